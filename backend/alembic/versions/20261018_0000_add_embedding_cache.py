@@ -0,0 +1,37 @@
+"""add embedding_cache table for persistent query embedding cache
+
+Revision ID: 20261018_0000
+Revises: 20260507_2300
+Create Date: 2026-10-18 09:00:00
+
+"""
+from __future__ import annotations
+
+from alembic import op
+
+
+revision = "20261018_0000"
+down_revision = "20260507_2300"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute("CREATE EXTENSION IF NOT EXISTS vector")
+    op.execute(
+        """
+        CREATE TABLE IF NOT EXISTS embedding_cache (
+            model VARCHAR(64) NOT NULL,
+            text_hash CHAR(64) NOT NULL,
+            embedding vector NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (model, text_hash)
+        )
+        """
+    )
+    op.execute("CREATE INDEX IF NOT EXISTS idx_embedding_cache_created ON embedding_cache(created_at)")
+
+
+def downgrade() -> None:
+    op.execute("DROP INDEX IF EXISTS idx_embedding_cache_created")
+    op.execute("DROP TABLE IF EXISTS embedding_cache")
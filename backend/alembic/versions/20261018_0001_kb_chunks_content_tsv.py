@@ -0,0 +1,40 @@
+"""add stored tsvector columns + GIN indexes on kb_chunks for keyword recall
+
+Revision ID: 20261018_0001
+Revises: 20261018_0000
+Create Date: 2026-10-18 10:00:00
+
+"""
+from __future__ import annotations
+
+from alembic import op
+
+
+revision = "20261018_0001"
+down_revision = "20261018_0000"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # 生成列在写入时计算一次 tsvector,检索时不再逐行 to_tsvector
+    op.execute(
+        "ALTER TABLE kb_chunks ADD COLUMN IF NOT EXISTS content_tsv tsvector "
+        "GENERATED ALWAYS AS (to_tsvector('simple', content)) STORED"
+    )
+    # 德语词干化版本(Konjunktiv/Konjunktivs、gehen/geht 等可互相命中)
+    op.execute(
+        "ALTER TABLE kb_chunks ADD COLUMN IF NOT EXISTS content_tsv_german tsvector "
+        "GENERATED ALWAYS AS (to_tsvector('german', content)) STORED"
+    )
+    op.execute("CREATE INDEX IF NOT EXISTS idx_kb_chunks_content_tsv ON kb_chunks USING GIN (content_tsv)")
+    op.execute(
+        "CREATE INDEX IF NOT EXISTS idx_kb_chunks_content_tsv_german ON kb_chunks USING GIN (content_tsv_german)"
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP INDEX IF EXISTS idx_kb_chunks_content_tsv_german")
+    op.execute("DROP INDEX IF EXISTS idx_kb_chunks_content_tsv")
+    op.execute("ALTER TABLE kb_chunks DROP COLUMN IF EXISTS content_tsv_german")
+    op.execute("ALTER TABLE kb_chunks DROP COLUMN IF EXISTS content_tsv")
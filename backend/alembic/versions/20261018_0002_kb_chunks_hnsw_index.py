@@ -0,0 +1,42 @@
+"""type kb_chunks.embedding as vector(1024) and replace ivfflat with HNSW
+
+Revision ID: 20261018_0002
+Revises: 20261018_0001
+Create Date: 2026-10-18 11:00:00
+
+"""
+from __future__ import annotations
+
+import os
+
+from alembic import op
+
+
+revision = "20261018_0002"
+down_revision = "20261018_0001"
+branch_labels = None
+depends_on = None
+
+
+# 与 text-embedding-v3 默认输出维度一致;换模型时同步修改
+EMBEDDING_DIM = int(os.getenv("KB_EMBEDDING_DIM", "1024"))
+# HNSW 构建参数:m 越大召回越高、索引越大;ef_construction 越大构建越慢、图质量越好
+HNSW_M = int(os.getenv("KB_HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("KB_HNSW_EF_CONSTRUCTION", "64"))
+
+
+def upgrade() -> None:
+    # 维度不符的脏数据无法转成定长向量,先清空其 embedding(文档可在管理端重建索引)
+    op.execute(f"UPDATE kb_chunks SET embedding = NULL WHERE embedding IS NOT NULL AND vector_dims(embedding) <> {EMBEDDING_DIM}")
+    op.execute("DROP INDEX IF EXISTS idx_kb_chunks_embedding_ivfflat")
+    op.execute(f"ALTER TABLE kb_chunks ALTER COLUMN embedding TYPE vector({EMBEDDING_DIM})")
+    op.execute(
+        "CREATE INDEX IF NOT EXISTS idx_kb_chunks_embedding_hnsw "
+        "ON kb_chunks USING hnsw (embedding vector_cosine_ops) "
+        f"WITH (m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION})"
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP INDEX IF EXISTS idx_kb_chunks_embedding_hnsw")
+    op.execute("ALTER TABLE kb_chunks ALTER COLUMN embedding TYPE vector")
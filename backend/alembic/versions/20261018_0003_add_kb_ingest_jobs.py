@@ -0,0 +1,52 @@
+"""add kb_ingest_jobs table for background document ingestion
+
+Revision ID: 20261018_0003
+Revises: 20261018_0002
+Create Date: 2026-10-18 12:00:00
+
+"""
+from __future__ import annotations
+
+from alembic import op
+
+
+revision = "20261018_0003"
+down_revision = "20261018_0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute(
+        """
+        CREATE TABLE IF NOT EXISTS kb_ingest_jobs (
+            id BIGSERIAL PRIMARY KEY,
+            document_id BIGINT NOT NULL REFERENCES kb_documents(id) ON DELETE CASCADE,
+            status VARCHAR(16) NOT NULL DEFAULT 'queued'
+                CHECK (status IN ('queued', 'running', 'succeeded', 'failed')),
+            progress INTEGER NOT NULL DEFAULT 0,
+            stage VARCHAR(32) NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 3,
+            error_message TEXT NULL,
+            worker_id VARCHAR(64) NULL,
+            run_after TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            heartbeat_at TIMESTAMPTZ NULL,
+            started_at TIMESTAMPTZ NULL,
+            finished_at TIMESTAMPTZ NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """
+    )
+    # 取任务只扫排队中的行
+    op.execute(
+        "CREATE INDEX IF NOT EXISTS idx_kb_ingest_jobs_queue ON kb_ingest_jobs(run_after, id) WHERE status = 'queued'"
+    )
+    op.execute("CREATE INDEX IF NOT EXISTS idx_kb_ingest_jobs_doc ON kb_ingest_jobs(document_id, id)")
+
+
+def downgrade() -> None:
+    op.execute("DROP INDEX IF EXISTS idx_kb_ingest_jobs_doc")
+    op.execute("DROP INDEX IF EXISTS idx_kb_ingest_jobs_queue")
+    op.execute("DROP TABLE IF EXISTS kb_ingest_jobs")
@@ -0,0 +1,43 @@
+"""add content_hash / embedding_model to kb_chunks for embedding reuse
+
+Revision ID: 20261018_0004
+Revises: 20261018_0003
+Create Date: 2026-10-18 14:00:00
+
+"""
+from __future__ import annotations
+
+import os
+
+from alembic import op
+
+
+revision = "20261018_0004"
+down_revision = "20261018_0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute("ALTER TABLE kb_chunks ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64) NULL")
+    op.execute("ALTER TABLE kb_chunks ADD COLUMN IF NOT EXISTS embedding_model VARCHAR(64) NULL")
+    # 已有向量均由当前配置的模型生成,回填后重建索引即可直接复用
+    op.execute(
+        "UPDATE kb_chunks SET content_hash = encode(sha256(convert_to(content, 'UTF8')), 'hex') "
+        "WHERE content_hash IS NULL"
+    )
+    model = os.getenv("EMBEDDING_MODEL", "text-embedding-v3").replace("'", "''")
+    op.execute(
+        f"UPDATE kb_chunks SET embedding_model = '{model}' "
+        "WHERE embedding_model IS NULL AND embedding IS NOT NULL"
+    )
+    op.execute(
+        "CREATE INDEX IF NOT EXISTS idx_kb_chunks_content_hash "
+        "ON kb_chunks (content_hash, embedding_model) WHERE embedding IS NOT NULL"
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP INDEX IF EXISTS idx_kb_chunks_content_hash")
+    op.execute("ALTER TABLE kb_chunks DROP COLUMN IF EXISTS embedding_model")
+    op.execute("ALTER TABLE kb_chunks DROP COLUMN IF EXISTS content_hash")
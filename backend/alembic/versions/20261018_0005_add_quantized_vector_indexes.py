@@ -0,0 +1,76 @@
+"""add binary / halfvec expression HNSW indexes on kb_chunks.embedding
+
+Revision ID: 20261018_0005
+Revises: 20261018_0004
+Create Date: 2026-10-18 16:00:00
+
+"""
+from __future__ import annotations
+
+import os
+
+from alembic import op
+
+
+revision = "20261018_0005"
+down_revision = "20261018_0004"
+branch_labels = None
+depends_on = None
+
+
+EMBEDDING_DIM = int(os.getenv("KB_EMBEDDING_DIM", "1024"))
+HNSW_M = int(os.getenv("KB_HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("KB_HNSW_EF_CONSTRUCTION", "64"))
+# 要建的量化索引(逗号分隔):binary = 1 bit/维(Hamming 粗排),halfvec = 16 bit/维
+QUANT_INDEXES = {
+    x.strip() for x in os.getenv("KB_VECTOR_QUANT_INDEXES", "binary,halfvec").split(",") if x.strip()
+}
+# 切到量化检索后可删掉全精度 HNSW 索引省空间(向量本身仍以全精度保存在表里,用于精排)
+DROP_FLOAT_HNSW = os.getenv("KB_DROP_FLOAT_HNSW", "false").lower() == "true"
+
+# 表达式必须与 KnowledgeBaseCRUD.search_chunks_by_embedding 中 ORDER BY 的写法完全一致,规划器才会用索引
+_INDEX_DEFS = {
+    "binary": (
+        "idx_kb_chunks_embedding_bit_hnsw",
+        f"(binary_quantize(embedding)::bit({EMBEDDING_DIM})) bit_hamming_ops",
+    ),
+    "halfvec": (
+        "idx_kb_chunks_embedding_half_hnsw",
+        f"(embedding::halfvec({EMBEDDING_DIM})) halfvec_cosine_ops",
+    ),
+}
+
+
+def upgrade() -> None:
+    for kind in sorted(QUANT_INDEXES):
+        if kind not in _INDEX_DEFS:
+            continue
+        name, expr = _INDEX_DEFS[kind]
+        # halfvec / binary_quantize 需要 pgvector >= 0.7,旧版本跳过而不是让整个迁移失败
+        op.execute(
+            f"""
+            DO $$
+            BEGIN
+                BEGIN
+                    CREATE INDEX IF NOT EXISTS {name}
+                    ON kb_chunks USING hnsw ({expr})
+                    WITH (m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION});
+                EXCEPTION WHEN OTHERS THEN
+                    RAISE NOTICE 'Skip {name} creation: %', SQLERRM;
+                END;
+            END
+            $$;
+            """
+        )
+    if DROP_FLOAT_HNSW:
+        op.execute("DROP INDEX IF EXISTS idx_kb_chunks_embedding_hnsw")
+
+
+def downgrade() -> None:
+    op.execute(
+        "CREATE INDEX IF NOT EXISTS idx_kb_chunks_embedding_hnsw "
+        "ON kb_chunks USING hnsw (embedding vector_cosine_ops) "
+        f"WITH (m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION})"
+    )
+    for name, _ in _INDEX_DEFS.values():
+        op.execute(f"DROP INDEX IF EXISTS {name}")
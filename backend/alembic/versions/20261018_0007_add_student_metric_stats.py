@@ -0,0 +1,67 @@
+"""add incremental student metric stats tables
+
+Revision ID: 20261018_0007
+Revises: 20261018_0006
+Create Date: 2026-10-18 19:00:00
+
+"""
+from __future__ import annotations
+
+from alembic import op
+
+
+revision = "20261018_0007"
+down_revision = "20261018_0006"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # 能力画像所需的累计量(计数/求和),由写路径事件增量维护
+    op.execute(
+        """
+        CREATE TABLE IF NOT EXISTS student_metric_stats (
+            student_id INTEGER PRIMARY KEY REFERENCES students(id) ON DELETE CASCADE,
+            grammar_total INTEGER NOT NULL DEFAULT 0,
+            grammar_correct INTEGER NOT NULL DEFAULT 0,
+            speaking_scored INTEGER NOT NULL DEFAULT 0,
+            speaking_total_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+            speaking_pron_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+            speaking_flu_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+            speaking_into_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+            writing_count INTEGER NOT NULL DEFAULT 0,
+            writing_len_sum BIGINT NOT NULL DEFAULT 0,
+            vocab_count INTEGER NOT NULL DEFAULT 0,
+            chat_user_messages INTEGER NOT NULL DEFAULT 0,
+            homework_scored INTEGER NOT NULL DEFAULT 0,
+            homework_score_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+            active_as_of DATE NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """
+    )
+    # 积极度滑动窗口用的按天练习计数,只保留最近几天
+    op.execute(
+        """
+        CREATE TABLE IF NOT EXISTS student_metric_daily (
+            student_id INTEGER NOT NULL REFERENCES students(id) ON DELETE CASCADE,
+            day DATE NOT NULL,
+            grammar_count INTEGER NOT NULL DEFAULT 0,
+            speaking_count INTEGER NOT NULL DEFAULT 0,
+            writing_count INTEGER NOT NULL DEFAULT 0,
+            homework_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (student_id, day)
+        )
+        """
+    )
+    op.execute("CREATE INDEX IF NOT EXISTS idx_student_metric_daily_day ON student_metric_daily(day)")
+    op.execute(
+        "CREATE INDEX IF NOT EXISTS idx_student_metric_stats_active_as_of ON student_metric_stats(active_as_of)"
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP INDEX IF EXISTS idx_student_metric_stats_active_as_of")
+    op.execute("DROP INDEX IF EXISTS idx_student_metric_daily_day")
+    op.execute("DROP TABLE IF EXISTS student_metric_daily")
+    op.execute("DROP TABLE IF EXISTS student_metric_stats")
@@ -0,0 +1,47 @@
+"""add materialized per-class metric stats
+
+Revision ID: 20261018_0008
+Revises: 20261018_0007
+Create Date: 2026-10-18 21:00:00
+
+"""
+from __future__ import annotations
+
+from alembic import op
+
+
+revision = "20261018_0008"
+down_revision = "20261018_0007"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # 教师分析类工具读取的班级聚合(能力均值、薄弱点分布、近 7 天活跃人数、错题热点)。
+    # 学生指标/错题变化时置 dirty,读取时或后台巡检时整批重算
+    op.execute(
+        """
+        CREATE TABLE IF NOT EXISTS class_metric_stats (
+            class_id INTEGER PRIMARY KEY REFERENCES classes(id) ON DELETE CASCADE,
+            student_count INTEGER NOT NULL DEFAULT 0,
+            ability_count INTEGER NOT NULL DEFAULT 0,
+            avg_listening DOUBLE PRECISION NOT NULL DEFAULT 0,
+            avg_speaking DOUBLE PRECISION NOT NULL DEFAULT 0,
+            avg_reading DOUBLE PRECISION NOT NULL DEFAULT 0,
+            avg_writing DOUBLE PRECISION NOT NULL DEFAULT 0,
+            weak_point_histogram JSONB NOT NULL DEFAULT '{}'::jsonb,
+            active_students_7d INTEGER NOT NULL DEFAULT 0,
+            error_hotspots JSONB NOT NULL DEFAULT '[]'::jsonb,
+            dirty BOOLEAN NOT NULL DEFAULT FALSE,
+            refreshed_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """
+    )
+    op.execute(
+        "CREATE INDEX IF NOT EXISTS idx_class_metric_stats_dirty ON class_metric_stats(class_id) WHERE dirty"
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP INDEX IF EXISTS idx_class_metric_stats_dirty")
+    op.execute("DROP TABLE IF EXISTS class_metric_stats")
@@ -0,0 +1,77 @@
+"""add daily learning / chat activity rollups
+
+Revision ID: 20261018_0009
+Revises: 20261018_0008
+Create Date: 2026-10-18 22:00:00
+
+"""
+from __future__ import annotations
+
+from alembic import op
+
+
+revision = "20261018_0009"
+down_revision = "20261018_0008"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # learning_sessions 按 (学生, 天, 模块) 汇总,写入学习记录时同步累加
+    op.execute(
+        """
+        CREATE TABLE IF NOT EXISTS student_activity_daily (
+            student_id INTEGER NOT NULL REFERENCES students(id) ON DELETE CASCADE,
+            day DATE NOT NULL,
+            module VARCHAR(64) NOT NULL,
+            minutes INTEGER NOT NULL DEFAULT 0,
+            session_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (student_id, day, module)
+        )
+        """
+    )
+    # chat_messages 按 (会话, 天) 汇总:首末消息时间用于计算互动时长,另记消息数
+    op.execute(
+        """
+        CREATE TABLE IF NOT EXISTS student_chat_daily (
+            session_id INTEGER NOT NULL REFERENCES chat_sessions(id) ON DELETE CASCADE,
+            day DATE NOT NULL,
+            student_id INTEGER NOT NULL REFERENCES students(id) ON DELETE CASCADE,
+            first_at TIMESTAMPTZ NOT NULL,
+            last_at TIMESTAMPTZ NOT NULL,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            user_message_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (session_id, day)
+        )
+        """
+    )
+    op.execute(
+        "CREATE INDEX IF NOT EXISTS idx_student_chat_daily_student_day ON student_chat_daily(student_id, day)"
+    )
+    # 回填历史数据:读路径只读汇总表,空表会让历史时长/活跃度全部显示为 0
+    # (与 ActivityRollupCRUD.rebuild 相同的聚合;scripts/backfill_activity_rollups.py 只用于事后修复)
+    op.execute(
+        """
+        INSERT INTO student_activity_daily(student_id, day, module, minutes, session_count)
+        SELECT student_id, CAST(session_date AS DATE), module, SUM(duration_minutes), COUNT(*)
+        FROM learning_sessions
+        GROUP BY 1, 2, 3
+        ON CONFLICT DO NOTHING
+        """
+    )
+    op.execute(
+        """
+        INSERT INTO student_chat_daily(session_id, day, student_id, first_at, last_at, message_count, user_message_count)
+        SELECT m.session_id, CAST(m.created_at AS DATE), cs.student_id, MIN(m.created_at), MAX(m.created_at),
+               COUNT(*), SUM(CASE WHEN m.role = 'user' THEN 1 ELSE 0 END)
+        FROM chat_messages m JOIN chat_sessions cs ON cs.id = m.session_id
+        GROUP BY 1, 2, 3
+        ON CONFLICT DO NOTHING
+        """
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP INDEX IF EXISTS idx_student_chat_daily_student_day")
+    op.execute("DROP TABLE IF EXISTS student_chat_daily")
+    op.execute("DROP TABLE IF EXISTS student_activity_daily")
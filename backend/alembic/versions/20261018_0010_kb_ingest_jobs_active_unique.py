@@ -0,0 +1,46 @@
+"""one active ingest job per kb document
+
+Revision ID: 20261018_0010
+Revises: 20261018_0009
+Create Date: 2026-10-18 23:00:00
+
+"""
+from __future__ import annotations
+
+from alembic import op
+
+
+revision = "20261018_0010"
+down_revision = "20261018_0009"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # 运行中再次提交的重建请求:当前任务结束后重新排队,而不是另起一个并发任务
+    op.execute(
+        "ALTER TABLE kb_ingest_jobs ADD COLUMN IF NOT EXISTS rerun_requested BOOLEAN NOT NULL DEFAULT FALSE"
+    )
+    # 清理历史遗留的重复活动任务:每个文档保留 running 优先、id 最小的一个
+    op.execute(
+        """
+        UPDATE kb_ingest_jobs j SET status = 'failed', error_message = 'superseded by another active job',
+            finished_at = NOW(), updated_at = NOW()
+        FROM (
+            SELECT id, ROW_NUMBER() OVER (
+                PARTITION BY document_id ORDER BY (status = 'running') DESC, id
+            ) AS rn
+            FROM kb_ingest_jobs WHERE status IN ('queued', 'running')
+        ) d
+        WHERE j.id = d.id AND d.rn > 1
+        """
+    )
+    op.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_kb_ingest_jobs_active_doc ON kb_ingest_jobs(document_id) "
+        "WHERE status IN ('queued', 'running')"
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP INDEX IF EXISTS uq_kb_ingest_jobs_active_doc")
+    op.execute("ALTER TABLE kb_ingest_jobs DROP COLUMN IF EXISTS rerun_requested")
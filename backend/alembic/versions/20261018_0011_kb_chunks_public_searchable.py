@@ -0,0 +1,124 @@
+"""restrict public vector ANN to public, ready, active chunks
+
+Revision ID: 20261018_0011
+Revises: 20261018_0010
+Create Date: 2026-10-18 23:30:00
+
+"""
+from __future__ import annotations
+
+import os
+
+from alembic import op
+
+
+revision = "20261018_0011"
+down_revision = "20261018_0010"
+branch_labels = None
+depends_on = None
+
+
+EMBEDDING_DIM = int(os.getenv("KB_EMBEDDING_DIM", "1024"))
+HNSW_M = int(os.getenv("KB_HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("KB_HNSW_EF_CONSTRUCTION", "64"))
+QUANT_INDEXES = {
+    x.strip() for x in os.getenv("KB_VECTOR_QUANT_INDEXES", "binary,halfvec").split(",") if x.strip()
+}
+
+# 与 20261018_0002 / 0005 的索引表达式一致,只是加了 WHERE public_searchable 的部分索引条件
+_INDEX_DEFS = {
+    "float": ("idx_kb_chunks_embedding_public_hnsw", "embedding vector_cosine_ops"),
+    "binary": (
+        "idx_kb_chunks_embedding_public_bit_hnsw",
+        f"(binary_quantize(embedding)::bit({EMBEDDING_DIM})) bit_hamming_ops",
+    ),
+    "halfvec": (
+        "idx_kb_chunks_embedding_public_half_hnsw",
+        f"(embedding::halfvec({EMBEDDING_DIM})) halfvec_cosine_ops",
+    ),
+}
+
+
+def upgrade() -> None:
+    # 部分索引不能引用 kb_documents,把"公共、ready、激活"冗余到 chunk 上,由触发器维护
+    op.execute(
+        "ALTER TABLE kb_chunks ADD COLUMN IF NOT EXISTS public_searchable BOOLEAN NOT NULL DEFAULT FALSE"
+    )
+    op.execute(
+        """
+        UPDATE kb_chunks c SET public_searchable = TRUE
+        FROM kb_documents d
+        WHERE d.id = c.document_id AND d.scope = 'public' AND d.status = 'ready' AND d.is_active = TRUE
+        """
+    )
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION kb_chunks_set_public_searchable() RETURNS trigger AS $$
+        BEGIN
+            SELECT (d.scope = 'public' AND d.status = 'ready' AND d.is_active = TRUE)
+              INTO NEW.public_searchable
+              FROM kb_documents d WHERE d.id = NEW.document_id;
+            NEW.public_searchable := COALESCE(NEW.public_searchable, FALSE);
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        """
+    )
+    op.execute("DROP TRIGGER IF EXISTS trg_kb_chunks_public_searchable ON kb_chunks")
+    op.execute(
+        "CREATE TRIGGER trg_kb_chunks_public_searchable BEFORE INSERT OR UPDATE OF document_id ON kb_chunks "
+        "FOR EACH ROW EXECUTE FUNCTION kb_chunks_set_public_searchable()"
+    )
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION kb_documents_sync_public_searchable() RETURNS trigger AS $$
+        DECLARE
+            visible BOOLEAN := (NEW.scope = 'public' AND NEW.status = 'ready' AND NEW.is_active = TRUE);
+        BEGIN
+            UPDATE kb_chunks SET public_searchable = visible
+            WHERE document_id = NEW.id AND public_searchable IS DISTINCT FROM visible;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """
+    )
+    op.execute("DROP TRIGGER IF EXISTS trg_kb_documents_public_searchable ON kb_documents")
+    op.execute(
+        "CREATE TRIGGER trg_kb_documents_public_searchable AFTER UPDATE OF scope, status, is_active ON kb_documents "
+        "FOR EACH ROW WHEN ("
+        "(OLD.scope = 'public' AND OLD.status = 'ready' AND OLD.is_active = TRUE) IS DISTINCT FROM "
+        "(NEW.scope = 'public' AND NEW.status = 'ready' AND NEW.is_active = TRUE)"
+        ") EXECUTE FUNCTION kb_documents_sync_public_searchable()"
+    )
+
+    for kind in ["float"] + sorted(QUANT_INDEXES):
+        if kind not in _INDEX_DEFS:
+            continue
+        name, expr = _INDEX_DEFS[kind]
+        # halfvec / binary_quantize 需要 pgvector >= 0.7,旧版本跳过而不是让整个迁移失败
+        op.execute(
+            f"""
+            DO $$
+            BEGIN
+                BEGIN
+                    CREATE INDEX IF NOT EXISTS {name}
+                    ON kb_chunks USING hnsw ({expr})
+                    WITH (m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION})
+                    WHERE public_searchable;
+                EXCEPTION WHEN OTHERS THEN
+                    RAISE NOTICE 'Skip {name} creation: %', SQLERRM;
+                END;
+            END
+            $$;
+            """
+        )
+
+
+def downgrade() -> None:
+    for name, _ in _INDEX_DEFS.values():
+        op.execute(f"DROP INDEX IF EXISTS {name}")
+    op.execute("DROP TRIGGER IF EXISTS trg_kb_documents_public_searchable ON kb_documents")
+    op.execute("DROP FUNCTION IF EXISTS kb_documents_sync_public_searchable()")
+    op.execute("DROP TRIGGER IF EXISTS trg_kb_chunks_public_searchable ON kb_chunks")
+    op.execute("DROP FUNCTION IF EXISTS kb_chunks_set_public_searchable()")
+    op.execute("ALTER TABLE kb_chunks DROP COLUMN IF EXISTS public_searchable")
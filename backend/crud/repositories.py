@@ -1,3 +1,6 @@
+import json
+import os
+import struct
 from datetime import datetime, timezone
 from typing import Any
 
@@ -66,6 +69,7 @@ from schemas.entities import (
     VocabularyCreate,
     WritingSessionCreate,
 )
+from services.tool_cache import invalidate_tool_cache, student_tag
 
 
 class SystemSettingCRUD:
@@ -276,6 +280,32 @@ class StudentCRUD:
             out.append(row)
         return out
 
+    @staticmethod
+    def bulk_update_metrics(db: Session, metrics: dict[int, dict[str, Any]]) -> list[int]:
+        """批量写回积极度/综合分/薄弱点,只改动有变化的行;不提交。返回实际更新的学生 id。"""
+        if not metrics:
+            return []
+        ids = list(metrics)
+        rows = db.execute(
+            text(
+                "UPDATE students AS s SET active_score=v.active_score, overall_score=v.overall_score, "
+                "weak_point=v.weak_point, updated_at=NOW() "
+                "FROM unnest(CAST(:ids AS INTEGER[]), CAST(:active AS INTEGER[]), "
+                "CAST(:overall AS NUMERIC[]), CAST(:weak AS VARCHAR[])) "
+                "AS v(id, active_score, overall_score, weak_point) "
+                "WHERE s.id = v.id AND (s.active_score, s.overall_score, s.weak_point) "
+                "IS DISTINCT FROM (v.active_score, v.overall_score, v.weak_point) "
+                "RETURNING s.id"
+            ),
+            {
+                "ids": ids,
+                "active": [int(metrics[i]["active_score"]) for i in ids],
+                "overall": [float(metrics[i]["overall_score"]) for i in ids],
+                "weak": [metrics[i]["weak_point"] for i in ids],
+            },
+        ).scalars().all()
+        return list(rows)
+
     @staticmethod
     def list_class_ids(db: Session, student_id: int) -> list[int]:
         rows = list(
@@ -290,10 +320,14 @@ class StudentCRUD:
     @staticmethod
     def set_classes(db: Session, student: Student, class_ids: list[int]) -> None:
         dedup_ids = sorted(set(int(x) for x in class_ids if x is not None))
+        # 原班级与新班级的聚合都要重算
+        ClassMetricStatsCRUD.mark_dirty_for_students(db, [student.id])
+        ClassMetricStatsCRUD.mark_dirty(db, dedup_ids)
         db.execute(delete(ClassStudentRelation).where(ClassStudentRelation.student_id == student.id))
         for class_id in dedup_ids:
             db.add(ClassStudentRelation(class_id=class_id, student_id=student.id))
         db.commit()
+        invalidate_tool_cache(student_tag(student.id, "profile"))
         db.refresh(student)
 
     @staticmethod
@@ -315,6 +349,7 @@ class StudentCRUD:
             if hasattr(student, k):
                 setattr(student, k, v)
         db.commit()
+        invalidate_tool_cache(student_tag(student.id, "profile"))
         db.refresh(student)
         return student
 
@@ -363,6 +398,36 @@ class StudentAbilityCRUD:
         db.refresh(obj)
         return obj
 
+    @staticmethod
+    def bulk_upsert(db: Session, metrics: dict[int, dict[str, Any]]) -> list[int]:
+        """批量 upsert 四维能力与诊断,只改动有变化的行;不提交。返回实际写入的学生 id。"""
+        if not metrics:
+            return []
+        ids = list(metrics)
+        rows = db.execute(
+            text(
+                "INSERT INTO student_abilities(student_id, listening, speaking, reading, writing, ai_diagnosis) "
+                "SELECT * FROM unnest(CAST(:ids AS INTEGER[]), CAST(:listening AS INTEGER[]), "
+                "CAST(:speaking AS INTEGER[]), CAST(:reading AS INTEGER[]), CAST(:writing AS INTEGER[]), "
+                "CAST(:diagnosis AS TEXT[])) "
+                "ON CONFLICT (student_id) DO UPDATE SET listening=EXCLUDED.listening, speaking=EXCLUDED.speaking, "
+                "reading=EXCLUDED.reading, writing=EXCLUDED.writing, ai_diagnosis=EXCLUDED.ai_diagnosis, updated_at=NOW() "
+                "WHERE (student_abilities.listening, student_abilities.speaking, student_abilities.reading, "
+                "student_abilities.writing, student_abilities.ai_diagnosis) IS DISTINCT FROM "
+                "(EXCLUDED.listening, EXCLUDED.speaking, EXCLUDED.reading, EXCLUDED.writing, EXCLUDED.ai_diagnosis) "
+                "RETURNING student_id"
+            ),
+            {
+                "ids": ids,
+                "listening": [int(metrics[i]["listening"]) for i in ids],
+                "speaking": [int(metrics[i]["speaking"]) for i in ids],
+                "reading": [int(metrics[i]["reading"]) for i in ids],
+                "writing": [int(metrics[i]["writing"]) for i in ids],
+                "diagnosis": [metrics[i]["diagnosis"] for i in ids],
+            },
+        ).scalars().all()
+        return list(rows)
+
     @staticmethod
     def get_by_student_id(db: Session, student_id: int) -> StudentAbility | None:
         return db.scalar(select(StudentAbility).where(StudentAbility.student_id == student_id))
@@ -374,6 +439,7 @@ class HomeworkCRUD:
         obj = Homework(**payload.model_dump())
         db.add(obj)
         db.commit()
+        invalidate_tool_cache(student_tag(obj.student_id, "homework"))
         db.refresh(obj)
         return obj
 
@@ -394,6 +460,7 @@ class HomeworkCRUD:
         if feedback:
             homework.ai_comment = feedback
         db.commit()
+        invalidate_tool_cache(student_tag(homework.student_id, "homework"))
         db.refresh(homework)
         return homework
 
@@ -690,6 +757,8 @@ class ChatMessageCRUD:
     def create(db: Session, payload: ChatMessageCreate) -> ChatMessage:
         obj = ChatMessage(**payload.model_dump())
         db.add(obj)
+        db.flush()
+        ActivityRollupCRUD.add_chat_message(db, obj.id)
         db.commit()
         db.refresh(obj)
         return obj
@@ -1174,6 +1243,7 @@ class LearningSessionCRUD:
             data["session_date"] = date.today()
         obj = LearningSession(**data)
         db.add(obj)
+        ActivityRollupCRUD.add_learning(db, obj.student_id, obj.session_date, obj.module, obj.duration_minutes)
         db.commit()
         db.refresh(obj)
         return obj
@@ -1184,25 +1254,163 @@ class LearningSessionCRUD:
             select(LearningSession).where(LearningSession.student_id == student_id).order_by(LearningSession.session_date.desc())
         ))
 
+    @staticmethod
+    def list_week_contents(db: Session, student_id: int, week_start: Any) -> list[tuple[Any, str]]:
+        """本周各条学习记录的 (session_date, content),用于周报文字;时长走 student_activity_daily。"""
+        return [
+            (session_date, content)
+            for session_date, content in db.execute(
+                select(LearningSession.session_date, LearningSession.content)
+                .where(
+                    LearningSession.student_id == student_id,
+                    LearningSession.session_date >= week_start,
+                    LearningSession.content.is_not(None),
+                )
+                .order_by(LearningSession.session_date.desc())
+            )
+        ]
+
     @staticmethod
     def total_minutes(db: Session, student_id: int) -> int:
-        from sqlalchemy import func as sa_func
-        result = db.scalar(
-            select(sa_func.coalesce(sa_func.sum(LearningSession.duration_minutes), 0))
-            .where(LearningSession.student_id == student_id)
-        )
-        return int(result)
+        return sum(ActivityRollupCRUD.module_minutes(db, student_id).values())
 
     @staticmethod
     def week_minutes(db: Session, student_id: int) -> int:
         from datetime import date, timedelta
-        from sqlalchemy import func as sa_func
         week_start = date.today() - timedelta(days=date.today().weekday())
-        result = db.scalar(
-            select(sa_func.coalesce(sa_func.sum(LearningSession.duration_minutes), 0))
-            .where(LearningSession.student_id == student_id, LearningSession.session_date >= week_start)
+        return ActivityRollupCRUD.minutes_since_many(db, [student_id], week_start).get(student_id, 0)
+
+
+class ActivityRollupCRUD:
+    """student_activity_daily(学习时长按天/模块汇总)与 student_chat_daily(对话按会话/天汇总)。
+
+    写入学习记录 / 对话消息时在同一事务里累加;写方法均不提交。
+    """
+
+    @staticmethod
+    def add_learning(db: Session, student_id: int, session_date: Any, module: str, minutes: int) -> None:
+        day = session_date.date() if isinstance(session_date, datetime) else session_date
+        db.execute(
+            text(
+                "INSERT INTO student_activity_daily(student_id, day, module, minutes, session_count) "
+                "VALUES (:student_id, :day, :module, :minutes, 1) "
+                "ON CONFLICT (student_id, day, module) DO UPDATE SET "
+                "minutes = student_activity_daily.minutes + EXCLUDED.minutes, "
+                "session_count = student_activity_daily.session_count + 1"
+            ),
+            {"student_id": student_id, "day": day, "module": module, "minutes": int(minutes or 0)},
+        )
+
+    @staticmethod
+    def add_chat_message(db: Session, message_id: int) -> None:
+        db.execute(
+            text(
+                "INSERT INTO student_chat_daily"
+                "(session_id, day, student_id, first_at, last_at, message_count, user_message_count) "
+                "SELECT m.session_id, CAST(m.created_at AS DATE), cs.student_id, m.created_at, m.created_at, 1, "
+                "CASE WHEN m.role = 'user' THEN 1 ELSE 0 END "
+                "FROM chat_messages m JOIN chat_sessions cs ON cs.id = m.session_id WHERE m.id = :id "
+                "ON CONFLICT (session_id, day) DO UPDATE SET "
+                "first_at = LEAST(student_chat_daily.first_at, EXCLUDED.first_at), "
+                "last_at = GREATEST(student_chat_daily.last_at, EXCLUDED.last_at), "
+                "message_count = student_chat_daily.message_count + 1, "
+                "user_message_count = student_chat_daily.user_message_count + EXCLUDED.user_message_count"
+            ),
+            {"id": message_id},
+        )
+
+    @staticmethod
+    def module_minutes(db: Session, student_id: int) -> dict[str, int]:
+        rows = db.execute(
+            text(
+                "SELECT module, SUM(minutes) FROM student_activity_daily "
+                "WHERE student_id = :student_id GROUP BY module"
+            ),
+            {"student_id": student_id},
+        ).all()
+        return {module: int(total or 0) for module, total in rows}
+
+    @staticmethod
+    def module_summary_since(db: Session, student_id: int, since: Any) -> list[tuple[str, int, int]]:
+        """[since, 今天] 内按模块的 (module, 学习次数, 分钟数),分钟数降序。"""
+        rows = db.execute(
+            text(
+                "SELECT module, SUM(session_count) AS session_count, SUM(minutes) AS total_minutes "
+                "FROM student_activity_daily WHERE student_id = :student_id AND day >= :since "
+                "GROUP BY module ORDER BY total_minutes DESC, module"
+            ),
+            {"student_id": student_id, "since": since},
+        ).all()
+        return [(module, int(cnt or 0), int(mins or 0)) for module, cnt, mins in rows]
+
+    @staticmethod
+    def daily_minutes(db: Session, student_id: int, since: Any) -> dict[Any, int]:
+        rows = db.execute(
+            text(
+                "SELECT day, SUM(minutes) FROM student_activity_daily "
+                "WHERE student_id = :student_id AND day >= :since GROUP BY day"
+            ),
+            {"student_id": student_id, "since": since},
+        ).all()
+        return {day: int(total or 0) for day, total in rows}
+
+    @staticmethod
+    def minutes_since_many(db: Session, student_ids: list[int], since: Any) -> dict[int, int]:
+        if not student_ids:
+            return {}
+        rows = db.execute(
+            text(
+                "SELECT student_id, SUM(minutes) FROM student_activity_daily "
+                "WHERE student_id = ANY(:ids) AND day >= :since GROUP BY student_id"
+            ),
+            {"ids": list(student_ids), "since": since},
+        ).all()
+        return {sid: int(total or 0) for sid, total in rows}
+
+    @staticmethod
+    def chat_session_spans(db: Session, student_ids: list[int], since: Any) -> list[tuple[int, Any, Any, int]]:
+        """[since, 今天] 内每个会话的 (student_id, 首条消息时间, 末条消息时间, 用户发言数)。"""
+        if not student_ids:
+            return []
+        return [
+            (sid, first_at, last_at, int(user_count or 0))
+            for sid, first_at, last_at, user_count in db.execute(
+                text(
+                    "SELECT student_id, MIN(first_at), MAX(last_at), SUM(user_message_count) "
+                    "FROM student_chat_daily WHERE student_id = ANY(:ids) AND day >= :since "
+                    "GROUP BY student_id, session_id"
+                ),
+                {"ids": list(student_ids), "since": since},
+            )
+        ]
+
+    @staticmethod
+    def rebuild(db: Session, student_ids: list[int] | None = None) -> None:
+        """从 learning_sessions / chat_messages 重建汇总(student_ids 为空表示全部学生)。"""
+        scope = "" if student_ids is None else " WHERE student_id = ANY(:ids)"
+        chat_scope = "" if student_ids is None else " WHERE cs.student_id = ANY(:ids)"
+        params = {} if student_ids is None else {"ids": list(student_ids)}
+        db.execute(text("DELETE FROM student_activity_daily" + scope), params)
+        db.execute(
+            text(
+                "INSERT INTO student_activity_daily(student_id, day, module, minutes, session_count) "
+                "SELECT student_id, CAST(session_date AS DATE), module, SUM(duration_minutes), COUNT(*) "
+                "FROM learning_sessions" + scope + " GROUP BY 1, 2, 3"
+            ),
+            params,
+        )
+        db.execute(text("DELETE FROM student_chat_daily" + scope), params)
+        db.execute(
+            text(
+                "INSERT INTO student_chat_daily"
+                "(session_id, day, student_id, first_at, last_at, message_count, user_message_count) "
+                "SELECT m.session_id, CAST(m.created_at AS DATE), cs.student_id, MIN(m.created_at), MAX(m.created_at), "
+                "COUNT(*), SUM(CASE WHEN m.role = 'user' THEN 1 ELSE 0 END) "
+                "FROM chat_messages m JOIN chat_sessions cs ON cs.id = m.session_id"
+                + chat_scope + " GROUP BY 1, 2, 3"
+            ),
+            params,
         )
-        return int(result)
 
 
 class StudentKnowledgeMasteryCRUD:
@@ -1232,7 +1440,357 @@ class StudentKnowledgeMasteryCRUD:
         ))
 
 
+# kb_chunks 批量写入:psycopg 下走二进制 COPY(关闭后退化为 executemany)
+KB_BULK_INSERT = os.getenv("KB_BULK_INSERT", "true").lower() == "true"
+# kb_chunks.embedding 的维度(与迁移 20261018_0002 一致),量化检索的表达式索引按它建
+KB_EMBEDDING_DIM = int(os.getenv("KB_EMBEDDING_DIM", "1024"))
+
+
+def _vector_literal(vec: list[float]) -> str:
+    return "[" + ",".join(repr(float(x)) for x in vec) + "]"
+
+
+def _vector_binary_dumper(vector_oid: int):
+    """构造 pgvector 的 psycopg 二进制 dumper:uint16 维度 + uint16 保留位 + float4 大端数组。"""
+    from psycopg.adapt import Dumper
+    from psycopg.pq import Format
+
+    class VectorBinaryDumper(Dumper):
+        format = Format.BINARY
+        oid = vector_oid
+
+        def dump(self, obj):
+            return struct.pack(f">HH{len(obj)}f", len(obj), 0, *obj)
+
+    return VectorBinaryDumper
+
+
+def _copy_kb_chunks(db: Session, doc_id: int, chunks: list[dict[str, Any]]) -> None:
+    """在当前 Session 的事务里用 COPY ... FORMAT BINARY 写入一批 chunks。"""
+    from psycopg.types import TypeInfo
+
+    raw = db.connection().connection.driver_connection
+    info = TypeInfo.fetch(raw, "vector")
+    if info is None:
+        raise RuntimeError("数据库未安装 pgvector 扩展(vector 类型不存在)")
+    raw.adapters.register_dumper(None, _vector_binary_dumper(info.oid))
+
+    with raw.cursor() as cur:
+        with cur.copy(
+            "COPY kb_chunks (document_id, chunk_index, content, token_count, metadata, "
+            "content_hash, embedding_model, embedding) "
+            "FROM STDIN WITH (FORMAT BINARY)"
+        ) as copy:
+            copy.set_types(["int8", "int4", "text", "int4", "jsonb", "varchar", "varchar", info.oid])
+            for c in chunks:
+                copy.write_row((
+                    doc_id,
+                    c["chunk_index"],
+                    c["content"],
+                    c.get("token_count", 0),
+                    json.loads(c.get("metadata_json") or "{}"),
+                    c.get("content_hash"),
+                    c.get("embedding_model"),
+                    c["embedding"],
+                ))
+
+
 # 数据库操作
+class StudentMetricStatsCRUD:
+    """student_metric_stats(累计量)与 student_metric_daily(按天练习计数)的读写。写方法均不提交。"""
+
+    COUNTERS = (
+        "grammar_total", "grammar_correct",
+        "speaking_scored", "speaking_total_sum", "speaking_pron_sum", "speaking_flu_sum", "speaking_into_sum",
+        "writing_count", "writing_len_sum",
+        "vocab_count", "chat_user_messages",
+        "homework_scored", "homework_score_sum",
+    )
+    DAILY_COUNTERS = ("grammar_count", "speaking_count", "writing_count", "homework_count")
+    _COUNTER_TYPES = {
+        "speaking_total_sum": "DOUBLE PRECISION", "speaking_pron_sum": "DOUBLE PRECISION",
+        "speaking_flu_sum": "DOUBLE PRECISION", "speaking_into_sum": "DOUBLE PRECISION",
+        "homework_score_sum": "DOUBLE PRECISION", "writing_len_sum": "BIGINT",
+    }
+
+    @staticmethod
+    def apply_deltas(
+        db: Session, student_id: int, deltas: dict[str, float], active_as_of: Any
+    ) -> dict[str, Any] | None:
+        """累计量加上增量并返回更新后的整行;该学生还没有统计行时返回 None(由调用方全量重建)。"""
+        unknown = set(deltas) - set(StudentMetricStatsCRUD.COUNTERS)
+        if unknown:
+            raise ValueError(f"unknown metric counters: {sorted(unknown)}")
+        sets = [f"{c} = {c} + :{c}" for c in deltas]
+        row = db.execute(
+            text(
+                "UPDATE student_metric_stats SET "
+                + ", ".join(sets + ["active_as_of = :active_as_of", "updated_at = NOW()"])
+                + " WHERE student_id = :student_id RETURNING *"
+            ),
+            {**deltas, "student_id": student_id, "active_as_of": active_as_of},
+        ).mappings().first()
+        return dict(row) if row else None
+
+    @staticmethod
+    def add_daily(db: Session, student_id: int, day: Any, deltas: dict[str, int]) -> None:
+        cols = [c for c in StudentMetricStatsCRUD.DAILY_COUNTERS if deltas.get(c)]
+        if not cols:
+            return
+        db.execute(
+            text(
+                f"INSERT INTO student_metric_daily(student_id, day, {', '.join(cols)}) "
+                f"VALUES (:student_id, :day, {', '.join(':' + c for c in cols)}) "
+                "ON CONFLICT (student_id, day) DO UPDATE SET "
+                + ", ".join(f"{c} = student_metric_daily.{c} + EXCLUDED.{c}" for c in cols)
+            ),
+            {**{c: int(deltas[c]) for c in cols}, "student_id": student_id, "day": day},
+        )
+
+    @staticmethod
+    def window_counts(db: Session, student_ids: list[int], since: Any) -> dict[int, dict[str, int]]:
+        """[since, 今天] 内各项练习次数之和。"""
+        if not student_ids:
+            return {}
+        cols = StudentMetricStatsCRUD.DAILY_COUNTERS
+        rows = db.execute(
+            text(
+                f"SELECT student_id, {', '.join(f'SUM({c}) AS {c}' for c in cols)} "
+                "FROM student_metric_daily WHERE student_id = ANY(:ids) AND day >= :since "
+                "GROUP BY student_id"
+            ),
+            {"ids": list(student_ids), "since": since},
+        ).mappings().all()
+        return {r["student_id"]: {c: int(r[c] or 0) for c in cols} for r in rows}
+
+    @staticmethod
+    def replace_many(
+        db: Session,
+        stats: dict[int, dict[str, float]],
+        daily: dict[int, dict[Any, dict[str, int]]],
+        since: Any,
+        active_as_of: Any,
+    ) -> None:
+        """全量重建:覆盖累计量,并用 daily 替换 [since, 今天] 的按天计数。"""
+        if not stats:
+            return
+        ids = list(stats)
+        cols = StudentMetricStatsCRUD.COUNTERS
+        types = StudentMetricStatsCRUD._COUNTER_TYPES
+        db.execute(
+            text(
+                f"INSERT INTO student_metric_stats(student_id, {', '.join(cols)}, active_as_of, updated_at) "
+                "SELECT v.*, CAST(:active_as_of AS DATE), NOW() FROM unnest(CAST(:ids AS INTEGER[]), "
+                + ", ".join(f"CAST(:{c} AS {types.get(c, 'INTEGER')}[])" for c in cols)
+                + f") AS v(student_id, {', '.join(cols)}) "
+                "ON CONFLICT (student_id) DO UPDATE SET "
+                + ", ".join(f"{c} = EXCLUDED.{c}" for c in cols)
+                + ", active_as_of = EXCLUDED.active_as_of, updated_at = NOW()"
+            ),
+            {"ids": ids, "active_as_of": active_as_of, **{c: [stats[i].get(c, 0) for i in ids] for c in cols}},
+        )
+        db.execute(
+            text("DELETE FROM student_metric_daily WHERE student_id = ANY(:ids) AND day >= :since"),
+            {"ids": ids, "since": since},
+        )
+        daily_rows = [(sid, day, counts) for sid, days in daily.items() for day, counts in days.items()]
+        if daily_rows:
+            dcols = StudentMetricStatsCRUD.DAILY_COUNTERS
+            db.execute(
+                text(
+                    f"INSERT INTO student_metric_daily(student_id, day, {', '.join(dcols)}) "
+                    "SELECT * FROM unnest(CAST(:ids AS INTEGER[]), CAST(:days AS DATE[]), "
+                    + ", ".join(f"CAST(:{c} AS INTEGER[])" for c in dcols)
+                    + ")"
+                ),
+                {
+                    "ids": [r[0] for r in daily_rows],
+                    "days": [r[1] for r in daily_rows],
+                    **{c: [int(r[2].get(c, 0)) for r in daily_rows] for c in dcols},
+                },
+            )
+
+    @staticmethod
+    def list_stale_student_ids(db: Session, today: Any, limit: int) -> list[int]:
+        """还没有统计行、或积极度不是今天算的学生(窗口已滑动)。"""
+        return list(db.execute(
+            text(
+                "SELECT s.id FROM students s "
+                "LEFT JOIN student_metric_stats m ON m.student_id = s.id "
+                "WHERE m.student_id IS NULL OR m.active_as_of IS NULL OR m.active_as_of < :today "
+                "ORDER BY s.id LIMIT :limit"
+            ),
+            {"today": today, "limit": limit},
+        ).scalars())
+
+    @staticmethod
+    def prune_daily(db: Session, before: Any) -> int:
+        result = db.execute(text("DELETE FROM student_metric_daily WHERE day < :before"), {"before": before})
+        return int(result.rowcount or 0)
+
+
+class ClassMetricStatsCRUD:
+    """class_metric_stats:教师分析类工具读取的班级聚合。写方法均不提交。
+
+    所有写方法都按 class_id 升序加行锁,标记 dirty 与整批重算并发时不会互相死锁。
+    """
+
+    @staticmethod
+    def mark_dirty(db: Session, class_ids: list[int]) -> None:
+        if not class_ids:
+            return
+        db.execute(
+            text(
+                "UPDATE class_metric_stats SET dirty = TRUE WHERE class_id IN ("
+                "SELECT class_id FROM class_metric_stats WHERE class_id = ANY(:ids) AND NOT dirty "
+                "ORDER BY class_id FOR UPDATE)"
+            ),
+            {"ids": sorted(class_ids)},
+        )
+
+    @staticmethod
+    def mark_dirty_for_students(db: Session, student_ids: list[int]) -> None:
+        """学生指标 / 错题变化后,把其所在班级的聚合标记为待重算。"""
+        if not student_ids:
+            return
+        db.execute(
+            text(
+                "UPDATE class_metric_stats SET dirty = TRUE WHERE class_id IN ("
+                "SELECT class_id FROM class_metric_stats WHERE NOT dirty AND class_id IN ("
+                "SELECT class_id FROM class_student_relations WHERE student_id = ANY(:ids)) "
+                "ORDER BY class_id FOR UPDATE)"
+            ),
+            {"ids": list(student_ids)},
+        )
+
+    @staticmethod
+    def get_many(db: Session, class_ids: list[int]) -> dict[int, dict[str, Any]]:
+        if not class_ids:
+            return {}
+        rows = db.execute(
+            text("SELECT * FROM class_metric_stats WHERE class_id = ANY(:ids)"),
+            {"ids": list(class_ids)},
+        ).mappings().all()
+        return {r["class_id"]: dict(r) for r in rows}
+
+    @staticmethod
+    def list_dirty_class_ids(db: Session, limit: int) -> list[int]:
+        """待重算的班级:已标记 dirty 的,以及还没有聚合行的(新建班级)。"""
+        return list(db.execute(
+            text(
+                "SELECT class_id FROM class_metric_stats WHERE dirty "
+                "UNION "
+                "SELECT c.id FROM classes c "
+                "WHERE NOT EXISTS (SELECT 1 FROM class_metric_stats s WHERE s.class_id = c.id) "
+                "ORDER BY 1 LIMIT :limit"
+            ),
+            {"limit": limit},
+        ).scalars())
+
+    @staticmethod
+    def rebuild(db: Session, class_ids: list[int], active_days: int = 7) -> None:
+        """一条语句整批重算这些班级的聚合并写入(不存在则插入)。"""
+        if not class_ids:
+            return
+        ids = sorted({int(c) for c in class_ids})
+        # 先按 class_id 顺序锁住已有行,再按同样顺序写入,与 mark_dirty* 的加锁顺序一致
+        db.execute(
+            text(
+                "SELECT class_id FROM class_metric_stats WHERE class_id = ANY(:ids) "
+                "ORDER BY class_id FOR UPDATE"
+            ),
+            {"ids": ids},
+        )
+        db.execute(
+            text(
+                """
+                WITH target AS (
+                    SELECT DISTINCT unnest(CAST(:ids AS INTEGER[])) AS class_id
+                ),
+                members AS (
+                    SELECT r.class_id, r.student_id
+                    FROM class_student_relations r JOIN target t ON t.class_id = r.class_id
+                ),
+                ability AS (
+                    SELECT m.class_id, COUNT(*) AS student_count, COUNT(a.id) AS ability_count,
+                           COALESCE(AVG(a.listening), 0) AS avg_listening,
+                           COALESCE(AVG(a.speaking), 0) AS avg_speaking,
+                           COALESCE(AVG(a.reading), 0) AS avg_reading,
+                           COALESCE(AVG(a.writing), 0) AS avg_writing
+                    FROM members m LEFT JOIN student_abilities a ON a.student_id = m.student_id
+                    GROUP BY m.class_id
+                ),
+                weak AS (
+                    SELECT class_id, jsonb_object_agg(weak_point, n) AS histogram
+                    FROM (
+                        SELECT m.class_id, COALESCE(NULLIF(s.weak_point, ''), '未识别') AS weak_point, COUNT(*) AS n
+                        FROM members m JOIN students s ON s.id = m.student_id
+                        GROUP BY 1, 2
+                    ) w
+                    GROUP BY class_id
+                ),
+                active AS (
+                    SELECT m.class_id, COUNT(DISTINCT m.student_id) AS n
+                    FROM members m
+                    WHERE EXISTS (
+                        SELECT 1 FROM learning_sessions ls
+                        WHERE ls.student_id = m.student_id
+                          AND ls.created_at >= NOW() - make_interval(days => :active_days)
+                    )
+                    GROUP BY m.class_id
+                ),
+                errors AS (
+                    SELECT class_id,
+                           jsonb_agg(
+                               jsonb_build_object(
+                                   'source', source, 'error_count', error_count,
+                                   'affected_students', affected_students
+                               )
+                               ORDER BY error_count DESC, source
+                           ) AS hotspots
+                    FROM (
+                        SELECT m.class_id, e.source, COUNT(*) AS error_count,
+                               COUNT(DISTINCT e.student_id) AS affected_students
+                        FROM members m JOIN error_book_entries e ON e.student_id = m.student_id
+                        GROUP BY 1, 2
+                    ) x
+                    GROUP BY class_id
+                )
+                INSERT INTO class_metric_stats(
+                    class_id, student_count, ability_count,
+                    avg_listening, avg_speaking, avg_reading, avg_writing,
+                    weak_point_histogram, active_students_7d, error_hotspots, dirty, refreshed_at
+                )
+                SELECT t.class_id, COALESCE(a.student_count, 0), COALESCE(a.ability_count, 0),
+                       COALESCE(a.avg_listening, 0), COALESCE(a.avg_speaking, 0),
+                       COALESCE(a.avg_reading, 0), COALESCE(a.avg_writing, 0),
+                       COALESCE(w.histogram, '{}'::jsonb), COALESCE(ac.n, 0),
+                       COALESCE(e.hotspots, '[]'::jsonb), FALSE, NOW()
+                FROM target t
+                JOIN classes c ON c.id = t.class_id
+                LEFT JOIN ability a ON a.class_id = t.class_id
+                LEFT JOIN weak w ON w.class_id = t.class_id
+                LEFT JOIN active ac ON ac.class_id = t.class_id
+                LEFT JOIN errors e ON e.class_id = t.class_id
+                ORDER BY t.class_id
+                ON CONFLICT (class_id) DO UPDATE SET
+                    student_count = EXCLUDED.student_count,
+                    ability_count = EXCLUDED.ability_count,
+                    avg_listening = EXCLUDED.avg_listening,
+                    avg_speaking = EXCLUDED.avg_speaking,
+                    avg_reading = EXCLUDED.avg_reading,
+                    avg_writing = EXCLUDED.avg_writing,
+                    weak_point_histogram = EXCLUDED.weak_point_histogram,
+                    active_students_7d = EXCLUDED.active_students_7d,
+                    error_hotspots = EXCLUDED.error_hotspots,
+                    dirty = FALSE,
+                    refreshed_at = NOW()
+                """
+            ),
+            {"ids": ids, "active_days": int(active_days)},
+        )
+
+
 class KnowledgeBaseCRUD:
     @staticmethod
     def _ensure_temp_columns(db: Session) -> None:
@@ -1338,23 +1896,89 @@ class KnowledgeBaseCRUD:
         doc_id: int,
         chunks: list[dict[str, Any]],
     ) -> None:
+        """整体替换文档的 chunks(同一事务内先删后写)。"""
+        KnowledgeBaseCRUD.delete_chunks(db, doc_id)
+        KnowledgeBaseCRUD.append_chunks(db, doc_id, chunks)
+        db.commit()
+
+    @staticmethod
+    def delete_chunks(db: Session, doc_id: int) -> None:
+        """删除文档的全部 chunks,不提交(由调用方与后续写入放在同一事务)。"""
         db.execute(text("DELETE FROM kb_chunks WHERE document_id=:doc_id"), {"doc_id": doc_id})
-        for c in chunks:
-            db.execute(
-                text(
-                    "INSERT INTO kb_chunks(document_id, chunk_index, content, token_count, metadata, embedding) "
-                    "VALUES (:document_id, :chunk_index, :content, :token_count, CAST(:metadata AS JSONB), CAST(:embedding AS vector))"
-                ),
+
+    @staticmethod
+    def append_chunks(db: Session, doc_id: int, chunks: list[dict[str, Any]]) -> None:
+        """追加写入一批 chunks,不提交。
+
+        psycopg 驱动下用二进制 COPY 一次写入,向量按 pgvector 二进制格式传输,
+        不再逐行 INSERT、也不把浮点数格式化成文本;其它驱动或关闭 KB_BULK_INSERT
+        时退化为单条语句的 executemany。
+        """
+        if not chunks:
+            return
+        if KB_BULK_INSERT and db.get_bind().dialect.driver == "psycopg":
+            _copy_kb_chunks(db, doc_id, chunks)
+            return
+        db.execute(
+            text(
+                "INSERT INTO kb_chunks(document_id, chunk_index, content, token_count, metadata, "
+                "content_hash, embedding_model, embedding) "
+                "VALUES (:document_id, :chunk_index, :content, :token_count, CAST(:metadata AS JSONB), "
+                ":content_hash, :embedding_model, CAST(:embedding AS vector))"
+            ),
+            [
                 {
                     "document_id": doc_id,
                     "chunk_index": c["chunk_index"],
                     "content": c["content"],
                     "token_count": c.get("token_count", 0),
                     "metadata": c.get("metadata_json", "{}"),
-                    "embedding": c["embedding_vector"],
-                },
-            )
-        db.commit()
+                    "content_hash": c.get("content_hash"),
+                    "embedding_model": c.get("embedding_model"),
+                    "embedding": c.get("embedding_vector") or _vector_literal(c["embedding"]),
+                }
+                for c in chunks
+            ],
+        )
+
+    @staticmethod
+    def get_embeddings_by_hash(
+        db: Session,
+        content_hashes: list[str],
+        model: str,
+        batch_size: int = 1000,
+    ) -> dict[str, list[float]]:
+        """按内容哈希查已入库的向量(跨文档,限同一 embedding 模型),返回 {content_hash: embedding}。
+
+        只取向量、不返回正文,所以不受文档可见性限制:同一本教材被多位老师各自上传时可直接复用。
+        """
+        found: dict[str, list[float]] = {}
+        unique = list(dict.fromkeys(h for h in content_hashes if h))
+        for i in range(0, len(unique), batch_size):
+            rows = db.execute(
+                text(
+                    "SELECT DISTINCT ON (content_hash) content_hash, embedding::text AS embedding "
+                    "FROM kb_chunks "
+                    "WHERE content_hash = ANY(:hashes) AND embedding_model = :model AND embedding IS NOT NULL "
+                    "ORDER BY content_hash, id DESC"
+                ),
+                {"hashes": unique[i : i + batch_size], "model": model},
+            ).mappings().all()
+            for r in rows:
+                found[r["content_hash"]] = [float(x) for x in r["embedding"].strip("[]").split(",")]
+        return found
+
+    # 量化粗排的 ORDER BY 表达式,需与迁移 20261018_0005 建的表达式索引逐字一致
+    QUANTIZED_ANN_ORDER = {
+        "binary": (
+            f"binary_quantize(c.embedding)::bit({KB_EMBEDDING_DIM}) "
+            "<~> binary_quantize(CAST(:query_embedding AS vector))"
+        ),
+        "halfvec": (
+            f"c.embedding::halfvec({KB_EMBEDDING_DIM}) "
+            f"<=> CAST(:query_embedding AS halfvec({KB_EMBEDDING_DIM}))"
+        ),
+    }
 
     @staticmethod
     def search_chunks_by_embedding(
@@ -1364,13 +1988,98 @@ class KnowledgeBaseCRUD:
         score_threshold: float = 0.25,
         viewer_user_id: int | None = None,
         viewer_session_key: str | None = None,
+        candidate_k: int | None = None,
+        ef_search: int | None = None,
+        include_public: bool = True,
+        quantization: str | None = None,
+        rescore_k: int | None = None,
     ) -> list[dict[str, Any]]:
+        """向量召回。
+
+        先用 HNSW 索引按余弦距离取 candidate_k 个近邻(纯 ORDER BY distance LIMIT,
+        可走索引),再在这个候选集上做文档可见性过滤和相似度阈值过滤。
+        公共库近邻只在 public_searchable 的 chunk(公共、ready、激活,触发器维护)上取,走部分索引,
+        其他用户的私有文档、失败/停用/处理中的文档不会占掉候选名额。
+        调用者本人的私有文档数量少,单独精确扫描后并入候选集,避免被公共库挤出近邻。
+
+        ef_search: 若给出,在当前事务内设置 hnsw.ef_search(需 >= candidate_k 才能取满候选)。
+        include_public=False: 只检索调用者本人的私有/本会话文档(公共库由进程内索引负责)。
+        quantization: "binary" / "halfvec" 时两阶段检索:先在量化表达式索引上粗排取 rescore_k 个,
+            再用表里的全精度向量精确重算距离取 candidate_k 个。
+        """
         KnowledgeBaseCRUD._ensure_temp_columns(db)
+        if not include_public:
+            if viewer_user_id is None:
+                return []
+            rows = db.execute(
+                text(
+                    "SELECT c.id, c.document_id, c.chunk_index, c.content, c.metadata, d.title, d.source_name, "
+                    "d.owner_user_id, 1 - (c.embedding <=> CAST(:query_embedding AS vector)) AS score "
+                    "FROM kb_chunks c "
+                    "JOIN kb_documents d ON d.id = c.document_id "
+                    "WHERE d.scope='private' AND d.owner_user_id=:viewer_user_id "
+                    "AND d.status='ready' AND d.is_active=TRUE "
+                    "AND (COALESCE(d.is_temporary, FALSE)=FALSE OR d.session_key=:viewer_session_key) "
+                    "AND c.embedding IS NOT NULL "
+                    "AND 1 - (c.embedding <=> CAST(:query_embedding AS vector)) >= :score_threshold "
+                    "ORDER BY c.embedding <=> CAST(:query_embedding AS vector) "
+                    "LIMIT :top_k"
+                ),
+                {
+                    "query_embedding": query_embedding_vector,
+                    "top_k": top_k,
+                    "score_threshold": score_threshold,
+                    "viewer_user_id": viewer_user_id,
+                    "viewer_session_key": viewer_session_key,
+                },
+            ).mappings().all()
+            return [dict(r) for r in rows]
+        if candidate_k is None:
+            candidate_k = top_k * 4
+        candidate_k = max(candidate_k, top_k)
+        if quantization:
+            if quantization not in KnowledgeBaseCRUD.QUANTIZED_ANN_ORDER:
+                raise ValueError(f"不支持的向量量化方式: {quantization}")
+            rescore_k = max(rescore_k or candidate_k * 4, candidate_k)
+            public_ann = (
+                "  (SELECT r.id, r.embedding <=> CAST(:query_embedding AS vector) AS distance "
+                "   FROM (SELECT c.id, c.embedding FROM kb_chunks c WHERE c.public_searchable "
+                f"         ORDER BY {KnowledgeBaseCRUD.QUANTIZED_ANN_ORDER[quantization]} "
+                "         LIMIT :rescore_k) r "
+                "   ORDER BY r.embedding <=> CAST(:query_embedding AS vector) "
+                "   LIMIT :candidate_k) "
+            )
+        else:
+            rescore_k = candidate_k
+            public_ann = (
+                # 查询向量直接作为绑定参数出现在 ORDER BY 中,规划器才能走 HNSW 索引扫描
+                "  (SELECT c.id, c.embedding <=> CAST(:query_embedding AS vector) AS distance "
+                "   FROM kb_chunks c WHERE c.public_searchable "
+                "   ORDER BY c.embedding <=> CAST(:query_embedding AS vector) "
+                "   LIMIT :candidate_k) "
+            )
+        if ef_search:
+            db.execute(
+                text("SELECT set_config('hnsw.ef_search', :ef_search, true)"),
+                {"ef_search": str(max(int(ef_search), rescore_k))},
+            )
         rows = db.execute(
             text(
+                "WITH ann AS ("
+                + public_ann +
+                "  UNION "
+                "  (SELECT c.id, c.embedding <=> CAST(:query_embedding AS vector) AS distance "
+                "   FROM kb_chunks c "
+                "   JOIN kb_documents d ON d.id = c.document_id "
+                "   WHERE d.scope='private' AND d.owner_user_id=:viewer_user_id "
+                "   AND c.embedding IS NOT NULL "
+                "   ORDER BY c.embedding <=> CAST(:query_embedding AS vector) "
+                "   LIMIT :candidate_k)"
+                ") "
                 "SELECT c.id, c.document_id, c.chunk_index, c.content, c.metadata, d.title, d.source_name, d.owner_user_id, "
-                "(1 - (c.embedding <=> CAST(:query_embedding AS vector))) AS score "
-                "FROM kb_chunks c "
+                "(1 - ann.distance) AS score "
+                "FROM ann "
+                "JOIN kb_chunks c ON c.id = ann.id "
                 "JOIN kb_documents d ON d.id = c.document_id "
                 "WHERE d.status='ready' AND d.is_active=TRUE " # 文档状态是ready且激活
                 "AND ("
@@ -1378,13 +2087,15 @@ class KnowledgeBaseCRUD:
                 "OR (d.scope='private' AND d.owner_user_id=:viewer_user_id " # 要么是私有文档
                 "    AND (COALESCE(d.is_temporary, FALSE)=FALSE OR d.session_key=:viewer_session_key))" # 且必须是调用者本人的
                 ") "
-                "AND (1 - (c.embedding <=> CAST(:query_embedding AS vector))) >= :score_threshold "
-                "ORDER BY c.embedding <=> CAST(:query_embedding AS vector) "
+                "AND (1 - ann.distance) >= :score_threshold "
+                "ORDER BY ann.distance "
                 "LIMIT :top_k"
             ),
             {
                 "query_embedding": query_embedding_vector,
                 "top_k": top_k,
+                "candidate_k": candidate_k,
+                "rescore_k": rescore_k,
                 "score_threshold": score_threshold,
                 "viewer_user_id": viewer_user_id,
                 "viewer_session_key": viewer_session_key,
@@ -1392,6 +2103,61 @@ class KnowledgeBaseCRUD:
         ).mappings().all()
         return [dict(r) for r in rows]
     
+    @staticmethod
+    def list_public_document_versions(db: Session) -> dict[int, str]:
+        """可被所有人检索的公共文档 → 版本串(updated_at + chunk_count),供进程内向量索引做增量同步。"""
+        KnowledgeBaseCRUD._ensure_temp_columns(db)
+        rows = db.execute(
+            text(
+                "SELECT id, updated_at, chunk_count FROM kb_documents "
+                "WHERE scope='public' AND status='ready' AND is_active=TRUE "
+                "AND COALESCE(is_temporary, FALSE)=FALSE"
+            )
+        ).mappings().all()
+        return {int(r["id"]): f"{r['updated_at'].isoformat() if r['updated_at'] else ''}|{r['chunk_count']}" for r in rows}
+
+    @staticmethod
+    def iter_chunk_embeddings(db: Session, doc_ids: list[int], batch_size: int = 2000):
+        """流式读取指定文档的 chunk 向量,逐行产出 {"id", "document_id", "embedding": list[float]}。"""
+        if not doc_ids:
+            return
+        result = db.execute(
+            text(
+                "SELECT id, document_id, embedding::real[] AS embedding FROM kb_chunks "
+                "WHERE document_id = ANY(:doc_ids) AND embedding IS NOT NULL "
+                "ORDER BY id"
+            ),
+            {"doc_ids": [int(d) for d in doc_ids]},
+            execution_options={"stream_results": True, "max_row_buffer": batch_size},
+        ).mappings()
+        for rows in result.partitions(batch_size):
+            for r in rows:
+                yield dict(r)
+
+    @staticmethod
+    def get_public_chunks_by_ids(db: Session, chunk_ids: list[int]) -> list[dict[str, Any]]:
+        """按主键取公共文档的 chunk(附文档信息);再次校验可见性,过期索引命中的已删/下线文档会被滤掉。"""
+        if not chunk_ids:
+            return []
+        KnowledgeBaseCRUD._ensure_temp_columns(db)
+        rows = db.execute(
+            text(
+                "SELECT c.id, c.document_id, c.chunk_index, c.content, c.metadata, d.title, d.source_name, d.owner_user_id "
+                "FROM kb_chunks c "
+                "JOIN kb_documents d ON d.id = c.document_id "
+                "WHERE c.id = ANY(:ids) AND d.scope='public' AND d.status='ready' AND d.is_active=TRUE "
+                "AND COALESCE(d.is_temporary, FALSE)=FALSE"
+            ),
+            {"ids": [int(i) for i in chunk_ids]},
+        ).mappings().all()
+        return [dict(r) for r in rows]
+
+    # 关键词检索可选的全文检索配置 → kb_chunks 上对应的 stored tsvector 列(GIN 索引)
+    KEYWORD_TS_COLUMNS = {
+        "simple": "content_tsv",
+        "german": "content_tsv_german",
+    }
+
     @staticmethod
     def search_chunks_by_keyword(
         db: Session,
@@ -1400,6 +2166,7 @@ class KnowledgeBaseCRUD:
         score_threshold: float = 0.01,
         viewer_user_id: int | None = None,
         viewer_session_key: str | None = None,
+        ts_config: str = "simple",
     ) -> list[dict[str, Any]]:
         """基于 PostgreSQL 全文检索的关键词召回(BM25 风格)。
         
@@ -1409,34 +2176,36 @@ class KnowledgeBaseCRUD:
         
         使用 ts_rank_cd 排序,score 越高越相关。返回字段格式与
         search_chunks_by_embedding 对齐,便于上层融合。
+
+        ts_config: "simple"(原词匹配) 或 "german"(德语词干化)。匹配走写入时生成的
+        content_tsv / content_tsv_german 列及其 GIN 索引,tsquery 只解析一次。
         """
+        if ts_config not in KnowledgeBaseCRUD.KEYWORD_TS_COLUMNS:
+            raise ValueError(f"不支持的全文检索配置: {ts_config}")
+        tsv_col = KnowledgeBaseCRUD.KEYWORD_TS_COLUMNS[ts_config]
         KnowledgeBaseCRUD._ensure_temp_columns(db)
         rows = db.execute(
             text(
+                "WITH q AS (SELECT websearch_to_tsquery(CAST(:ts_config AS regconfig), :query) AS tsq) "
                 "SELECT c.id, c.document_id, c.chunk_index, c.content, c.metadata, "
                 "d.title, d.source_name, d.owner_user_id, "
-                "ts_rank_cd("
-                "  to_tsvector('simple', c.content), "
-                "  websearch_to_tsquery('simple', :query)"
-                ") AS score "
-                "FROM kb_chunks c "
+                f"ts_rank_cd(c.{tsv_col}, q.tsq) AS score "
+                "FROM q, kb_chunks c "
                 "JOIN kb_documents d ON d.id = c.document_id "
-                "WHERE d.status='ready' AND d.is_active=TRUE "
+                f"WHERE c.{tsv_col} @@ q.tsq "
+                "AND d.status='ready' AND d.is_active=TRUE "
                 "AND ("
                 "d.scope='public' "
                 "OR (d.scope='private' AND d.owner_user_id=:viewer_user_id "
                 "    AND (COALESCE(d.is_temporary, FALSE)=FALSE OR d.session_key=:viewer_session_key))"
                 ") "
-                "AND to_tsvector('simple', c.content) @@ websearch_to_tsquery('simple', :query) "
-                "AND ts_rank_cd("
-                "  to_tsvector('simple', c.content), "
-                "  websearch_to_tsquery('simple', :query)"
-                ") >= :score_threshold "
+                f"AND ts_rank_cd(c.{tsv_col}, q.tsq) >= :score_threshold "
                 "ORDER BY score DESC "
                 "LIMIT :top_k"
             ),
             {
                 "query": query,
+                "ts_config": ts_config,
                 "top_k": top_k,
                 "score_threshold": score_threshold,
                 "viewer_user_id": viewer_user_id,
@@ -1453,3 +2222,183 @@ class KnowledgeBaseCRUD:
         db.execute(text("DELETE FROM kb_documents WHERE id=:id"), {"id": doc_id})
         db.commit()
         return True
+
+
+class KbIngestJobCRUD:
+    """kb_ingest_jobs 表:知识库文档入库任务队列(多进程/多线程用 SKIP LOCKED 抢占)。"""
+
+    _COLUMNS = (
+        "id, document_id, status, progress, stage, attempts, max_attempts, error_message, "
+        "worker_id, run_after, heartbeat_at, started_at, finished_at, created_at, updated_at, rerun_requested"
+    )
+    # 结束一个任务:运行期间有人再次提交(rerun_requested)时重新排队,否则进入终态;
+    # final_progress / final_stage 为 NULL 时保留原值
+    _FINISH_SET = (
+        "status = CASE WHEN rerun_requested THEN 'queued' ELSE CAST(:final_status AS VARCHAR) END, "
+        "progress = CASE WHEN rerun_requested THEN 0 "
+        "ELSE COALESCE(CAST(:final_progress AS INTEGER), progress) END, "
+        "stage = CASE WHEN rerun_requested THEN 'queued' "
+        "ELSE COALESCE(CAST(:final_stage AS VARCHAR), stage) END, "
+        "attempts = CASE WHEN rerun_requested THEN 0 ELSE attempts END, "
+        "worker_id = CASE WHEN rerun_requested THEN NULL ELSE worker_id END, "
+        "run_after = CASE WHEN rerun_requested THEN NOW() ELSE run_after END, "
+        "finished_at = CASE WHEN rerun_requested THEN NULL ELSE NOW() END, "
+        "rerun_requested = FALSE, updated_at = NOW()"
+    )
+
+    @staticmethod
+    def enqueue(db: Session, doc_id: int, max_attempts: int = 3) -> dict[str, Any]:
+        """为文档排一个入库任务。
+
+        每个文档最多一个 queued/running 任务(部分唯一索引):已在排队时直接复用;
+        正在运行时标记 rerun_requested,当前任务结束后重新排队,不会并发入库同一文档。
+        """
+        row = db.execute(
+            text(
+                "INSERT INTO kb_ingest_jobs(document_id, max_attempts) VALUES (:doc_id, :max_attempts) "
+                "ON CONFLICT (document_id) WHERE status IN ('queued', 'running') DO UPDATE SET "
+                "rerun_requested = kb_ingest_jobs.rerun_requested OR kb_ingest_jobs.status = 'running', "
+                "updated_at = NOW() "
+                f"RETURNING {KbIngestJobCRUD._COLUMNS}"
+            ),
+            {"doc_id": doc_id, "max_attempts": max_attempts},
+        ).mappings().first()
+        db.commit()
+        return dict(row) if row else {}
+
+    @staticmethod
+    def claim_next(db: Session, worker_id: str) -> dict[str, Any] | None:
+        """原子地领取一个到期的排队任务,置为 running 并累加 attempts。"""
+        row = db.execute(
+            text(
+                "UPDATE kb_ingest_jobs SET status='running', attempts=attempts+1, worker_id=:worker_id, "
+                "stage='queued', progress=0, error_message=NULL, "
+                "started_at=NOW(), heartbeat_at=NOW(), updated_at=NOW() "
+                "WHERE id = ("
+                "  SELECT id FROM kb_ingest_jobs "
+                "  WHERE status='queued' AND run_after <= NOW() "
+                "  AND NOT EXISTS (SELECT 1 FROM kb_ingest_jobs r "
+                "                  WHERE r.document_id = kb_ingest_jobs.document_id AND r.status='running') "
+                "  ORDER BY run_after, id "
+                "  FOR UPDATE SKIP LOCKED LIMIT 1"
+                f") RETURNING {KbIngestJobCRUD._COLUMNS}"
+            ),
+            {"worker_id": worker_id},
+        ).mappings().first()
+        db.commit()
+        return dict(row) if row else None
+
+    @staticmethod
+    def update_progress(db: Session, job_id: int, progress: int, stage: str) -> None:
+        db.execute(
+            text(
+                "UPDATE kb_ingest_jobs SET progress=:progress, stage=:stage, heartbeat_at=NOW(), updated_at=NOW() "
+                "WHERE id=:id"
+            ),
+            {"id": job_id, "progress": max(0, min(100, int(progress))), "stage": stage},
+        )
+        db.commit()
+
+    @staticmethod
+    def mark_succeeded(db: Session, job_id: int) -> None:
+        db.execute(
+            text(f"UPDATE kb_ingest_jobs SET {KbIngestJobCRUD._FINISH_SET} WHERE id=:id"),
+            {"id": job_id, "final_status": "succeeded", "final_progress": 100, "final_stage": "done"},
+        )
+        db.commit()
+
+    @staticmethod
+    def release(db: Session, job_id: int, delay_seconds: float) -> None:
+        """未能开始执行(文档正被另一个任务入库)的任务放回队列,不计入重试次数。"""
+        db.execute(
+            text(
+                "UPDATE kb_ingest_jobs SET status='queued', worker_id=NULL, attempts=GREATEST(attempts-1, 0), "
+                "run_after=NOW() + make_interval(secs => :delay), updated_at=NOW() WHERE id=:id"
+            ),
+            {"id": job_id, "delay": float(delay_seconds)},
+        )
+        db.commit()
+
+    @staticmethod
+    def mark_failed(db: Session, job_id: int, error_message: str, retry_delay_seconds: float | None = None) -> None:
+        """失败:给出 retry_delay_seconds 时重新排队(延迟执行),否则终态 failed。"""
+        if retry_delay_seconds is not None:
+            db.execute(
+                text(
+                    "UPDATE kb_ingest_jobs SET status='queued', error_message=:error_message, worker_id=NULL, "
+                    "rerun_requested=FALSE, run_after=NOW() + make_interval(secs => :delay), updated_at=NOW() "
+                    "WHERE id=:id"
+                ),
+                {"id": job_id, "error_message": error_message[:500], "delay": float(retry_delay_seconds)},
+            )
+        else:
+            db.execute(
+                text(
+                    f"UPDATE kb_ingest_jobs SET {KbIngestJobCRUD._FINISH_SET}, error_message=:error_message "
+                    "WHERE id=:id"
+                ),
+                {
+                    "id": job_id,
+                    "error_message": error_message[:500],
+                    "final_status": "failed",
+                    "final_progress": None,
+                    "final_stage": None,
+                },
+            )
+        db.commit()
+
+    @staticmethod
+    def requeue_stale(db: Session, stale_seconds: float) -> int:
+        """把心跳超时的 running 任务放回队列(进程崩溃/重启后恢复)。"""
+        result = db.execute(
+            text(
+                "UPDATE kb_ingest_jobs SET status='queued', worker_id=NULL, run_after=NOW(), updated_at=NOW() "
+                "WHERE status='running' AND COALESCE(heartbeat_at, started_at, created_at) "
+                "< NOW() - make_interval(secs => :stale_seconds)"
+            ),
+            {"stale_seconds": float(stale_seconds)},
+        )
+        db.commit()
+        return int(result.rowcount or 0)
+
+    @staticmethod
+    def get_latest_for_document(db: Session, doc_id: int) -> dict[str, Any] | None:
+        row = db.execute(
+            text(
+                f"SELECT {KbIngestJobCRUD._COLUMNS} FROM kb_ingest_jobs "
+                "WHERE document_id=:doc_id ORDER BY id DESC LIMIT 1"
+            ),
+            {"doc_id": doc_id},
+        ).mappings().first()
+        return dict(row) if row else None
+
+
+class EmbeddingCacheCRUD:
+    """embedding_cache 表:按 (model, 文本 sha256) 持久化向量,供 services.embedding 做二级缓存。"""
+
+    @staticmethod
+    def get(db: Session, model: str, text_hash: str, max_age_days: int = 30) -> tuple[list[float], str] | None:
+        row = db.execute(
+            text(
+                "SELECT embedding::text AS embedding FROM embedding_cache "
+                "WHERE model=:model AND text_hash=:text_hash "
+                "AND created_at >= NOW() - make_interval(days => :max_age_days)"
+            ),
+            {"model": model, "text_hash": text_hash, "max_age_days": max_age_days},
+        ).mappings().first()
+        if not row or not row["embedding"]:
+            return None
+        literal = row["embedding"]
+        return [float(x) for x in literal.strip("[]").split(",")], literal
+
+    @staticmethod
+    def put(db: Session, model: str, text_hash: str, embedding_vector: str) -> None:
+        db.execute(
+            text(
+                "INSERT INTO embedding_cache(model, text_hash, embedding) "
+                "VALUES (:model, :text_hash, CAST(:embedding AS vector)) "
+                "ON CONFLICT (model, text_hash) DO UPDATE SET embedding=EXCLUDED.embedding, created_at=NOW()"
+            ),
+            {"model": model, "text_hash": text_hash, "embedding": embedding_vector},
+        )
+        db.commit()
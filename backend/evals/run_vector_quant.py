@@ -0,0 +1,227 @@
+"""量化向量检索的召回率评测:recall@k(对比精确暴力检索)+ 延迟 + 索引体积。
+
+对评测集中的全部 query(学生/教师 v2 + v3,去重)分别做:
+- exact:   全表精确余弦排序(不走索引),作为标准答案
+- float:   当前全精度 HNSW(RAG_VECTOR_QUANTIZATION 为空时的线上路径)
+- halfvec: halfvec 表达式索引粗排 + 全精度精排
+- binary:  binary_quantize 表达式索引粗排 + 全精度精排
+只检索公共知识库(与 viewer 无关),需要可连接的数据库和 embedding API。
+
+公共库近邻只在 public_searchable 的部分索引上取;库里私有/停用/失败文档的 chunk 越多,
+旧的"全表近邻再过滤"召回掉得越多。评测同时报告这些不可见 chunk 的数量、
+public_searchable 与文档状态不一致的 chunk 数(应为 0),--min-recall 给出时任一模式
+R@10 低于阈值即以非零状态退出。
+
+用法:
+    cd backend
+    python -m evals.run_vector_quant
+    python -m evals.run_vector_quant --modes float binary --rescore-factor 8
+    python -m evals.run_vector_quant --min-recall 0.9
+
+输出: evals/results/vector_quant_<timestamp>.json
+"""
+import sys
+import io
+import argparse
+import json
+import logging
+import statistics
+import time
+from datetime import datetime
+from pathlib import Path
+
+sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding="utf-8")
+logging.basicConfig(level=logging.WARNING)
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from sqlalchemy import text
+
+from crud.repositories import KnowledgeBaseCRUD
+from db.session import SessionLocal
+from evals.student_eval_set import STUDENT_EVAL_CASES, TEACHER_EVAL_CASES
+from evals.student_eval_set_v3 import STUDENT_EVAL_CASES_V3, TEACHER_EVAL_CASES_V3
+from services.embedding import embed_text
+from services.rag import (
+    RAG_HNSW_EF_SEARCH,
+    RAG_QUANT_RESCORE_FACTOR,
+    RAG_RECALL_TOP_K,
+    RAG_VECTOR_CANDIDATE_FACTOR,
+)
+
+
+K_VALUES = (5, 10, 20)
+INDEX_NAMES = {
+    "float": "idx_kb_chunks_embedding_public_hnsw",
+    "halfvec": "idx_kb_chunks_embedding_public_half_hnsw",
+    "binary": "idx_kb_chunks_embedding_public_bit_hnsw",
+}
+
+
+def collect_queries() -> list[str]:
+    seen: dict[str, None] = {}
+    for cases in (STUDENT_EVAL_CASES, TEACHER_EVAL_CASES, STUDENT_EVAL_CASES_V3, TEACHER_EVAL_CASES_V3):
+        for case in cases:
+            q = (case.get("query") or "").strip()
+            if q:
+                seen.setdefault(q, None)
+    return list(seen)
+
+
+def exact_top_ids(db, query_vec: str, k: int) -> list[int]:
+    """精确检索:距离表达式 + 0 阻止规划器使用向量索引,等价于全表扫描排序。"""
+    rows = db.execute(
+        text(
+            "SELECT c.id FROM kb_chunks c "
+            "JOIN kb_documents d ON d.id = c.document_id "
+            "WHERE d.scope='public' AND d.status='ready' AND d.is_active=TRUE "
+            "AND c.embedding IS NOT NULL "
+            "ORDER BY (c.embedding <=> CAST(:q AS vector)) + 0 "
+            "LIMIT :k"
+        ),
+        {"q": query_vec, "k": k},
+    ).all()
+    return [int(r[0]) for r in rows]
+
+
+def ann_top_ids(db, query_vec: str, k: int, mode: str, rescore_factor: int) -> list[int]:
+    candidate_k = max(k, RAG_RECALL_TOP_K) * RAG_VECTOR_CANDIDATE_FACTOR
+    rows = KnowledgeBaseCRUD.search_chunks_by_embedding(
+        db,
+        query_vec,
+        top_k=k,
+        score_threshold=-1.0,
+        viewer_user_id=None,
+        candidate_k=candidate_k,
+        ef_search=RAG_HNSW_EF_SEARCH or None,
+        quantization=None if mode == "float" else mode,
+        rescore_k=candidate_k * rescore_factor,
+    )
+    db.commit()  # 结束事务,set_config(..., true) 不带到下一次查询
+    return [int(r["id"]) for r in rows]
+
+
+def visibility_counts(db) -> dict[str, int]:
+    """有向量但不可公共检索的 chunk 数,以及 public_searchable 与文档状态不一致的 chunk 数。"""
+    row = db.execute(
+        text(
+            "SELECT COUNT(*) FILTER (WHERE NOT visible) AS hidden, "
+            "COUNT(*) FILTER (WHERE visible IS DISTINCT FROM c.public_searchable) AS drift "
+            "FROM (SELECT c.public_searchable, "
+            "      (d.scope='public' AND d.status='ready' AND d.is_active=TRUE) AS visible "
+            "      FROM kb_chunks c JOIN kb_documents d ON d.id = c.document_id "
+            "      WHERE c.embedding IS NOT NULL) c"
+        )
+    ).mappings().first()
+    return {"hidden_chunks": int(row["hidden"] or 0), "flag_drift": int(row["drift"] or 0)}
+
+
+def index_sizes(db) -> dict[str, int | None]:
+    sizes = {}
+    for mode, name in INDEX_NAMES.items():
+        reg = db.execute(text("SELECT to_regclass(:n)"), {"n": f"public.{name}"}).scalar()
+        sizes[mode] = (
+            int(db.execute(text("SELECT pg_relation_size(CAST(:n AS regclass))"), {"n": name}).scalar())
+            if reg else None
+        )
+    return sizes
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="recall@k of quantized vector search vs exact search")
+    parser.add_argument("--modes", nargs="+", default=["float", "halfvec", "binary"])
+    parser.add_argument("--rescore-factor", type=int, default=RAG_QUANT_RESCORE_FACTOR)
+    parser.add_argument("--min-recall", type=float, default=None, help="R@10 下限,低于则退出码为 1")
+    args = parser.parse_args()
+
+    queries = collect_queries()
+    max_k = max(K_VALUES)
+    db = SessionLocal()
+    try:
+        sizes = index_sizes(db)
+        visibility = visibility_counts(db)
+        print(f"queries: {len(queries)}, modes: {args.modes}, rescore_factor: {args.rescore_factor}")
+        print(
+            f"  non-public chunks: {visibility['hidden_chunks']}, "
+            f"public_searchable drift: {visibility['flag_drift']}"
+        )
+        for mode in args.modes:
+            size = sizes.get(mode)
+            print(f"  index[{mode}]: {f'{size / 1024 / 1024:.1f} MB' if size else 'missing (seq scan)'}")
+
+        per_mode = {m: {"recall": {k: [] for k in K_VALUES}, "latency_ms": []} for m in args.modes}
+        for i, q in enumerate(queries, 1):
+            _, q_vec = embed_text(q)
+            truth = exact_top_ids(db, q_vec, max_k)
+            if not truth:
+                continue
+            for mode in args.modes:
+                t0 = time.perf_counter()
+                got = ann_top_ids(db, q_vec, max_k, mode, args.rescore_factor)
+                per_mode[mode]["latency_ms"].append((time.perf_counter() - t0) * 1000)
+                for k in K_VALUES:
+                    expected = set(truth[:k])
+                    per_mode[mode]["recall"][k].append(len(expected & set(got[:k])) / len(expected))
+            print(f"[{i}/{len(queries)}] {q[:40]}")
+    finally:
+        db.close()
+
+    summary = {}
+    print("\n" + "=" * 72)
+    print(f"{'mode':<8} " + " ".join(f"{'R@' + str(k):>7}" for k in K_VALUES) + f" {'p50 ms':>8} {'p95 ms':>8}")
+    for mode, data in per_mode.items():
+        recall = {k: round(statistics.mean(v), 4) if v else None for k, v in data["recall"].items()}
+        lat = data["latency_ms"]
+        summary[mode] = {
+            "recall_at_k": {str(k): v for k, v in recall.items()},
+            "latency_p50_ms": round(percentile(lat, 50), 2),
+            "latency_p95_ms": round(percentile(lat, 95), 2),
+            "index_bytes": sizes.get(mode),
+        }
+        print(
+            f"{mode:<8} "
+            + " ".join(f"{(recall[k] if recall[k] is not None else float('nan')):>7.3f}" for k in K_VALUES)
+            + f" {summary[mode]['latency_p50_ms']:>8.1f} {summary[mode]['latency_p95_ms']:>8.1f}"
+        )
+
+    out_dir = Path(__file__).parent / "results"
+    out_dir.mkdir(exist_ok=True)
+    out = out_dir / f"vector_quant_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    out.write_text(
+        json.dumps(
+            {
+                "queries": len(queries),
+                "rescore_factor": args.rescore_factor,
+                "k_values": list(K_VALUES),
+                "visibility": visibility,
+                "modes": summary,
+            },
+            ensure_ascii=False,
+            indent=2,
+        ),
+        encoding="utf-8",
+    )
+    print(f"\n结果已保存: {out}")
+
+    failed = visibility["flag_drift"] > 0
+    if args.min_recall is not None:
+        for mode, data in summary.items():
+            r10 = data["recall_at_k"].get("10")
+            if r10 is None or r10 < args.min_recall:
+                print(f"[FAIL] {mode}: R@10={r10} < {args.min_recall}")
+                failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -313,6 +313,44 @@ def startup_event():
     except Exception as e:
         print(f"[Server] ensure admin failed: {e}")
 
+    # 知识库入库任务工作线程（KB_INGEST_WORKERS=0 时不在 API 进程内消费，改用 scripts/run_kb_worker.py）
+    try:
+        from services.kb_jobs import start_ingest_workers
+        start_ingest_workers()
+    except Exception as e:
+        print(f"[Server] start kb ingest workers failed: {e}")
+
+    # 公共知识库进程内向量索引(RAG_MEMORY_INDEX_ENABLED=true 时):加载快照并在后台与数据库对齐
+    try:
+        from services.vector_index import warm_public_index
+        warm_public_index()
+    except Exception as e:
+        print(f"[Server] warm memory vector index failed: {e}")
+
+    # 学生指标后台巡检(METRICS_SWEEP_INTERVAL=0 关闭):积极度窗口按天滑动,并为缺统计行的学生回填
+    try:
+        from services.metrics import start_metrics_sweeper
+        start_metrics_sweeper()
+    except Exception as e:
+        print(f"[Server] start metrics sweeper failed: {e}")
+
+
+@app.on_event("shutdown")
+def shutdown_event():
+    from services.kb_jobs import stop_ingest_workers
+    stop_ingest_workers()
+    from services.metrics import stop_metrics_sweeper
+    stop_metrics_sweeper()
+    # 处理完合并队列里待写的学习时长与指标
+    from services.metrics_refresher import stop_metrics_refresher
+    stop_metrics_refresher()
+
+
+@app.on_event("shutdown")
+async def close_llm_client():
+    from services.llm import aclose_async_client
+    await aclose_async_client()
+
 # ════════════════════ 2. 跨域中间件 ════════════════════
 
 app.add_middleware(
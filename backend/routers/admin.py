@@ -8,19 +8,18 @@ from sqlalchemy.orm import Session
 from pydantic import BaseModel
 
 from db.session import get_db
-from crud.repositories import UserCRUD, ClassroomCRUD, SystemSettingCRUD, StudentCRUD, KnowledgeBaseCRUD
+from crud.repositories import UserCRUD, ClassroomCRUD, SystemSettingCRUD, StudentCRUD, KnowledgeBaseCRUD, KbIngestJobCRUD
 from models.entities import Student
 from schemas.entities import ClassroomCreate
 from core.deps import require_admin
 from core.responses import ok, fail
 from core.password import ensure_transport_hash, hash_password
-from services.metrics import refresh_student_metrics
-from services.kb_ingest import (
-    KB_EMPTY_TEXT_HINT,
-    chunk_text,
-    enrich_chunks_with_embeddings,
-    extract_text,
-)
+from services.metrics import student_metrics_snapshot
+from services.tool_cache import invalidate_tool_cache, student_tag
+from services.kb_jobs import enqueue_ingest, job_status_payload
+from services.answer_cache import invalidate_answer_cache
+from services.rerank import invalidate_rerank_cache
+from services.vector_index import notify_documents_changed
 
 router = APIRouter(prefix="/api/admin", tags=["admin"])
 KB_STORAGE_DIR = Path(__file__).resolve().parent.parent / "storage" / "kb"
@@ -63,24 +62,6 @@ class AdminResetPasswordBody(BaseModel):
     new_password: str
 
 
-def _ingest_document_sync(db: Session, doc_id: int) -> None:
-    doc = KnowledgeBaseCRUD.get_document(db, doc_id)
-    if not doc:
-        raise HTTPException(status_code=404, detail="文档不存在")
-    try:
-        source_path = Path(doc["source_path"])
-        text = extract_text(source_path, doc.get("mime_type"))
-        chunks = chunk_text(text)
-        if not chunks:
-            KnowledgeBaseCRUD.set_document_status(db, doc_id, "failed", KB_EMPTY_TEXT_HINT)
-            return
-        enriched = enrich_chunks_with_embeddings(chunks)
-        KnowledgeBaseCRUD.replace_chunks(db, doc_id, enriched)
-        KnowledgeBaseCRUD.set_document_status(db, doc_id, "ready", None, chunk_count=len(enriched))
-    except Exception as e:
-        KnowledgeBaseCRUD.set_document_status(db, doc_id, "failed", str(e)[:500])
-
-
 @router.get("/teachers")
 def list_teachers(db: Session = Depends(get_db), _admin=Depends(require_admin)):
     """列出所有教师（供管理员分配班级时选择）。"""
@@ -200,7 +181,7 @@ def list_students(db: Session = Depends(get_db), _admin=Depends(require_admin)):
     students = list(db.scalars(select(Student).order_by(Student.id)))
     result = []
     for s in students:
-        latest_metrics = refresh_student_metrics(db, s.id)
+        latest_metrics = student_metrics_snapshot(s)
         user = UserCRUD.get_by_id(db, s.user_id)
         class_ids = StudentCRUD.list_class_ids(db, s.id)
         class_objs = [ClassroomCRUD.get_by_id(db, c_id) for c_id in class_ids]
@@ -271,8 +252,9 @@ def update_student(
             user.is_active = bool(updates["is_active"])
 
     db.commit()
+    invalidate_tool_cache(student_tag(student.id, "profile"))
     db.refresh(student)
-    latest_metrics = refresh_student_metrics(db, student.id)
+    latest_metrics = student_metrics_snapshot(student)
     final_class_ids = StudentCRUD.list_class_ids(db, student.id)
     class_objs = [ClassroomCRUD.get_by_id(db, c_id) for c_id in final_class_ids]
     class_objs = [c for c in class_objs if c]
@@ -488,8 +470,8 @@ async def kb_upload_doc(
         scope="public",
         owner_user_id=None,
     )
-    _ingest_document_sync(db, int(doc["id"]))
-    return {"id": doc["id"], "status": "processing"}
+    job = enqueue_ingest(db, int(doc["id"]))
+    return {"id": doc["id"], "status": "processing", "job_id": job.get("id")}
 
 
 @router.post("/kb/reindex/{doc_id}")
@@ -497,9 +479,21 @@ def kb_reindex_doc(doc_id: int, db: Session = Depends(get_db), _admin=Depends(re
     doc = KnowledgeBaseCRUD.get_document(db, doc_id)
     if not doc:
         raise HTTPException(status_code=404, detail="文档不存在")
-    KnowledgeBaseCRUD.set_document_status(db, doc_id, "processing", None)
-    _ingest_document_sync(db, doc_id)
-    return {"id": doc_id, "status": "processing"}
+    job = enqueue_ingest(db, doc_id)
+    return {"id": doc_id, "status": "processing", "job_id": job.get("id")}
+
+
+@router.get("/kb/docs/{doc_id}/job")
+def kb_doc_job_status(doc_id: int, db: Session = Depends(get_db), _admin=Depends(require_admin)):
+    """查询文档最近一次入库任务的状态与进度。"""
+    doc = KnowledgeBaseCRUD.get_document(db, doc_id)
+    if not doc:
+        raise HTTPException(status_code=404, detail="文档不存在")
+    return {
+        "id": doc_id,
+        "status": doc.get("status"),
+        "job": job_status_payload(KbIngestJobCRUD.get_latest_for_document(db, doc_id)),
+    }
 
 
 @router.delete("/kb/docs/{doc_id}")
@@ -514,6 +508,9 @@ def kb_delete_doc(doc_id: int, db: Session = Depends(get_db), _admin=Depends(req
     ok = KnowledgeBaseCRUD.delete_document(db, doc_id)
     if not ok:
         raise HTTPException(status_code=404, detail="文档不存在")
+    invalidate_rerank_cache([doc_id])
+    invalidate_answer_cache([doc_id])
+    notify_documents_changed([doc_id])
     if source_path.exists():
         try:
             source_path.unlink(missing_ok=True)
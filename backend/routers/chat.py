@@ -1,7 +1,9 @@
+import asyncio
 import traceback
 import logging
 from pathlib import Path
 from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query, Request
 from pydantic import BaseModel
 from sqlalchemy.orm import Session
@@ -33,9 +35,21 @@ from services.llm import (
     refresh_teacher_memory,
     MEMORY_REFRESH_EVERY,
 )
-from services.metrics import track_learning_activity, refresh_student_metrics
-from services.rag import build_rag_context
-from services.llm import generate_response_with_tools, generate_response_with_tools_streaming # 关键:Agent 函数
+from services.metrics_refresher import schedule_chat_metrics_refresh
+from services.rag import (
+    RAG_PREFETCH_ENABLED,
+    RAG_STREAM_RERANK_BUDGET_MS,
+    build_rag_context,
+    prefetch_rag_context,
+)
+from services.answer_cache import (
+    cache_scope,
+    is_cacheable_turn,
+    lookup_answer,
+    replay_deltas,
+    store_answer,
+)
+from services.llm import generate_response_with_tools, agenerate_response_with_tools_streaming # 关键:Agent 函数
 from services.prompts import load_prompt
 from services.observability import ExecutionTrace
 from services.sse import sse_format
@@ -273,15 +287,116 @@ def chat_endpoint(
             "trace_id": trace.trace_id,
         }
 
+def _finish_teacher_stream_turn(db, bg, user, session, history, full_reply_text, trace):
+    """流式对话收尾(同步 DB 操作,由异步 endpoint 放到线程池执行)。"""
+    TeacherChatMessageCRUD.create(
+        db,
+        TeacherChatMessageCreate(
+            session_id=session.id, role="assistant", content=full_reply_text or "(空回复)"
+        ),
+    )
+    TeacherChatSessionCRUD.touch(db, session.id)
+    
+    n = len(history) + 2
+    if n >= MEMORY_REFRESH_EVERY and n % MEMORY_REFRESH_EVERY == 0:
+        bg.add_task(refresh_teacher_memory, user.id, session.id)
+    
+    trace.finalize(reply_text=full_reply_text, success=True)
+    trace.persist(db)
+
+
+def _fail_stream_turn(db, trace, full_reply_text, e: Exception) -> None:
+    trace.finalize(
+        reply_text=full_reply_text or None,
+        success=False,
+        error_type=type(e).__name__,
+        error_message=str(e),
+    )
+    try:
+        trace.persist(db)
+    except Exception:
+        pass
+
+
+def _start_rag_prefetch(request, viewer_user_id, key_prefix, find_open_session, trace):
+    """流式对话:会话准备之前就在独立连接上开始检索,返回 Future(未启用时返回 None)。
+
+    会话键按 resolve_*_session 的同一规则只读推断:new_thread 的新会话不可能已有会话级临时文档;
+    指定 session_id 时直接用;否则取当前未关闭的会话。
+    """
+    if not RAG_PREFETCH_ENABLED:
+        return None
+
+    def resolve_session_key(db):
+        if request.new_thread:
+            return None
+        if request.session_id is not None:
+            return f"{key_prefix}:{request.session_id}"
+        open_s = find_open_session(db)
+        return f"{key_prefix}:{open_s.id}" if open_s else None
+
+    return prefetch_rag_context(
+        request.message,
+        viewer_user_id=viewer_user_id,
+        resolve_session_key=resolve_session_key,
+        trace=trace,
+    )
+
+
+async def _prepare_stream_turn(prepare, *args, trace):
+    """在线程池里准备会话,span 记录起止时刻,便于与 rag_prefetch 对照重叠。"""
+    with trace.span("session_prepare", prepare.__name__) as span:
+        start_ms = trace.elapsed_ms()
+        session, history = await run_in_threadpool(prepare, *args)
+        span.set_output({"start_ms": start_ms, "end_ms": trace.elapsed_ms(), "history_len": len(history)})
+    return session, history
+
+
+async def _collect_rag_context(prefetch, db, request, history, viewer_user_id, session_key, trace):
+    """取预取的检索结果;推断的会话键与实际会话不符(或预取失败)时按实际会话重新检索。"""
+    if prefetch is not None:
+        with trace.span("rag_wait", "speculative_prefetch") as span:
+            wait_start_ms = trace.elapsed_ms()
+            try:
+                predicted_key, result = await asyncio.wrap_future(prefetch)
+                # 推断为 None 只在本轮新建会话时成立(新会话没有会话级临时文档)
+                reusable = predicted_key == session_key or (
+                    predicted_key is None and (request.new_thread or len(history) <= 1)
+                )
+            except Exception as e:
+                logger.warning(f"[STREAM] RAG 预取失败: {type(e).__name__}: {e}")
+                predicted_key, result, reusable = None, None, False
+            span.set_output({
+                "reused": reusable,
+                "predicted_session_key": predicted_key,
+                "wait_start_ms": wait_start_ms,
+                "waited_ms": trace.elapsed_ms() - wait_start_ms,
+            })
+        if reusable:
+            return result
+    return await run_in_threadpool(
+        build_rag_context,
+        db, request.message,
+        viewer_user_id=viewer_user_id,
+        viewer_session_key=session_key,
+        trace=trace,
+        rerank_budget_ms=RAG_STREAM_RERANK_BUDGET_MS,
+    )
+
+
 @router.post("/api/teacher/chat/stream")
-def teacher_chat_stream_endpoint(
+async def teacher_chat_stream_endpoint(
     bg: BackgroundTasks,
     req: Request,
     request: TeacherChatReq,
     db: Session = Depends(get_db),
 ):
-    """教师端流式对话 endpoint(SSE)。"""
-    user = require_teacher(req, db)
+    """教师端流式对话 endpoint(SSE)。
+    
+    异步实现:LLM 流在事件循环上读取,DB/RAG 等同步调用放线程池,
+    打开的流不再各占一个线程池线程。RAG 检索与会话准备并发执行(见 _start_rag_prefetch)。
+    """
+    user = await run_in_threadpool(require_teacher, req, db)
     logger.info(f"[STREAM] 教师流式对话: user_id={user.id}, msg_len={len(request.message)}")
     
     trace = ExecutionTrace(
@@ -291,12 +406,19 @@ def teacher_chat_stream_endpoint(
         user_message=request.message,
     )
     
-    def event_generator():
+    async def event_generator():
         full_reply_text = ""
         tool_calls_used: list = []
         
         try:
-            session, history = _prepare_teacher_chat_context(db, user, request)
+            rag_prefetch = _start_rag_prefetch(
+                request, user.id, "teacher",
+                lambda rdb: TeacherChatSessionCRUD.find_open_session(rdb, user.id),
+                trace,
+            )
+            session, history = await _prepare_stream_turn(
+                _prepare_teacher_chat_context, db, user, request, trace=trace,
+            )
             trace.session_id = session.id
             
             yield sse_format("meta", {
@@ -312,10 +434,10 @@ def teacher_chat_stream_endpoint(
             
             yield sse_format("rag_start", {"query": request.message[:200]})
             
-            rag_context, rag_sources, rag_top_score = build_rag_context(
-                db, request.message,
+            rag_context, rag_sources, rag_top_score = await _collect_rag_context(
+                rag_prefetch, db, request, history,
                 viewer_user_id=user.id,
-                viewer_session_key=f"teacher:{session.id}",
+                session_key=f"teacher:{session.id}",
                 trace=trace,
             )
             
@@ -338,7 +460,7 @@ def teacher_chat_stream_endpoint(
             
             context = {"db": db, "teacher_user_id": user.id}
             
-            for event_dict in generate_response_with_tools_streaming(
+            async for event_dict in agenerate_response_with_tools_streaming(
                 messages=messages,
                 system_instruction=TEACHER_AGENT_SYSTEM_PROMPT,
                 context=context,
@@ -389,20 +511,9 @@ def teacher_chat_stream_endpoint(
                     yield sse_format("token", {"delta": ch})
                 full_reply_text += reference_line
             
-            TeacherChatMessageCRUD.create(
-                db,
-                TeacherChatMessageCreate(
-                    session_id=session.id, role="assistant", content=full_reply_text or "(空回复)"
-                ),
+            await run_in_threadpool(
+                _finish_teacher_stream_turn, db, bg, user, session, history, full_reply_text, trace,
             )
-            TeacherChatSessionCRUD.touch(db, session.id)
-            
-            n = len(history) + 2
-            if n >= MEMORY_REFRESH_EVERY and n % MEMORY_REFRESH_EVERY == 0:
-                bg.add_task(refresh_teacher_memory, user.id, session.id)
-            
-            trace.finalize(reply_text=full_reply_text, success=True)
-            trace.persist(db)
             
             yield sse_format("done", {
                 "success": True,
@@ -414,16 +525,7 @@ def teacher_chat_stream_endpoint(
         
         except Exception as e:
             logger.error(f"[STREAM] 教师流式对话失败: {type(e).__name__}: {e}", exc_info=True)
-            trace.finalize(
-                reply_text=full_reply_text or None,
-                success=False,
-                error_type=type(e).__name__,
-                error_message=str(e),
-            )
-            try:
-                trace.persist(db)
-            except Exception:
-                pass
+            await run_in_threadpool(_fail_stream_turn, db, trace, full_reply_text, e)
             
             yield sse_format("error", {
                 "message": f"AI 调用失败: {type(e).__name__}",
@@ -567,14 +669,12 @@ def student_chat_endpoint(
         )
         
         chat_minutes = max(1, min(8, len(request.message.strip()) // 60 + 1))
-        track_learning_activity(
-            db, student_id=student.id,
+        schedule_chat_metrics_refresh(
+            student.id, session.id,
             module="AI助教",
             duration_minutes=chat_minutes,
             content="统一对话",
         )
-        refresh_student_metrics(db, student.id)
-        ChatSessionCRUD.touch(db, session.id)
         
         n = len(history) + 2
         if n >= MEMORY_REFRESH_EVERY and n % MEMORY_REFRESH_EVERY == 0:
@@ -618,8 +718,37 @@ def student_chat_endpoint(
         }
 
 
+def _finish_student_stream_turn(db, bg, student, session, history, request, full_reply_text, trace):
+    """流式对话收尾(同步 DB 操作,由异步 endpoint 放到线程池执行)。"""
+    ChatMessageCRUD.create(
+        db,
+        ChatMessageCreate(
+            session_id=session.id,
+            role="assistant",
+            content=full_reply_text or "(空回复)",
+            correction=None,
+        ),
+    )
+    
+    # 学习时长、会话 touch 与指标刷新交给后台合并执行,done 不再等待
+    chat_minutes = max(1, min(8, len(request.message.strip()) // 60 + 1))
+    schedule_chat_metrics_refresh(
+        student.id, session.id,
+        module="AI助教",
+        duration_minutes=chat_minutes,
+        content="统一对话",
+    )
+    
+    n = len(history) + 2
+    if n >= MEMORY_REFRESH_EVERY and n % MEMORY_REFRESH_EVERY == 0:
+        bg.add_task(refresh_student_memory, student.id, session.id)
+    
+    trace.finalize(reply_text=full_reply_text, success=True)
+    trace.persist(db)
+
+
 @router.post("/api/student/chat/stream")
-def student_chat_stream_endpoint(
+async def student_chat_stream_endpoint(
     bg: BackgroundTasks,
     req: Request,
     request: StudentChatReq,
@@ -634,14 +763,17 @@ def student_chat_stream_endpoint(
     事件类型:
         meta              - 连接建立后立即推送 trace_id, session_id
         rag_start         - 开始 RAG 检索
-        rag_done          - RAG 完成(含命中分数)
+        rag_done          - RAG 完成(含命中分数;命中答案缓存时带 cache_hit)
         tool_call_start   - 工具开始调用
         tool_call_done    - 工具完成
-        token             - LLM 输出 token
+        token             - LLM 输出 token(缓存命中时为回放的缓存回答)
         done              - 流结束(含完整 reply 备份)
         error             - 错误
+    
+    异步实现:LLM 流在事件循环上读取,DB/RAG/缓存等同步调用放线程池。
+    RAG 检索与会话准备并发执行(见 _start_rag_prefetch),首 token 不等远程精排超出预算的部分。
     """
-    student = require_student(req, db)
+    student = await run_in_threadpool(require_student, req, db)
     logger.info(f"[STREAM] 学生流式对话: student_id={student.id}, msg_len={len(request.message)}")
     
     # trace 在 generator 外创建(便于失败时也能 finalize)
@@ -652,14 +784,21 @@ def student_chat_stream_endpoint(
         user_message=request.message,
     )
     
-    def event_generator():
-        """SSE 事件生成器(同步 generator)。"""
+    async def event_generator():
+        """SSE 事件生成器(async generator)。"""
         full_reply_text = ""  # 累积所有 token 用于持久化
         tool_calls_used: list = []
         
         try:
-            # ─── 准备上下文 ───
-            session, history = _prepare_student_chat_context(db, student, request)
+            # ─── 准备上下文(RAG 检索同时在独立连接上开始) ───
+            rag_prefetch = _start_rag_prefetch(
+                request, student.user_id, "student",
+                lambda rdb: ChatSessionCRUD.find_open_session(rdb, student.id, None, STUDENT_LOBBY_SCENE_NAME),
+                trace,
+            )
+            session, history = await _prepare_stream_turn(
+                _prepare_student_chat_context, db, student, request, trace=trace,
+            )
             trace.session_id = session.id
             
             # 推送 meta 事件
@@ -669,127 +808,149 @@ def student_chat_stream_endpoint(
                 "role": "student",
             })
             
-            messages: list[dict] = []
+            # ─── 语义答案缓存:会话首轮、非本人数据问题才参与 ───
+            cache_scope_key = cache_scope("student", "student", AGENT_SYSTEM_PROMPT, MODEL_ID)
+            cacheable = is_cacheable_turn(request.message, len(history) - 1)
+            cached = None
+            if cacheable:
+                with trace.span("cache_lookup", "answer_cache") as span:
+                    cached = await run_in_threadpool(lookup_answer, db, request.message, cache_scope_key)
+                    span.set_output({
+                        "cache_hit": cached is not None,
+                        "similarity": round(cached["similarity"], 4) if cached else None,
+                    })
             
-            # 长期记忆
-            if getattr(student, "long_memory_summary", None):
-                messages.append({
-                    "role": "user",
-                    "content": "[Learner profile]\n" + student.long_memory_summary,
+            if cached:
+                if rag_prefetch is not None:
+                    rag_prefetch.cancel()  # 还在排队时直接取消;已开始的跑完即丢弃
+                trace.cache_hit = True
+                trace.rag_used = True
+                trace.rag_top_score = cached["rag_top_score"]
+                yield sse_format("rag_done", {
+                    "used": True,
+                    "top_score": round(cached["rag_top_score"], 3),
+                    "sources_count": len(cached["sources"]),
+                    "cache_hit": True,
                 })
+                for delta in replay_deltas(cached["reply"]):
+                    yield sse_format("token", {"delta": delta})
+                full_reply_text = cached["reply"]
+            else:
+                messages: list[dict] = []
             
-            # ─── RAG 检索 ───
-            yield sse_format("rag_start", {"query": request.message[:200]})
+                # 长期记忆
+                if getattr(student, "long_memory_summary", None):
+                    messages.append({
+                        "role": "user",
+                        "content": "[Learner profile]\n" + student.long_memory_summary,
+                    })
             
-            rag_context, rag_sources, rag_top_score = build_rag_context(
-                db, request.message,
-                viewer_user_id=student.user_id,
-                viewer_session_key=f"student:{session.id}",
-                trace=trace,
-            )
+                # ─── RAG 检索 ───
+                yield sse_format("rag_start", {"query": request.message[:200]})
             
-            rag_used_strong = bool(rag_context and rag_top_score >= 0.4)
-            yield sse_format("rag_done", {
-                "used": rag_used_strong,
-                "top_score": round(rag_top_score, 3) if rag_top_score else 0,
-                "sources_count": len(rag_sources or []),
-            })
+                rag_context, rag_sources, rag_top_score = await _collect_rag_context(
+                    rag_prefetch, db, request, history,
+                    viewer_user_id=student.user_id,
+                    session_key=f"student:{session.id}",
+                    trace=trace,
+                )
             
-            if rag_used_strong:
-                messages.append({
-                    "role": "user",
-                    "content": "[Knowledge Base 预检索结果,可参考]\n" + rag_context,
+                rag_used_strong = bool(rag_context and rag_top_score >= 0.4)
+                yield sse_format("rag_done", {
+                    "used": rag_used_strong,
+                    "top_score": round(rag_top_score, 3) if rag_top_score else 0,
+                    "sources_count": len(rag_sources or []),
                 })
-                trace.rag_used = True
-                trace.rag_top_score = rag_top_score
             
-            messages.extend(history_to_messages(history, max_turns=14))
+                if rag_used_strong:
+                    messages.append({
+                        "role": "user",
+                        "content": "[Knowledge Base 预检索结果,可参考]\n" + rag_context,
+                    })
+                    trace.rag_used = True
+                    trace.rag_top_score = rag_top_score
             
-            # ─── Agent 流式循环 ───
-            context = {"db": db, "student_id": student.id}
+                messages.extend(history_to_messages(history, max_turns=14))
             
-            for event_dict in generate_response_with_tools_streaming(
-                messages=messages,
-                system_instruction=AGENT_SYSTEM_PROMPT,
-                context=context,
-                toolset="student",
-                trace=trace,
-            ):
-                etype = event_dict["event"]
+                # ─── Agent 流式循环 ───
+                context = {"db": db, "student_id": student.id}
+                llm_failed = False
+            
+                async for event_dict in agenerate_response_with_tools_streaming(
+                    messages=messages,
+                    system_instruction=AGENT_SYSTEM_PROMPT,
+                    context=context,
+                    toolset="student",
+                    trace=trace,
+                ):
+                    etype = event_dict["event"]
                 
-                if etype == "token":
-                    full_reply_text += event_dict["delta"]
-                    yield sse_format("token", {"delta": event_dict["delta"]})
+                    if etype == "token":
+                        full_reply_text += event_dict["delta"]
+                        yield sse_format("token", {"delta": event_dict["delta"]})
                 
-                elif etype == "tool_call_start":
-                    tool_calls_used.append({
-                        "name": event_dict["name"],
-                        "display_name": event_dict["display_name"],
-                        "args": event_dict["args"],
-                        "iteration": event_dict["iteration"],
-                    })
-                    yield sse_format("tool_call_start", {
-                        "name": event_dict["name"],
-                        "display_name": event_dict["display_name"],
-                        "args": event_dict["args"],
-                        "iteration": event_dict["iteration"],
-                    })
+                    elif etype == "tool_call_start":
+                        tool_calls_used.append({
+                            "name": event_dict["name"],
+                            "display_name": event_dict["display_name"],
+                            "args": event_dict["args"],
+                            "iteration": event_dict["iteration"],
+                        })
+                        yield sse_format("tool_call_start", {
+                            "name": event_dict["name"],
+                            "display_name": event_dict["display_name"],
+                            "args": event_dict["args"],
+                            "iteration": event_dict["iteration"],
+                        })
                 
-                elif etype == "tool_call_done":
-                    yield sse_format("tool_call_done", {
-                        "name": event_dict["name"],
-                        "success": event_dict["success"],
-                        "summary": event_dict["summary"],
-                    })
+                    elif etype == "tool_call_done":
+                        yield sse_format("tool_call_done", {
+                            "name": event_dict["name"],
+                            "success": event_dict["success"],
+                            "summary": event_dict["summary"],
+                        })
                 
-                elif etype == "done":
-                    # generator 内部的 done 事件:用 generator 给的 reply 兜底
-                    if event_dict.get("reply"):
-                        full_reply_text = event_dict["reply"]
-                    break
+                    elif etype == "done":
+                        # generator 内部的 done 事件:用 generator 给的 reply 兜底
+                        if event_dict.get("reply"):
+                            full_reply_text = event_dict["reply"]
+                        break
                 
-                elif etype == "error":
-                    yield sse_format("error", {"message": event_dict["message"]})
-                    full_reply_text = event_dict["message"]
-                    break
+                    elif etype == "error":
+                        yield sse_format("error", {"message": event_dict["message"]})
+                        full_reply_text = event_dict["message"]
+                        llm_failed = True
+                        break
             
-            # ─── 后处理:补 RAG 引用 ───
-            _kb_miss_markers = ("知识库未命中", "通用回答", "未命中")
-            if rag_sources and rag_top_score >= 0.4 and full_reply_text and not any(m in full_reply_text for m in _kb_miss_markers):
-                reference_line = "\n\n参考资料: " + "; ".join(rag_sources[:5])
-                # 推送给前端展示
-                for ch in reference_line:
-                    yield sse_format("token", {"delta": ch})
-                full_reply_text += reference_line
+                # ─── 后处理:补 RAG 引用 ───
+                _kb_miss_markers = ("知识库未命中", "通用回答", "未命中")
+                if rag_sources and rag_top_score >= 0.4 and full_reply_text and not any(m in full_reply_text for m in _kb_miss_markers):
+                    reference_line = "\n\n参考资料: " + "; ".join(rag_sources[:5])
+                    # 推送给前端展示
+                    for ch in reference_line:
+                        yield sse_format("token", {"delta": ch})
+                    full_reply_text += reference_line
             
-            # ─── 持久化对话记录 ───
-            ChatMessageCRUD.create(
-                db,
-                ChatMessageCreate(
-                    session_id=session.id,
-                    role="assistant",
-                    content=full_reply_text or "(空回复)",
-                    correction=None,
-                ),
-            )
+                # 未调用工具、公共知识库强命中、未注入个人学习画像的回答才写入缓存
+                if (
+                    cacheable
+                    and rag_used_strong
+                    and not tool_calls_used
+                    and not llm_failed
+                    and not getattr(student, "long_memory_summary", None)
+                    and full_reply_text
+                    and not any(m in full_reply_text for m in _kb_miss_markers)
+                ):
+                    await run_in_threadpool(
+                        store_answer,
+                        db, request.message, cache_scope_key,
+                        full_reply_text, rag_top_score, rag_sources,
+                    )
             
-            chat_minutes = max(1, min(8, len(request.message.strip()) // 60 + 1))
-            track_learning_activity(
-                db, student_id=student.id,
-                module="AI助教",
-                duration_minutes=chat_minutes,
-                content="统一对话",
+            # ─── 持久化对话记录 + trace ───
+            await run_in_threadpool(
+                _finish_student_stream_turn, db, bg, student, session, history, request, full_reply_text, trace,
             )
-            refresh_student_metrics(db, student.id)
-            ChatSessionCRUD.touch(db, session.id)
-            
-            n = len(history) + 2
-            if n >= MEMORY_REFRESH_EVERY and n % MEMORY_REFRESH_EVERY == 0:
-                bg.add_task(refresh_student_memory, student.id, session.id)
-            
-            # ─── trace 完成 + 持久化 ───
-            trace.finalize(reply_text=full_reply_text, success=True)
-            trace.persist(db)
             
             # ─── 推送 done 事件 ───
             yield sse_format("done", {
@@ -798,20 +959,12 @@ def student_chat_stream_endpoint(
                 "session_id": session.id,
                 "tool_calls_count": len(tool_calls_used),
                 "total_duration_ms": trace.total_duration_ms,
+                "cache_hit": trace.cache_hit,
             })
         
         except Exception as e:
             logger.error(f"[STREAM] 学生流式对话失败: {type(e).__name__}: {e}", exc_info=True)
-            trace.finalize(
-                reply_text=full_reply_text or None,
-                success=False,
-                error_type=type(e).__name__,
-                error_message=str(e),
-            )
-            try:
-                trace.persist(db)
-            except Exception:
-                pass
+            await run_in_threadpool(_fail_stream_turn, db, trace, full_reply_text, e)
             
             yield sse_format("error", {
                 "message": f"AI 调用失败: {type(e).__name__}",
@@ -1029,15 +1182,12 @@ def scene_chat(req: SceneChatReq, request: Request, db: Session = Depends(get_db
             ),
         )
         chat_minutes = max(1, min(8, len(req.userMessage.strip()) // 60 + 1))
-        track_learning_activity(
-            db,
-            student_id=student.id,
+        schedule_chat_metrics_refresh(
+            student.id, session.id,
             module="情景对话",
             duration_minutes=chat_minutes,
             content=f"场景对话: {scene_name}",
         )
-        refresh_student_metrics(db, student.id)
-        ChatSessionCRUD.touch(db, session.id)
         return ok({"reply": reply, "correction": correction, "session_id": session.id})
     except Exception as e:
         return fail(f"对话失败: {e}")
@@ -30,7 +30,7 @@ from schemas.entities import (
 )
 from core.responses import ok, fail, to_float
 from core.deps import require_teacher
-from services.metrics import refresh_student_metrics
+from services.metrics import record_metric_event, student_metrics_snapshot
 
 router = APIRouter()
 
@@ -60,7 +60,7 @@ def get_student_detail(id: str, request: Request = None, db: Session = Depends(g
         student_class_ids = set(StudentCRUD.list_class_ids(db, student.id))
         if not (student_class_ids & teacher_class_ids):
             return fail("无权查看该学生", 403)
-        refreshed = refresh_student_metrics(db, student.id)
+        refreshed = student_metrics_snapshot(student)
         ability = StudentAbilityCRUD.get_by_student_id(db, student.id)
         homeworks = HomeworkCRUD.list_by_student(db, student.id)
         exam_assignments = list(db.scalars(
@@ -242,6 +242,7 @@ def save_homework_review(request: HomeworkSaveRequest, req: Request = None, db:
         student_class_ids = set(StudentCRUD.list_class_ids(db, student.id)) if student else set()
         if not student or not (student_class_ids & teacher_class_ids):
             return fail("无权操作该作业", 403)
+        old_score = hw.score
         HomeworkReviewCRUD.create(
             db,
             HomeworkReviewCreate(
@@ -252,7 +253,14 @@ def save_homework_review(request: HomeworkSaveRequest, req: Request = None, db:
             ),
         )
         HomeworkCRUD.update_score_feedback(db, request.homeworkId, request.score, request.feedback)
-        latest = refresh_student_metrics(db, student.id)
+        latest = None
+        if hw.status == "已完成":
+            latest = record_metric_event(
+                db, student.id, "homework_scored",
+                old_score=None if old_score is None else float(old_score),
+                new_score=None if request.score is None else float(request.score),
+            )
+        latest = latest or student_metrics_snapshot(student)
         return ok({"homeworkId": request.homeworkId, "saved": True, "metrics": latest}, "评分保存成功")
     except Exception as e:
         return fail(f"评分保存失败: {e}")
@@ -21,6 +21,7 @@ from crud.repositories import (
     SpeakingEvaluationCRUD,
     WritingSessionCRUD,
     LearningSessionCRUD,
+    ActivityRollupCRUD,
     StudentKnowledgeMasteryCRUD,
 )
 from schemas.entities import (
@@ -36,7 +37,8 @@ from core.deps import require_student, current_student
 from services.llm import ai_text, ai_json
 from services.metrics import (
     track_learning_activity,
-    refresh_student_metrics,
+    record_metric_event,
+    student_metrics_snapshot,
     parse_duration_minutes,
     compute_student_interaction_minutes,
 )
@@ -56,8 +58,13 @@ def _track_and_refresh(
     module: str,
     duration_minutes: int,
     content: str | None = None,
+    event: str = "learning",
+    **event_data,
 ) -> None:
-    """写入学习行为并刷新积极度；统计失败不影响主流程。"""
+    """写入学习行为并增量更新积极度/能力画像；统计失败不影响主流程。
+
+    event / event_data 描述本次写入的原始数据,见 services.metrics.record_metric_event。
+    """
     try:
         track_learning_activity(
             db,
@@ -66,7 +73,7 @@ def _track_and_refresh(
             duration_minutes=duration_minutes,
             content=content,
         )
-        refresh_student_metrics(db, student_id)
+        record_metric_event(db, student_id, event, **event_data)
     except Exception:
         pass
 
@@ -172,6 +179,7 @@ def vocab_collect(req: VocabCollectReq, request: Request, db: Session = Depends(
         if not student:
             return fail("未找到学生信息", 401)
         if req.isCollect:
+            newly_collected = not StudentVocabCollectionCRUD.is_collected(db, student.id, req.vocabId)
             StudentVocabCollectionCRUD.collect(
                 db, StudentVocabCollectionCreate(student_id=student.id, vocab_id=req.vocabId)
             )
@@ -188,9 +196,13 @@ def vocab_collect(req: VocabCollectReq, request: Request, db: Session = Depends(
                         translate=vocab.chinese,
                         note=vocab.example,
                     ))
-            _track_and_refresh(db, student.id, "词汇学习", 2, "词汇收藏")
+            _track_and_refresh(
+                db, student.id, "词汇学习", 2, "词汇收藏",
+                event="vocab_collection", delta=int(newly_collected),
+            )
         else:
-            StudentVocabCollectionCRUD.uncollect(db, student.id, req.vocabId)
+            if StudentVocabCollectionCRUD.uncollect(db, student.id, req.vocabId):
+                record_metric_event(db, student.id, "vocab_collection", delta=-1)
             vocab = VocabularyCRUD.get_by_id(db, req.vocabId)
             vocab_cat = FavoriteCategoryCRUD.get_by_type(db, "vocab")
             if vocab and vocab_cat:
@@ -508,6 +520,8 @@ def grammar_submit(req: GrammarSubmitReq, request: Request, db: Session = Depend
         details = []
         correct_count = 0
         wrong_questions: list[dict] = []  # 收集本次错题,批量写入
+        new_submissions = 0  # 首次作答的题数(重答只覆盖原记录)
+        correct_delta = 0  # 答对条数的净变化
         
         for ans in req.answers:
             ex = GrammarExerciseCRUD.get_by_id(db, ans.exerciseId)
@@ -535,11 +549,14 @@ def grammar_submit(req: GrammarSubmitReq, request: Request, db: Session = Depend
             # 保存答题历史(UPSERT)
             last_sub = GrammarSubmissionCRUD.get_last_submission(db, student.id, ans.exerciseId)
             if last_sub:
+                correct_delta += int(is_correct) - int(bool(last_sub.is_correct))
                 last_sub.user_answer = ans.userAnswer
                 last_sub.is_correct = is_correct
                 last_sub.ai_analysis = analysis if not is_correct else None
                 db.merge(last_sub)
             else:
+                new_submissions += 1
+                correct_delta += int(is_correct)
                 GrammarSubmissionCRUD.create(
                     db,
                     GrammarSubmissionCreate(
@@ -597,6 +614,9 @@ def grammar_submit(req: GrammarSubmitReq, request: Request, db: Session = Depend
             "语法练习",
             max(3, len(req.answers) * 2),
             f"语法提交: 正确{correct_count}/{len(req.answers)}",
+            event="grammar_submission",
+            submitted=new_submissions,
+            correct=correct_delta,
         )
         
         return ok({
@@ -675,6 +695,11 @@ def speaking_evaluate(req: SpeakingEvalReq, request: Request, db: Session = Depe
             "听说训练",
             duration_minutes,
             f"口语评测: {material.title}",
+            event="speaking_evaluation",
+            total_score=result.get("totalScore"),
+            pronunciation_score=result.get("pronunciationScore"),
+            fluency_score=result.get("fluencyScore"),
+            intonation_score=result.get("intonationScore"),
         )
         return ok(result)
     except Exception as e:
@@ -700,7 +725,10 @@ def writing_check(req: WritingReq, request: Request, db: Session = Depends(get_d
                 ),
             )
             writing_minutes = max(2, min(25, len(req.userText.strip()) // 80 + 2))
-            _track_and_refresh(db, student.id, "写作辅助", writing_minutes, "写作纠错")
+            _track_and_refresh(
+                db, student.id, "写作辅助", writing_minutes, "写作纠错",
+                event="writing_session", text_length=len(req.userText),
+            )
         return ok(result)
     except Exception as e:
         return fail(f"检查失败: {e}")
@@ -728,7 +756,10 @@ def writing_generate_sample(req: WritingReq, request: Request, db: Session = Dep
                 ),
             )
             writing_minutes = max(3, min(30, len(req.userText.strip()) // 70 + 3))
-            _track_and_refresh(db, student.id, "写作辅助", writing_minutes, "写作范文")
+            _track_and_refresh(
+                db, student.id, "写作辅助", writing_minutes, "写作范文",
+                event="writing_session", text_length=len(req.userText),
+            )
         return ok(result)
     except Exception as e:
         return fail(f"生成范文失败: {e}")
@@ -900,7 +931,8 @@ def favorites_delete(fav_id: int, request: Request, db: Session = Depends(get_db
             all_vocabs = VocabularyCRUD.list_all(db)
             for v in all_vocabs:
                 if v.german == fav.content:
-                    StudentVocabCollectionCRUD.uncollect(db, student.id, v.id)
+                    if StudentVocabCollectionCRUD.uncollect(db, student.id, v.id):
+                        record_metric_event(db, student.id, "vocab_collection", delta=-1)
                     break
         FavoriteCRUD.delete(db, fav_id)
         return ok(None, "删除成功")
@@ -957,14 +989,11 @@ def learning_progress(request: Request, db: Session = Depends(get_db)):
         if not student:
             return fail("未找到学生信息", 401)
 
-        latest_metrics = refresh_student_metrics(db, student.id)
-        total_time = LearningSessionCRUD.total_minutes(db, student.id)
+        latest_metrics = student_metrics_snapshot(student)
         week_time = LearningSessionCRUD.week_minutes(db, student.id)
         interaction_minutes = compute_student_interaction_minutes(db, student.id, days=7)
-        sessions = LearningSessionCRUD.list_by_student(db, student.id)
-        module_map: dict[str, int] = {}
-        for s in sessions:
-            module_map[s.module] = module_map.get(s.module, 0) + s.duration_minutes
+        module_map = ActivityRollupCRUD.module_minutes(db, student.id)
+        total_time = sum(module_map.values())
         all_modules = ["词汇学习", "语法练习", "情景对话", "听说训练", "写作辅助"]
         max_minutes = max(module_map.values()) if module_map else 1
         modules = [
@@ -977,20 +1006,13 @@ def learning_progress(request: Request, db: Session = Depends(get_db)):
         finish_rate = round(mastered_count / len(knowledge_list) * 100) if knowledge_list else 0
         today = date.today()
         week_start = today - timedelta(days=today.weekday())
-        week_sessions = [
-            s for s in sessions
-            if (hasattr(s.session_date, 'date') and s.session_date.date() >= week_start)
-            or (isinstance(s.session_date, date) and s.session_date >= week_start)
-        ]
+        # 时长取按天汇总;文字只查本周的学习记录
         day_map: dict[int, dict] = {}
-        for s in week_sessions:
-            sd = s.session_date.date() if hasattr(s.session_date, 'date') else s.session_date
-            weekday = sd.weekday()
-            if weekday not in day_map:
-                day_map[weekday] = {"time": 0, "contents": []}
-            day_map[weekday]["time"] += s.duration_minutes
-            if s.content:
-                day_map[weekday]["contents"].append(s.content)
+        for day, minutes in ActivityRollupCRUD.daily_minutes(db, student.id, week_start).items():
+            day_map.setdefault(day.weekday(), {"time": 0, "contents": []})["time"] += minutes
+        for session_date, content in LearningSessionCRUD.list_week_contents(db, student.id, week_start):
+            sd = session_date.date() if hasattr(session_date, 'date') else session_date
+            day_map.setdefault(sd.weekday(), {"time": 0, "contents": []})["contents"].append(content)
         week_report = [
             {
                 "day": DAY_NAMES[i],
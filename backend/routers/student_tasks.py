@@ -14,7 +14,7 @@ from models.entities import ExamAssignment, Exam, Homework, Scenario, ScenarioPu
 from schemas.entities import HomeworkCreate
 from core.responses import ok, fail
 from core.deps import current_student, require_student
-from services.metrics import track_learning_activity, refresh_student_metrics
+from services.metrics import track_learning_activity, record_metric_event, student_metrics_snapshot
 
 from services.exam_grader import ExamGrader
 from services.error_book_service import ErrorBookService
@@ -312,7 +312,9 @@ def submit_exam_answers(req: StudentExamSubmitReq, request: Request, db: Session
 
         # 7. 提交
         db.commit()
-        latest = refresh_student_metrics(db, student.id)
+        latest = record_metric_event(
+            db, student.id, "homework_completed", score=float(earned_score)
+        ) or student_metrics_snapshot(student)
         return ok({"score": earned_score, "message": "提交成功", "metrics": latest})
     except Exception as e:
         db.rollback()
@@ -358,5 +360,5 @@ def complete_task(req: TaskCompleteReq, request: Request, db: Session = Depends(
             p.push_status = "completed"
             db.commit()
             track_learning_activity(db, student.id, "情景对话", 5, "完成情景任务")
-            refresh_student_metrics(db, student.id)
+            record_metric_event(db, student.id, "learning")
     return ok()
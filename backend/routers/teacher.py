@@ -27,7 +27,7 @@ from schemas.entities import (
 from core.responses import ok, fail, to_float
 from core.deps import require_teacher, get_current_teacher_and_classrooms
 from services.llm import generate_response
-from services.metrics import compute_student_interaction_minutes, refresh_student_metrics
+from services.metrics import compute_interaction_minutes_batch, student_metrics_snapshot
 
 import logging
 logger = logging.getLogger(__name__)
@@ -85,11 +85,8 @@ def teacher_dashboard(request: Request, db: Session = Depends(get_db)):
         students = list(students_map.values())
         class_name_by_id = {c.id: c.class_name for c in classrooms}
 
-        metric_map: dict[int, dict] = {}
-        interaction_hours = []
-        for s in students:
-            metric_map[s.id] = refresh_student_metrics(db, s.id)
-            interaction_hours.append(compute_student_interaction_minutes(db, s.id, days=7) / 60)
+        interaction_map = compute_interaction_minutes_batch(db, [s.id for s in students])
+        interaction_hours = [interaction_map.get(s.id, 0) / 60 for s in students]
 
         all_homeworks = []
         for s in students:
@@ -122,9 +119,9 @@ def teacher_dashboard(request: Request, db: Session = Depends(get_db)):
                     "name": s.name,
                     "uid": s.uid,
                     "class": " / ".join([class_name_by_id.get(cid, "") for cid in StudentCRUD.list_class_ids(db, s.id) if class_name_by_id.get(cid)]),
-                    "active": metric_map.get(s.id, {}).get("active_score", s.active_score),
-                    "score": metric_map.get(s.id, {}).get("overall_score", to_float(s.overall_score)),
-                    "weak": metric_map.get(s.id, {}).get("weak_point", s.weak_point or "暂无"),
+                    "active": s.active_score,
+                    "score": to_float(s.overall_score),
+                    "weak": s.weak_point or "暂无",
                 }
                 for s in students
             ],
@@ -446,7 +443,7 @@ def list_class_students(request: Request = None, db: Session = Depends(get_db)):
 
         result = []
         for s in students_map.values():
-            latest_metrics = refresh_student_metrics(db, s.id)
+            latest_metrics = student_metrics_snapshot(s)
             class_names = [class_name_by_id.get(cid) for cid in StudentCRUD.list_class_ids(db, s.id)]
             class_names = [x for x in class_names if x]
             result.append(
@@ -516,7 +513,7 @@ def update_class_student(
                 user.status = updates["status"]
             db.commit()
 
-        latest_metrics = refresh_student_metrics(db, student.id)
+        latest_metrics = student_metrics_snapshot(student)
 
         return ok(
             {
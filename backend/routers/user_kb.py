@@ -8,32 +8,17 @@ from fastapi import APIRouter, Depends, File, HTTPException, UploadFile
 from sqlalchemy.orm import Session
 
 from core.deps import require_login_user
-from crud.repositories import KnowledgeBaseCRUD
+from crud.repositories import KbIngestJobCRUD, KnowledgeBaseCRUD
 from db.session import get_db
-from services.kb_ingest import chunk_text, enrich_chunks_with_embeddings, extract_text
+from services.kb_jobs import enqueue_ingest, job_status_payload
+from services.answer_cache import invalidate_answer_cache
+from services.rerank import invalidate_rerank_cache
+from services.vector_index import notify_documents_changed
 
 router = APIRouter(prefix="/api/user/kb", tags=["user-kb"])
 KB_STORAGE_DIR = Path(__file__).resolve().parent.parent / "storage" / "kb_private"
 
 
-def _ingest_document_sync(db: Session, doc_id: int) -> None:
-    doc = KnowledgeBaseCRUD.get_document(db, doc_id)
-    if not doc:
-        raise HTTPException(status_code=404, detail="文档不存在")
-    try:
-        source_path = Path(doc["source_path"])
-        text = extract_text(source_path, doc.get("mime_type"))
-        chunks = chunk_text(text)
-        if not chunks:
-            KnowledgeBaseCRUD.set_document_status(db, doc_id, "failed", "文档内容为空或解析失败")
-            return
-        enriched = enrich_chunks_with_embeddings(chunks)
-        KnowledgeBaseCRUD.replace_chunks(db, doc_id, enriched)
-        KnowledgeBaseCRUD.set_document_status(db, doc_id, "ready", None, chunk_count=len(enriched))
-    except Exception as e:
-        KnowledgeBaseCRUD.set_document_status(db, doc_id, "failed", str(e)[:500])
-
-
 @router.get("/docs")
 def list_user_docs(db: Session = Depends(get_db), actor=Depends(require_login_user)):
     return KnowledgeBaseCRUD.list_documents(db, scope="private", owner_user_id=actor["user_id"])
@@ -64,8 +49,8 @@ async def upload_user_doc(
         scope="private",
         owner_user_id=actor["user_id"],
     )
-    _ingest_document_sync(db, int(doc["id"]))
-    return {"id": doc["id"], "status": "processing"}
+    job = enqueue_ingest(db, int(doc["id"]))
+    return {"id": doc["id"], "status": "processing", "job_id": job.get("id")}
 
 
 @router.post("/upload-temporary")
@@ -104,8 +89,8 @@ async def upload_user_temp_doc(
         is_temporary=True,
         session_key=session_key,
     )
-    _ingest_document_sync(db, int(doc["id"]))
-    return {"id": doc["id"], "status": "processing"}
+    job = enqueue_ingest(db, int(doc["id"]))
+    return {"id": doc["id"], "status": "processing", "job_id": job.get("id")}
 
 
 @router.post("/reindex/{doc_id}")
@@ -115,9 +100,23 @@ def reindex_user_doc(doc_id: int, db: Session = Depends(get_db), actor=Depends(r
         raise HTTPException(status_code=404, detail="文档不存在")
     if doc.get("scope") != "private" or doc.get("owner_user_id") != actor["user_id"]:
         raise HTTPException(status_code=403, detail="无权操作该文档")
-    KnowledgeBaseCRUD.set_document_status(db, doc_id, "processing", None)
-    _ingest_document_sync(db, doc_id)
-    return {"id": doc_id, "status": "processing"}
+    job = enqueue_ingest(db, doc_id)
+    return {"id": doc_id, "status": "processing", "job_id": job.get("id")}
+
+
+@router.get("/docs/{doc_id}/job")
+def user_doc_job_status(doc_id: int, db: Session = Depends(get_db), actor=Depends(require_login_user)):
+    """查询本人文档最近一次入库任务的状态与进度。"""
+    doc = KnowledgeBaseCRUD.get_document(db, doc_id)
+    if not doc:
+        raise HTTPException(status_code=404, detail="文档不存在")
+    if doc.get("scope") != "private" or doc.get("owner_user_id") != actor["user_id"]:
+        raise HTTPException(status_code=403, detail="无权查看该文档")
+    return {
+        "id": doc_id,
+        "status": doc.get("status"),
+        "job": job_status_payload(KbIngestJobCRUD.get_latest_for_document(db, doc_id)),
+    }
 
 
 @router.delete("/docs/{doc_id}")
@@ -129,6 +128,10 @@ def delete_user_doc(doc_id: int, db: Session = Depends(get_db), actor=Depends(re
         raise HTTPException(status_code=403, detail="无权删除该文档")
     source_path = Path(doc.get("source_path") or "")
     ok = KnowledgeBaseCRUD.delete_document(db, doc_id)
+    if ok:
+        invalidate_rerank_cache([doc_id])
+        invalidate_answer_cache([doc_id])
+        notify_documents_changed([doc_id])
     if ok and source_path.exists():
         try:
             source_path.unlink(missing_ok=True)
@@ -0,0 +1,58 @@
+"""
+从 learning_sessions / chat_messages 重建按天汇总表 student_activity_daily 与 student_chat_daily。
+
+迁移 20261018_0009 建表时已回填历史数据,之后写入学习记录和对话消息时同步累加;
+本脚本只用于修复:绕过应用直接往原始表导数据、或汇总与原始表不一致时重新对齐。
+
+用法（在 backend 目录）:
+  python scripts/backfill_activity_rollups.py                # 全部学生,一个事务
+  python scripts/backfill_activity_rollups.py --batch 1000   # 按学生分批提交
+"""
+from __future__ import annotations
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+backend_root = Path(__file__).resolve().parent.parent
+repo_root = backend_root.parent
+sys.path.insert(0, str(backend_root))
+
+from dotenv import load_dotenv
+
+load_dotenv(repo_root / ".env")
+load_dotenv(backend_root / ".env")
+
+from sqlalchemy import select
+
+from crud.repositories import ActivityRollupCRUD
+from db.session import SessionLocal
+from models.entities import Student
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="重建学习/对话按天汇总表")
+    parser.add_argument("--batch", type=int, default=0, help="每批学生数;0 表示全表一次重建")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        t0 = time.perf_counter()
+        if args.batch <= 0:
+            ActivityRollupCRUD.rebuild(db)
+            db.commit()
+        else:
+            ids = list(db.scalars(select(Student.id).order_by(Student.id)))
+            for i in range(0, len(ids), args.batch):
+                chunk = ids[i:i + args.batch]
+                ActivityRollupCRUD.rebuild(db, chunk)
+                db.commit()
+                print(f"[ROLLUP] {i + len(chunk)}/{len(ids)}")
+        print(f"[ROLLUP] 重建完成, {time.perf_counter() - t0:.1f}s")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+对比 kb_chunks 两种写入方式的耗时：逐行 INSERT + 文本向量字面量（旧实现）
+与 KnowledgeBaseCRUD.replace_chunks 的批量二进制 COPY（新实现）。
+
+需要可连接的 PostgreSQL（已执行 alembic upgrade head）。脚本会临时创建一个
+公共文档并在结束时删除，不调用 embedding API（向量随机生成）。
+
+用法（在 backend 目录）:
+  python scripts/bench_kb_bulk_insert.py
+  python scripts/bench_kb_bulk_insert.py --chunks 10000 --dim 1024
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import random
+import sys
+import time
+from pathlib import Path
+
+backend_root = Path(__file__).resolve().parent.parent
+repo_root = backend_root.parent
+sys.path.insert(0, str(backend_root))
+
+from dotenv import load_dotenv
+
+load_dotenv(repo_root / ".env")
+load_dotenv(backend_root / ".env")
+
+from sqlalchemy import text
+
+from crud.repositories import KnowledgeBaseCRUD
+from db.session import SessionLocal
+from services.embedding import _vector_to_pg_literal
+
+
+def _make_chunks(n: int, dim: int) -> list[dict]:
+    rnd = random.Random(42)
+    chunks = []
+    for i in range(n):
+        content = f"Beispieltext {i}: Der Konjunktiv II drückt Wünsche und irreale Bedingungen aus. " * 8
+        chunks.append({
+            "chunk_index": i,
+            "content": content,
+            "token_count": len(content) // 4,
+            "metadata_json": json.dumps({"start": i * 600, "end": i * 600 + 700}),
+            "embedding": [rnd.uniform(-1, 1) for _ in range(dim)],
+        })
+    return chunks
+
+
+def _legacy_replace_chunks(db, doc_id: int, chunks: list[dict]) -> None:
+    """基线实现(改造前的 replace_chunks):每个 chunk 一条 INSERT + 文本向量字面量。"""
+    db.execute(text("DELETE FROM kb_chunks WHERE document_id=:doc_id"), {"doc_id": doc_id})
+    for c in chunks:
+        db.execute(
+            text(
+                "INSERT INTO kb_chunks(document_id, chunk_index, content, token_count, metadata, embedding) "
+                "VALUES (:document_id, :chunk_index, :content, :token_count, CAST(:metadata AS JSONB), CAST(:embedding AS vector))"
+            ),
+            {
+                "document_id": doc_id,
+                "chunk_index": c["chunk_index"],
+                "content": c["content"],
+                "token_count": c.get("token_count", 0),
+                "metadata": c.get("metadata_json", "{}"),
+                "embedding": _vector_to_pg_literal(c["embedding"]),
+            },
+        )
+    db.commit()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="kb_chunks 批量写入基准")
+    parser.add_argument("--chunks", type=int, default=10000)
+    parser.add_argument("--dim", type=int, default=1024)
+    args = parser.parse_args()
+
+    print(f"生成 {args.chunks} 个合成 chunk(dim={args.dim})...")
+    chunks = _make_chunks(args.chunks, args.dim)
+
+    db = SessionLocal()
+    doc = KnowledgeBaseCRUD.create_document(
+        db,
+        title="__bench_bulk_insert__",
+        source_name="bench",
+        source_path="/dev/null",
+        mime_type="text/plain",
+        uploaded_by=None,
+    )
+    doc_id = int(doc["id"])
+    try:
+        t0 = time.perf_counter()
+        _legacy_replace_chunks(db, doc_id, chunks)
+        legacy_s = time.perf_counter() - t0
+        print(f"[旧] 逐行 INSERT:   {legacy_s:8.2f}s  ({args.chunks / legacy_s:8.0f} chunks/s)")
+
+        t0 = time.perf_counter()
+        KnowledgeBaseCRUD.replace_chunks(db, doc_id, chunks)
+        bulk_s = time.perf_counter() - t0
+        print(f"[新] 批量 COPY:     {bulk_s:8.2f}s  ({args.chunks / bulk_s:8.0f} chunks/s)")
+
+        written = db.execute(
+            text("SELECT COUNT(*) FROM kb_chunks WHERE document_id=:id"), {"id": doc_id}
+        ).scalar()
+        print(f"\n校验: 写入 {written} 行, 加速 {legacy_s / bulk_s:.1f}x")
+    finally:
+        KnowledgeBaseCRUD.delete_document(db, doc_id)
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""
+对比学生指标刷新的两种方式：逐个学生 refresh_student_active_score + refresh_student_performance
+（旧的 refresh_student_metrics，每人约 12 条聚合查询 + 2 次提交）与
+refresh_student_metrics_batch（按类 GROUP BY + 一次批量写回）。
+
+需要可连接的 PostgreSQL（已执行 alembic upgrade head）。脚本会创建一批合成学生
+（用户名前缀 zzbenchmetrics）及其学习记录、对话、写作、作业等数据，结束时删除。
+库里已有语法题 / 听力材料 / 词汇时，也会为合成学生生成对应的提交、测评和收藏。
+
+用法（在 backend 目录）:
+  python scripts/bench_metrics_batch.py
+  python scripts/bench_metrics_batch.py --students 1000 --keep
+"""
+from __future__ import annotations
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+backend_root = Path(__file__).resolve().parent.parent
+repo_root = backend_root.parent
+sys.path.insert(0, str(backend_root))
+
+from dotenv import load_dotenv
+
+load_dotenv(repo_root / ".env")
+load_dotenv(backend_root / ".env")
+
+from sqlalchemy import event, text
+
+from crud.repositories import ActivityRollupCRUD
+from db.session import SessionLocal, engine
+from services.metrics import (
+    refresh_student_active_score,
+    refresh_student_metrics_batch,
+    refresh_student_performance,
+)
+
+PREFIX = "zzbenchmetrics"
+BENCH_STUDENTS = f"SELECT s.id FROM students s JOIN users u ON u.id = s.user_id WHERE u.username LIKE '{PREFIX}%'"
+
+
+def _seed(db, n: int) -> list[int]:
+    db.execute(
+        text(
+            "INSERT INTO users(username, password_hash, role, display_name, status, is_active) "
+            "SELECT :prefix || g, 'x', 'student', 'Bench ' || g, 'approved', TRUE FROM generate_series(1, :n) g"
+        ),
+        {"prefix": PREFIX, "n": n},
+    )
+    db.execute(
+        text(
+            "INSERT INTO students(uid, user_id, name, status) "
+            "SELECT 'zzb' || u.id, u.id, u.display_name, 'approved' FROM users u WHERE u.username LIKE :pattern"
+        ),
+        {"pattern": f"{PREFIX}%"},
+    )
+    db.execute(text(
+        "INSERT INTO learning_sessions(student_id, module, duration_minutes, content, session_date) "
+        f"SELECT s.id, 'AI助教', 1 + (random() * 30)::int, 'bench', NOW() - random() * INTERVAL '14 days' "
+        f"FROM ({BENCH_STUDENTS}) s, generate_series(1, 8)"
+    ))
+    db.execute(text(
+        "INSERT INTO chat_sessions(student_id, scene_name, title) "
+        f"SELECT s.id, '大厅AI', 'bench' FROM ({BENCH_STUDENTS}) s, generate_series(1, 2)"
+    ))
+    db.execute(text(
+        "INSERT INTO chat_messages(session_id, role, content, created_at) "
+        "SELECT cs.id, CASE WHEN g % 2 = 0 THEN 'user' ELSE 'assistant' END, 'Hallo', "
+        "NOW() - INTERVAL '3 days' + g * INTERVAL '2 minutes' "
+        f"FROM chat_sessions cs JOIN ({BENCH_STUDENTS}) s ON s.id = cs.student_id, generate_series(1, 12) g"
+    ))
+    db.execute(text(
+        "INSERT INTO writing_sessions(student_id, session_type, user_text, created_at) "
+        "SELECT s.id, 'free', repeat('Wort ', 20 + (random() * 200)::int), NOW() - random() * INTERVAL '20 days' "
+        f"FROM ({BENCH_STUDENTS}) s, generate_series(1, 3)"
+    ))
+    db.execute(text(
+        "INSERT INTO homeworks(student_id, title, status, submitted_at, score) "
+        "SELECT s.id, 'bench', CASE WHEN random() < 0.7 THEN '已完成' ELSE '未提交' END, "
+        "NOW() - random() * INTERVAL '10 days', 50 + (random() * 50)::numeric(5, 2) "
+        f"FROM ({BENCH_STUDENTS}) s, generate_series(1, 4)"
+    ))
+
+    exercise_id = db.execute(text("SELECT id FROM grammar_exercises ORDER BY id LIMIT 1")).scalar()
+    if exercise_id:
+        db.execute(text(
+            "INSERT INTO grammar_submissions(student_id, exercise_id, user_answer, is_correct, submitted_at) "
+            "SELECT s.id, :exercise_id, 'bench', random() < 0.6, NOW() - random() * INTERVAL '14 days' "
+            f"FROM ({BENCH_STUDENTS}) s, generate_series(1, 10)"
+        ), {"exercise_id": exercise_id})
+    material_id = db.execute(text("SELECT id FROM listening_materials ORDER BY id LIMIT 1")).scalar()
+    if material_id:
+        db.execute(text(
+            "INSERT INTO speaking_evaluations(student_id, material_id, total_score, pronunciation_score, "
+            "fluency_score, intonation_score, evaluated_at) "
+            "SELECT s.id, :material_id, 60 + random() * 40, 60 + random() * 40, 60 + random() * 40, "
+            "60 + random() * 40, NOW() - random() * INTERVAL '14 days' "
+            f"FROM ({BENCH_STUDENTS}) s, generate_series(1, 3)"
+        ), {"material_id": material_id})
+    db.execute(text(
+        "INSERT INTO student_vocab_collections(student_id, vocab_id) "
+        f"SELECT s.id, v.id FROM ({BENCH_STUDENTS}) s, (SELECT id FROM vocabularies ORDER BY id LIMIT 5) v"
+    ))
+    ids = list(db.execute(text(BENCH_STUDENTS + " ORDER BY s.id")).scalars())
+    # 上面直接写原始表,补齐按天汇总
+    ActivityRollupCRUD.rebuild(db, ids)
+    db.commit()
+    return ids
+
+
+def _reset_metrics(db, ids: list[int]) -> None:
+    """两种方式都从"未计算"状态开始,保证写回量相同。"""
+    db.execute(text("DELETE FROM student_abilities WHERE student_id = ANY(:ids)"), {"ids": ids})
+    db.execute(
+        text("UPDATE students SET active_score=0, overall_score=0, weak_point=NULL WHERE id = ANY(:ids)"),
+        {"ids": ids},
+    )
+    db.commit()
+
+
+def _cleanup(db) -> None:
+    db.rollback()
+    # students 及各行为表均 ON DELETE CASCADE
+    db.execute(text("DELETE FROM users WHERE username LIKE :pattern"), {"pattern": f"{PREFIX}%"})
+    db.commit()
+
+
+class _QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *args, **kwargs):
+        self.count += 1
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="学生指标逐个刷新 vs 批量刷新基准")
+    parser.add_argument("--students", type=int, default=1000)
+    parser.add_argument("--keep", action="store_true", help="结束后保留合成数据")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    counter = _QueryCounter()
+    event.listen(engine, "before_cursor_execute", counter)
+    try:
+        _cleanup(db)
+        print(f"生成 {args.students} 个合成学生及其行为数据...")
+        ids = _seed(db, args.students)
+
+        _reset_metrics(db, ids)
+        counter.count = 0
+        t0 = time.perf_counter()
+        legacy = {}
+        for sid in ids:
+            active = refresh_student_active_score(db, sid)
+            perf = refresh_student_performance(db, sid)
+            legacy[sid] = (active, float(perf["overall_score"]), perf["weak_point"])
+        legacy_s = time.perf_counter() - t0
+        legacy_q = counter.count
+        print(f"[旧] 逐个刷新:   {legacy_s:8.2f}s  {legacy_q:7d} 条 SQL")
+
+        _reset_metrics(db, ids)
+        counter.count = 0
+        t0 = time.perf_counter()
+        batch = refresh_student_metrics_batch(db, ids)
+        batch_s = time.perf_counter() - t0
+        batch_q = counter.count
+        print(f"[新] 批量刷新:   {batch_s:8.2f}s  {batch_q:7d} 条 SQL")
+
+        mismatched = [
+            sid for sid in ids
+            if legacy[sid] != (batch[sid]["active_score"], float(batch[sid]["overall_score"]), batch[sid]["weak_point"])
+        ]
+        print(f"\n校验: {len(ids) - len(mismatched)}/{len(ids)} 个学生结果一致, 加速 {legacy_s / batch_s:.1f}x")
+        if mismatched:
+            sid = mismatched[0]
+            print(f"  例: student_id={sid} 旧={legacy[sid]} 新={batch[sid]}")
+
+        counter.count = 0
+        t0 = time.perf_counter()
+        refresh_student_metrics_batch(db, ids)
+        print(f"[新] 无变化再刷新: {time.perf_counter() - t0:6.2f}s  {counter.count:7d} 条 SQL(不产生写入)")
+    finally:
+        event.remove(engine, "before_cursor_execute", counter)
+        if not args.keep:
+            _cleanup(db)
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+测量 PDF 文本提取吞吐（pages/s）：顺序提取 vs 多进程分片提取（services.pdf_extract）。
+
+默认用 PyMuPDF 生成一份合成的德语多页 PDF；也可用 --pdf 指定真实文件（如大词典）。
+不连接数据库、不调用 embedding API。
+
+用法（在 backend 目录）:
+  python scripts/bench_pdf_extract.py
+  python scripts/bench_pdf_extract.py --pages 800 --workers 1 2 4 8
+  python scripts/bench_pdf_extract.py --pdf /path/to/dictionary.pdf --shard-pages 16
+"""
+from __future__ import annotations
+
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+backend_root = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(backend_root))
+
+from services.pdf_extract import (
+    KB_PDF_SHARD_PAGES,
+    _iter_pages_parallel,
+    _iter_pages_sequential,
+    pdf_page_count,
+)
+
+
+_LINES = [
+    "der Konjunktiv II: wäre, hätte, würde + Infinitiv",
+    "gehen, ging, ist gegangen — to go",
+    "das Haus, die Häuser — house",
+    "Wenn ich Zeit hätte, ginge ich ins Kino.",
+    "die Präposition mit + Dativ: mit dem Zug, mit der Bahn",
+    "Er sagt, er sei krank gewesen. (Konjunktiv I)",
+]
+
+
+def _make_pdf(path: Path, pages: int, lines_per_page: int) -> None:
+    import fitz  # PyMuPDF
+
+    doc = fitz.open()
+    for p in range(pages):
+        page = doc.new_page()
+        y = 48
+        for i in range(lines_per_page):
+            page.insert_text((48, y), f"{p + 1}.{i + 1}  {_LINES[(p + i) % len(_LINES)]}", fontsize=9)
+            y += 13
+    doc.save(str(path))
+    doc.close()
+
+
+def _run(path: Path, workers: int, page_count: int, shard_pages: int) -> tuple[float, int]:
+    started = time.perf_counter()
+    if workers <= 1:
+        texts = list(_iter_pages_sequential(path))
+    else:
+        texts = list(_iter_pages_parallel(path, page_count, workers, shard_pages))
+    elapsed = time.perf_counter() - started
+    return elapsed, sum(len(t) for t in texts)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark sequential vs multi-process PDF extraction")
+    parser.add_argument("--pdf", type=Path, default=None, help="existing PDF (default: generate one)")
+    parser.add_argument("--pages", type=int, default=400, help="pages of the synthetic PDF")
+    parser.add_argument("--lines-per-page", type=int, default=55)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--shard-pages", type=int, default=KB_PDF_SHARD_PAGES)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.pdf
+        if path is None:
+            path = Path(tmp) / "synthetic.pdf"
+            print(f"generating {args.pages}-page PDF ...")
+            _make_pdf(path, args.pages, args.lines_per_page)
+        page_count = pdf_page_count(path) or 0
+        if not page_count:
+            print(f"cannot read PDF: {path}")
+            return 1
+        print(f"pdf: {path} ({page_count} pages, shard={args.shard_pages} pages)")
+
+        baseline = None
+        for w in args.workers:
+            elapsed, chars = _run(path, w, page_count, args.shard_pages)
+            if baseline is None:
+                baseline = (elapsed, chars)
+            speedup = baseline[0] / elapsed if elapsed > 0 else 0.0
+            same = "ok" if chars == baseline[1] else f"MISMATCH chars={chars} vs {baseline[1]}"
+            print(
+                f"workers={w:<2}  {elapsed:7.2f}s  {page_count / elapsed:8.1f} pages/s  "
+                f"x{speedup:4.2f}  [{same}]"
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,187 @@
+"""
+流式对话并发压测：对 /api/{student,teacher}/chat/stream 同时打开 N 条 SSE 流。
+
+自带一个本地假 LLM（OpenAI 兼容 /v1/chat/completions，stream=True，按固定间隔吐 token，
+不调用工具），用来排除真实 LLM 的限流与延迟波动，只测后端自身能同时撑住多少条流。
+
+用法（在 backend 目录）:
+  1) 启动假 LLM:
+       python scripts/load_test_chat_stream.py fake-llm --port 9100 --tokens 200 --interval-ms 20
+  2) 让后端指向假 LLM 并启动（单 worker）:
+       LLM_PROVIDER=lmstudio LMSTUDIO_BASE_URL=http://127.0.0.1:9100 uvicorn main:app --port 8000
+  3) 压测:
+       python scripts/load_test_chat_stream.py run --username 2024001 --password 123456 -n 1000
+
+压测时建议设置 ANSWER_CACHE_ENABLED=false，否则同一问题会直接命中语义答案缓存、不经过 LLM。
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import httpx
+
+
+# ─── 假 LLM ───
+
+def _sse_chunk(payload: dict | str) -> bytes:
+    data = payload if isinstance(payload, str) else json.dumps(payload, ensure_ascii=False)
+    body = f"data: {data}\n\n".encode("utf-8")
+    # chunked transfer encoding: <hex 长度>\r\n<数据>\r\n
+    return f"{len(body):x}\r\n".encode() + body + b"\r\n"
+
+
+async def _handle_llm_conn(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, tokens: int, interval: float):
+    try:
+        while True:  # keep-alive:同一连接上可连续处理多个请求
+            head = await reader.readuntil(b"\r\n\r\n")
+            headers = {}
+            for line in head.decode("latin-1").split("\r\n")[1:]:
+                if ":" in line:
+                    k, v = line.split(":", 1)
+                    headers[k.strip().lower()] = v.strip()
+            await reader.readexactly(int(headers.get("content-length", "0")))
+
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/event-stream\r\n"
+                b"Transfer-Encoding: chunked\r\n"
+                b"Connection: keep-alive\r\n\r\n"
+            )
+            for i in range(tokens):
+                writer.write(_sse_chunk({"choices": [{"index": 0, "delta": {"content": f"Wort{i} "}}]}))
+                await writer.drain()
+                await asyncio.sleep(interval)
+            writer.write(_sse_chunk({"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}))
+            writer.write(_sse_chunk({"choices": [], "usage": {"prompt_tokens": 100, "completion_tokens": tokens}}))
+            writer.write(_sse_chunk("[DONE]"))
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _serve_fake_llm(host: str, port: int, tokens: int, interval_ms: float) -> None:
+    server = await asyncio.start_server(
+        lambda r, w: _handle_llm_conn(r, w, tokens, interval_ms / 1000),
+        host, port, backlog=4096,
+    )
+    print(f"fake LLM listening on http://{host}:{port}/v1/chat/completions "
+          f"({tokens} tokens x {interval_ms:.0f} ms ≈ {tokens * interval_ms / 1000:.1f}s per reply)")
+    async with server:
+        await server.serve_forever()
+
+
+# ─── 压测客户端 ───
+
+async def _login(client: httpx.AsyncClient, username: str, password: str) -> str:
+    resp = await client.post("/api/auth/login", json={"username": username, "password": password})
+    body = resp.json()
+    token = body.get("token") or (body.get("data") or {}).get("token")
+    if not token:
+        raise SystemExit(f"login failed: {resp.status_code} {str(body)[:200]}")
+    return token
+
+
+async def _one_stream(client: httpx.AsyncClient, path: str, token: str, message: str, state: dict) -> dict:
+    started = time.perf_counter()
+    first_token = None
+    tokens = 0
+    ok = False
+    try:
+        async with client.stream(
+            "POST", path,
+            json={"message": message, "new_thread": True},
+            headers={"Authorization": f"Bearer {token}"},
+        ) as resp:
+            state["open"] += 1
+            state["peak"] = max(state["peak"], state["open"])
+            event = ""
+            try:
+                async for line in resp.aiter_lines():
+                    if line.startswith("event: "):
+                        event = line[len("event: "):]
+                    elif line.startswith("data: ") and event == "token":
+                        tokens += 1
+                        if first_token is None:
+                            first_token = time.perf_counter() - started
+                    elif line.startswith("data: ") and event == "done":
+                        ok = bool(json.loads(line[len("data: "):]).get("success"))
+            finally:
+                state["open"] -= 1
+    except Exception as e:
+        state["errors"][type(e).__name__] = state["errors"].get(type(e).__name__, 0) + 1
+    return {"ok": ok, "ttft": first_token, "total": time.perf_counter() - started, "tokens": tokens}
+
+
+def _pct(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+async def _run(args) -> int:
+    limits = httpx.Limits(max_connections=args.concurrency + 10, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits) as client:
+        token = await _login(client, args.username, args.password)
+        path = f"/api/{args.role}/chat/stream"
+        state = {"open": 0, "peak": 0, "errors": {}}
+        print(f"opening {args.concurrency} concurrent streams -> {args.base_url}{path}")
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*[
+            _one_stream(client, path, token, f"{args.message} #{i}", state)
+            for i in range(args.concurrency)
+        ])
+        wall = time.perf_counter() - started
+
+    ok = [r for r in results if r["ok"]]
+    ttft = [r["ttft"] for r in ok if r["ttft"] is not None]
+    total = [r["total"] for r in ok]
+    print(f"\nstreams ok: {len(ok)}/{len(results)}   peak open: {state['peak']}   wall: {wall:.1f}s")
+    if state["errors"]:
+        print(f"errors: {state['errors']}")
+    if ok:
+        print(f"first token  p50 {_pct(ttft, 50):6.2f}s  p95 {_pct(ttft, 95):6.2f}s  max {max(ttft or [0]):6.2f}s")
+        print(f"full stream  p50 {_pct(total, 50):6.2f}s  p95 {_pct(total, 95):6.2f}s  max {max(total):6.2f}s")
+        print(f"tokens/stream mean {statistics.mean(r['tokens'] for r in ok):.0f}")
+    return 0 if len(ok) == len(results) else 1
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Concurrent SSE chat stream load test with a fake LLM")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    fake = sub.add_parser("fake-llm", help="run a local OpenAI-compatible streaming LLM stub")
+    fake.add_argument("--host", default="127.0.0.1")
+    fake.add_argument("--port", type=int, default=9100)
+    fake.add_argument("--tokens", type=int, default=200, help="tokens per reply")
+    fake.add_argument("--interval-ms", type=float, default=20.0, help="delay between tokens")
+
+    run = sub.add_parser("run", help="open N concurrent chat streams against the backend")
+    run.add_argument("--base-url", default="http://127.0.0.1:8000")
+    run.add_argument("--username", required=True)
+    run.add_argument("--password", required=True)
+    run.add_argument("--role", choices=["student", "teacher"], default="student")
+    run.add_argument("-n", "--concurrency", type=int, default=200)
+    run.add_argument("--message", default="Wann benutzt man den Dativ?")
+    run.add_argument("--timeout", type=float, default=600.0)
+
+    args = parser.parse_args()
+    if args.cmd == "fake-llm":
+        try:
+            asyncio.run(_serve_fake_llm(args.host, args.port, args.tokens, args.interval_ms))
+        except KeyboardInterrupt:
+            pass
+        return 0
+    return asyncio.run(_run(args))
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,53 @@
+"""
+从原始行为表全量重建 student_metric_stats / student_metric_daily 以及 students 上的积极度、综合评分。
+
+上线增量指标(迁移 20261018_0007)后执行一次做回填;之后日常由写路径事件增量维护,
+后台巡检(METRICS_SWEEP_INTERVAL)每天为每个学生全量重建一次以纠正删除等操作带来的偏差。
+
+用法（在 backend 目录）:
+  python scripts/rebuild_metric_stats.py             # 全部学生
+  python scripts/rebuild_metric_stats.py --batch 500
+"""
+from __future__ import annotations
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+backend_root = Path(__file__).resolve().parent.parent
+repo_root = backend_root.parent
+sys.path.insert(0, str(backend_root))
+
+from dotenv import load_dotenv
+
+load_dotenv(repo_root / ".env")
+load_dotenv(backend_root / ".env")
+
+from sqlalchemy import select
+
+from db.session import SessionLocal
+from models.entities import Student
+from services.metrics import METRICS_BATCH_CHUNK, refresh_student_metrics_batch
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="全量重建学生指标统计表")
+    parser.add_argument("--batch", type=int, default=METRICS_BATCH_CHUNK, help="每批学生数(每批一次提交)")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        ids = list(db.scalars(select(Student.id).order_by(Student.id)))
+        t0 = time.perf_counter()
+        for i in range(0, len(ids), max(1, args.batch)):
+            chunk = ids[i:i + max(1, args.batch)]
+            refresh_student_metrics_batch(db, chunk)
+            print(f"[METRICS] {i + len(chunk)}/{len(ids)}")
+        print(f"[METRICS] 重建完成: {len(ids)} 个学生, {time.perf_counter() - t0:.1f}s")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
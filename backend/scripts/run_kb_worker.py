@@ -0,0 +1,49 @@
+"""
+独立的知识库入库工作进程：消费 kb_ingest_jobs 队列（与 API 进程共享同一数据库）。
+适合把 PDF 解析/向量化从 API 进程剥离，API 进程设置 KB_INGEST_WORKERS=0 即可。
+
+用法（在 backend 目录）:
+  python scripts/run_kb_worker.py            # 线程数取 KB_INGEST_WORKERS（至少 1）
+  python scripts/run_kb_worker.py --workers 4
+"""
+from __future__ import annotations
+
+import argparse
+import logging
+import sys
+import time
+from pathlib import Path
+
+backend_root = Path(__file__).resolve().parent.parent
+repo_root = backend_root.parent
+sys.path.insert(0, str(backend_root))
+
+from dotenv import load_dotenv
+
+load_dotenv(repo_root / ".env")
+load_dotenv(backend_root / ".env")
+
+from services.kb_jobs import KB_INGEST_WORKERS, start_ingest_workers, stop_ingest_workers
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="知识库入库工作进程")
+    parser.add_argument("--workers", type=int, default=max(1, KB_INGEST_WORKERS))
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    n = start_ingest_workers(max(1, args.workers))
+    print(f"[KB-WORKER] {n} 个入库线程已启动，Ctrl+C 退出")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stop_ingest_workers()
+
+
+if __name__ == "__main__":
+    main()
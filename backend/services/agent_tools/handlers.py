@@ -9,6 +9,9 @@
 import logging
 import json
 from services.llm import ai_json
+from services.tool_cache import student_tag
+from services.class_stats import get_class_stats, stats_refreshed_at
+from crud.repositories import ActivityRollupCRUD
 from datetime import datetime, timedelta,date
 from typing import Any
 
@@ -176,22 +179,9 @@ def query_my_recent_activity(args: dict[str, Any], context: dict[str, Any]) -> d
     student_id = context["student_id"]
 
     days = max(1, min(int(args.get("days", 7)), 30))
-    since = datetime.now() - timedelta(days=days)
-
-    # 按模块聚合
-    rows = db.execute(
-        select(
-            LearningSession.module,
-            func.count(LearningSession.id).label("session_count"),
-            func.coalesce(func.sum(LearningSession.duration_minutes), 0).label("total_minutes"),
-        )
-        .where(
-            LearningSession.student_id == student_id,
-            LearningSession.created_at >= since,
-        )
-        .group_by(LearningSession.module)
-        .order_by(desc("total_minutes"))
-    ).all()
+    # 最近 days 个自然日(含今天),按模块读按天汇总
+    since = date.today() - timedelta(days=days - 1)
+    rows = ActivityRollupCRUD.module_summary_since(db, student_id, since)
 
     if not rows:
         return {
@@ -619,6 +609,43 @@ def _teacher_class_ids(db: Session, teacher_user_id: int) -> list[int]:
     ))
 
 
+def teacher_metrics_tags(db: Session, teacher_user_id: int) -> list[str]:
+    """教师分析类工具的缓存失效标签:任教班级内每个学生的 metrics 标签。"""
+    class_ids = _teacher_class_ids(db, teacher_user_id)
+    if not class_ids:
+        return []
+    student_ids = set(db.scalars(
+        select(ClassStudentRelation.student_id).where(ClassStudentRelation.class_id.in_(class_ids))
+    ))
+    return [student_tag(sid, "metrics") for sid in sorted(student_ids)]
+
+
+def _classes_share_students(db: Session, class_ids: list[int]) -> bool:
+    """这些班级之间是否有同一学生。"""
+    total, distinct = db.execute(
+        select(func.count(), func.count(func.distinct(ClassStudentRelation.student_id)))
+        .where(ClassStudentRelation.class_id.in_(class_ids))
+    ).one()
+    return int(total or 0) != int(distinct or 0)
+
+
+def _merge_error_hotspots(rows) -> list[tuple[str, int, int]]:
+    """合并各班预计算的错题热点,返回按错题数降序的 (source, error_count, affected_students)。
+
+    仅在班级之间没有共同学生时使用,此时各班的受影响人数可以直接相加。
+    """
+    merged: dict[str, list[int]] = {}
+    for row in rows:
+        for item in row["error_hotspots"] or []:
+            acc = merged.setdefault(item["source"], [0, 0])
+            acc[0] += int(item["error_count"])
+            acc[1] += int(item["affected_students"])
+    return sorted(
+        ((source, n, affected) for source, (n, affected) in merged.items()),
+        key=lambda x: (-x[1], x[0]),
+    )
+
+
 def query_class_overview(args: dict[str, Any], context: dict[str, Any]) -> dict[str, Any]:
     """查询教师所教全部班级的总览(均分、活跃度、学生数、薄弱点分布)。
     
@@ -644,16 +671,25 @@ def query_class_overview(args: dict[str, Any], context: dict[str, Any]) -> dict[
             "error": f"未找到指定班级'{target_code}'" if target_code else "无班级数据"
         }
     
+    # 读预计算的班级聚合(只读;过期的班级由后台重算,结果带 stats_refreshed_at)
+    stats = get_class_stats(db, [cls.id for cls in classes])
+
     overview = []
+    pending = 0
     for cls in classes:
-        # 班级所有学生
-        students = list(db.scalars(
-            select(Student)
-            .join(ClassStudentRelation, ClassStudentRelation.student_id == Student.id)
-            .where(ClassStudentRelation.class_id == cls.id)
-        ))
-        
-        if not students:
+        row = stats.get(cls.id)
+        if row is None:
+            # 新班级的聚合行尚未生成(后台重算中)
+            pending += 1
+            overview.append({
+                "class_id": cls.id,
+                "class_name": cls.class_name,
+                "class_code": cls.class_code,
+                "student_count": 0,
+            })
+            continue
+        student_count = int(row["student_count"])
+        if not student_count:
             overview.append({
                 "class_id": cls.id,
                 "class_name": cls.class_name,
@@ -663,51 +699,27 @@ def query_class_overview(args: dict[str, Any], context: dict[str, Any]) -> dict[
             })
             continue
         
-        # 取该班所有学生的能力数据
-        student_ids = [s.id for s in students]
-        abilities = list(db.scalars(
-            select(StudentAbility).where(StudentAbility.student_id.in_(student_ids))
-        ))
-        
-        # 聚合四维平均
-        if abilities:
-            avg_listening = sum(a.listening for a in abilities) / len(abilities)
-            avg_speaking = sum(a.speaking for a in abilities) / len(abilities)
-            avg_reading = sum(a.reading for a in abilities) / len(abilities)
-            avg_writing = sum(a.writing for a in abilities) / len(abilities)
-            avg_four_dims = (avg_listening + avg_speaking + avg_reading + avg_writing) / 4
-        else:
-            avg_listening = avg_speaking = avg_reading = avg_writing = avg_four_dims = 0
-        
-        # 薄弱点分布(weak_point 频次统计)
-        weak_distribution: dict[str, int] = {}
-        for s in students:
-            wp = s.weak_point or "未识别"
-            weak_distribution[wp] = weak_distribution.get(wp, 0) + 1
-        
-        # 活跃度:近 7 天有学习记录的学生数
-        seven_days_ago = datetime.now() - timedelta(days=7)
-        active_count = db.scalar(
-            select(func.count(func.distinct(LearningSession.student_id)))
-            .where(
-                LearningSession.student_id.in_(student_ids),
-                LearningSession.created_at >= seven_days_ago,
-            )
-        ) or 0
+        # 四维平均(只统计已有能力画像的学生)
+        avg_listening = float(row["avg_listening"])
+        avg_speaking = float(row["avg_speaking"])
+        avg_reading = float(row["avg_reading"])
+        avg_writing = float(row["avg_writing"])
+        avg_four_dims = (avg_listening + avg_speaking + avg_reading + avg_writing) / 4
+        active_count = int(row["active_students_7d"])
         
         overview.append({
             "class_id": cls.id,
             "class_name": cls.class_name,
             "class_code": cls.class_code,
-            "student_count": len(students),
-            "active_students_7d": int(active_count),
-            "active_rate": round(active_count / len(students) * 100, 1) if students else 0,
+            "student_count": student_count,
+            "active_students_7d": active_count,
+            "active_rate": round(active_count / student_count * 100, 1),
             "avg_listening": round(avg_listening, 1),
             "avg_speaking": round(avg_speaking, 1),
             "avg_reading": round(avg_reading, 1),
             "avg_writing": round(avg_writing, 1),
             "avg_four_dims": round(avg_four_dims, 1),
-            "weak_point_distribution": weak_distribution,
+            "weak_point_distribution": dict(row["weak_point_histogram"] or {}),
         })
     class_items = [ClassOverviewItem(**c) for c in overview]
     return ClassOverviewResult(
@@ -716,7 +728,9 @@ def query_class_overview(args: dict[str, Any], context: dict[str, Any]) -> dict[
         summary=(
             f"共 {len(class_items)} 个班级,"
             + f"总人数 {sum(c.student_count for c in class_items)} 人"
+            + (f",其中 {pending} 个班级统计生成中,请稍后再查" if pending else "")
         ),
+        stats_refreshed_at=stats_refreshed_at(list(stats.values())),
     ).model_dump()
 
     # return {
@@ -913,12 +927,9 @@ def find_struggling_students(args: dict[str, Any], context: dict[str, Any]) -> d
     if not class_ids:
         return {"error": "你没有任教的班级"}
     
-    student_ids = list(db.scalars(
-        select(ClassStudentRelation.student_id).where(
-            ClassStudentRelation.class_id.in_(class_ids)
-        )
-    ))
-    if not student_ids:
+    stats = get_class_stats(db, class_ids)
+    # 学生名单直接查库;聚合只用来提前判断"暂无学生",还没有聚合行时不据此下结论
+    if stats and not any(row["student_count"] for row in stats.values()):
         return {
             "dimension": dimension,
             "threshold": threshold,
@@ -927,50 +938,51 @@ def find_struggling_students(args: dict[str, Any], context: dict[str, Any]) -> d
             "summary": "你任教的班级暂无学生",
         }
     
-    # 取所有学生 + 能力
-    rows = list(db.execute(
-        select(Student, StudentAbility)
-        .outerjoin(StudentAbility, StudentAbility.student_id == Student.id)
-        .where(Student.id.in_(student_ids))
-    ).all())
-    
-    # 按维度筛选低于阈值的
-    struggling = []
-    for student, ability in rows:
-        if dimension == "overall":
-            # 用四维平均(overall_score 字段已知有 bug,这里直接算)
-            if not ability:
-                continue
-            score = (ability.listening + ability.speaking + ability.reading + ability.writing) / 4
-        else:
-            if not ability:
-                continue
-            score = getattr(ability, dimension)
-        
-        if score < threshold:
-            struggling.append({
-                "student_id": student.id,
-                "uid": student.uid,
-                "name": student.name,
-                "score_in_dimension": round(float(score), 1),
-                "weak_point": student.weak_point,
-                "abilities": {
-                    "listening": ability.listening,
-                    "speaking": ability.speaking,
-                    "reading": ability.reading,
-                    "writing": ability.writing,
-                },
-            })
+    # 在数据库里按维度筛选、排序、截断,只取回最薄弱的 limit 人
+    # (overall 用四维平均,overall_score 字段已知有 bug,这里直接算)
+    if dimension == "overall":
+        score_col = (
+            StudentAbility.listening + StudentAbility.speaking
+            + StudentAbility.reading + StudentAbility.writing
+        ) / 4.0
+    else:
+        score_col = getattr(StudentAbility, dimension)
+    rows = db.execute(
+        select(Student, StudentAbility, score_col.label("score"))
+        .join(StudentAbility, StudentAbility.student_id == Student.id)
+        .where(
+            Student.id.in_(
+                select(ClassStudentRelation.student_id).where(ClassStudentRelation.class_id.in_(class_ids))
+            ),
+            score_col < threshold,
+        )
+        .order_by(score_col, Student.id)
+        .limit(limit)
+    ).all()
     
-    # 按分数升序(最薄弱的在前)
-    struggling.sort(key=lambda x: x["score_in_dimension"])
-    struggling = struggling[:limit]
+    struggling = [
+        {
+            "student_id": student.id,
+            "uid": student.uid,
+            "name": student.name,
+            "score_in_dimension": round(float(score), 1),
+            "weak_point": student.weak_point,
+            "abilities": {
+                "listening": ability.listening,
+                "speaking": ability.speaking,
+                "reading": ability.reading,
+                "writing": ability.writing,
+            },
+        }
+        for student, ability, score in rows
+    ]
     
     return {
         "dimension": dimension,
         "threshold": threshold,
         "struggling_count": len(struggling),
         "students": struggling,
+        "stats_refreshed_at": stats_refreshed_at(list(stats.values())),
         "summary": (
             f"在「{dimension}」维度低于 {threshold} 分的学生共 {len(struggling)} 人"
             + (f",最薄弱的是 {struggling[0]['name']}({struggling[0]['score_in_dimension']} 分)"
@@ -1010,38 +1022,52 @@ def recommend_exam_focus(args: dict[str, Any], context: dict[str, Any]) -> dict[
     else:
         analyze_class_ids = class_ids
     
-    # 拿到这些班的学生
-    student_ids = list(db.scalars(
-        select(ClassStudentRelation.student_id).where(
-            ClassStudentRelation.class_id.in_(analyze_class_ids)
-        )
-    ))
-    if not student_ids:
+    stats = get_class_stats(db, analyze_class_ids)
+    # 部分班级还没有聚合行(新建班级/刚迁移,后台重算中)时按班合并会漏掉它们
+    partial = len(stats) < len(set(analyze_class_ids))
+    student_count = sum(int(row["student_count"]) for row in stats.values())
+    if not student_count and not partial:
         return {
             "analyzed_class_count": len(analyze_class_ids),
             "top_error_sources": [],
             "summary": "班级暂无学生",
         }
     
-    # 按 source 聚合错题数
-    rows = db.execute(
-        select(
-            ErrorBookEntry.source,
-            func.count(ErrorBookEntry.id).label("error_count"),
-            func.count(func.distinct(ErrorBookEntry.student_id)).label("affected_students"),
-        )
-        .where(ErrorBookEntry.student_id.in_(student_ids))
-        .group_by(ErrorBookEntry.source)
-        .order_by(desc("error_count"))
-        .limit(top_n)
-    ).all()
+    if partial or (len(stats) > 1 and _classes_share_students(db, list(stats))):
+        # 聚合行不全,或有学生同时在多个班(按班合并会重复计数):直接按学生去重统计
+        student_ids = list(db.scalars(
+            select(func.distinct(ClassStudentRelation.student_id)).where(
+                ClassStudentRelation.class_id.in_(analyze_class_ids)
+            )
+        ))
+        student_count = len(student_ids)
+        if not student_count:
+            return {
+                "analyzed_class_count": len(analyze_class_ids),
+                "top_error_sources": [],
+                "summary": "班级暂无学生",
+            }
+        rows = db.execute(
+            select(
+                ErrorBookEntry.source,
+                func.count(ErrorBookEntry.id).label("error_count"),
+                func.count(func.distinct(ErrorBookEntry.student_id)).label("affected_students"),
+            )
+            .where(ErrorBookEntry.student_id.in_(student_ids))
+            .group_by(ErrorBookEntry.source)
+            .order_by(desc("error_count"))
+            .limit(top_n)
+        ).all()
+    else:
+        rows = _merge_error_hotspots(stats.values())[:top_n]
     
     if not rows:
         return {
             "analyzed_class_count": len(analyze_class_ids),
-            "analyzed_student_count": len(student_ids),
+            "analyzed_student_count": student_count,
             "top_error_sources": [],
             "summary": "暂无错题数据,无法推荐考点",
+            "stats_refreshed_at": stats_refreshed_at(list(stats.values())),
         }
     
     sources = [
@@ -1049,17 +1075,18 @@ def recommend_exam_focus(args: dict[str, Any], context: dict[str, Any]) -> dict[
             "source": source,
             "error_count": int(error_count),
             "affected_students": int(affected_students),
-            "affected_rate": round(affected_students / len(student_ids) * 100, 1),
+            "affected_rate": round(affected_students / student_count * 100, 1),
         }
         for source, error_count, affected_students in rows
     ]
     
     return {
         "analyzed_class_count": len(analyze_class_ids),
-        "analyzed_student_count": len(student_ids),
+        "analyzed_student_count": student_count,
         "top_error_sources": sources,
+        "stats_refreshed_at": stats_refreshed_at(list(stats.values())),
         "summary": (
-            f"分析 {len(student_ids)} 名学生的错题分布,"
+            f"分析 {student_count} 名学生的错题分布,"
             f"建议试卷重点考察方向(按错题频次排):"
             + ", ".join(f"{s['source']}({s['error_count']} 题)" for s in sources)
         ),
@@ -6,13 +6,37 @@
 
 注册后，generate_response_with_tools 会自动把 schemas 发给 Qwen，
 并把 Qwen 选中的工具调用 dispatch 到对应的 handler。
+
+同一轮返回的多个工具调用若都声明为 read_only，由 call_batch / acall_batch 并发执行，
+每个调用在线程池里使用自己的 DB session。
+
+声明了 cache(ToolCachePolicy)的工具,结果按参数 + 调用方身份缓存,见 services.tool_cache。
 """
 
-from typing import Any, Callable
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, AsyncIterator, Callable, Iterator
 from . import handlers
+from db.session import SessionLocal
+from services.tool_cache import (
+    AGENT_TOOL_CACHE_ENABLED,
+    ToolCachePolicy,
+    get_tool_cache,
+    student_tag,
+)
 import logging
 logger = logging.getLogger(__name__)
 
+# 同一轮内并发执行的工具调用数上限(进程共享线程池);<=1 时始终顺序执行
+AGENT_TOOL_PARALLELISM = int(os.getenv("AGENT_TOOL_PARALLELISM", "4"))
+_TOOL_EXECUTOR = ThreadPoolExecutor(
+    max_workers=max(1, AGENT_TOOL_PARALLELISM), thread_name_prefix="agent-tool"
+)
+
+# (工具名, 参数, context) -> 结果;用于在执行外面包一层 trace span 等
+ToolInvoker = Callable[[str, dict[str, Any], dict[str, Any]], Any]
+
 class ToolRegistry:
     """简单的工具注册中心，按名字登记 schema + handler。"""
 
@@ -26,6 +50,8 @@ class ToolRegistry:
         parameters: dict,
         handler: Callable,
         toolsets: list[str] | None = None,
+        read_only: bool = False,
+        cache: ToolCachePolicy | None = None,
     ):
         """注册一个工具。
         
@@ -37,6 +63,8 @@ class ToolRegistry:
             toolsets: 这个工具属于哪些工具集,可多选。
                      可选值: "student" / "teacher" / "common"
                      默认 ["student"](向后兼容)
+            read_only: 只读且不依赖调用顺序(不写库、无副作用),可与同轮其他只读工具并发执行
+            cache: 结果缓存策略(TTL / key / 失效标签),None 表示不缓存
         """
         if toolsets is None:
             toolsets = ["student"]
@@ -51,6 +79,8 @@ class ToolRegistry:
             },
             "handler": handler,
             "toolsets": toolsets,
+            "read_only": read_only,
+            "cache": cache,
         }
 
     def get_schemas(self) -> list[dict[str, Any]]:
@@ -77,6 +107,32 @@ class ToolRegistry:
 
         context 里包含调用方信息（如 student_id、db session），handler 自己解构使用。
         """
+        return self.call_with_cache_status(name, args, context)[0]
+
+    def call_with_cache_status(
+        self, name: str, args: dict[str, Any], context: dict[str, Any]
+    ) -> tuple[dict[str, Any], str | None]:
+        """执行工具并返回 (结果, 缓存状态);缓存状态为 "hit" / "miss",未声明缓存策略时为 None。"""
+        policy = self._tools[name]["cache"] if name in self._tools else None
+        if policy is None or not AGENT_TOOL_CACHE_ENABLED:
+            return self._call(name, args, context), None
+
+        cache = get_tool_cache()
+        key = (name, policy.make_key(args, context))
+        hit, cached = cache.get(key)
+        if hit:
+            return cached, "hit"
+        epoch = cache.epoch
+        result = self._call(name, args, context)
+        if not (isinstance(result, dict) and "error" in result):
+            try:
+                tags = policy.tags(args, context, result) if policy.tags else []
+                cache.put(key, result, policy.ttl, tags, epoch)
+            except Exception as e:
+                logger.warning(f"工具 {name} 缓存写入失败: {type(e).__name__}: {e}")
+        return result, "miss"
+
+    def _call(self, name: str, args: dict[str, Any], context: dict[str, Any]) -> dict[str, Any]:
         if name not in self._tools:
             return {"error": f"unknown tool: {name}"}
         try:
@@ -90,11 +146,91 @@ class ToolRegistry:
             logger.error(f"工具 {name} 执行失败: {type(e).__name__}: {e}", exc_info=True)
             return {"error": f"{type(e).__name__}: {e}"}
 
+    def is_read_only(self, name: str) -> bool:
+        tool = self._tools.get(name)
+        return bool(tool and tool["read_only"])
+
+    def _can_parallelize(self, calls: list[tuple[str, dict[str, Any]]]) -> bool:
+        return (
+            AGENT_TOOL_PARALLELISM > 1
+            and len(calls) > 1
+            and all(self.is_read_only(name) for name, _ in calls)
+        )
+
+    def _invoke_isolated(self, invoke: ToolInvoker, name: str, args: dict[str, Any], context: dict[str, Any]) -> Any:
+        """在独立 DB session 里执行(Session 不能跨线程并发使用)。"""
+        db = SessionLocal()
+        try:
+            return invoke(name, args, {**context, "db": db})
+        finally:
+            db.close()
+
+    def call_batch(
+        self,
+        calls: list[tuple[str, dict[str, Any]]],
+        context: dict[str, Any],
+        invoke: ToolInvoker | None = None,
+    ) -> Iterator[tuple[int, Any]]:
+        """执行同一轮的一批工具调用,产出 (序号, 结果)。
+
+        全部为 read_only 时并发执行、按完成顺序产出;否则在当前线程按原顺序逐个执行
+        (共用 context 里的 db)。invoke 默认为 self.call。
+        """
+        invoke = invoke or self.call
+        if not self._can_parallelize(calls):
+            for i, (name, args) in enumerate(calls):
+                yield i, invoke(name, args, context)
+            return
+        futures = {
+            _TOOL_EXECUTOR.submit(self._invoke_isolated, invoke, name, args, context): i
+            for i, (name, args) in enumerate(calls)
+        }
+        for fut in as_completed(futures):
+            yield futures[fut], fut.result()
+
+    async def acall_batch(
+        self,
+        calls: list[tuple[str, dict[str, Any]]],
+        context: dict[str, Any],
+        invoke: ToolInvoker | None = None,
+    ) -> AsyncIterator[tuple[int, Any]]:
+        """call_batch 的异步版:工具在线程里执行,不阻塞事件循环。"""
+        invoke = invoke or self.call
+        if not self._can_parallelize(calls):
+            for i, (name, args) in enumerate(calls):
+                yield i, await asyncio.to_thread(invoke, name, args, context)
+            return
+        loop = asyncio.get_running_loop()
+
+        async def _one(i: int, name: str, args: dict[str, Any]) -> tuple[int, Any]:
+            return i, await loop.run_in_executor(
+                _TOOL_EXECUTOR, self._invoke_isolated, invoke, name, args, context
+            )
+
+        for coro in asyncio.as_completed([_one(i, n, a) for i, (n, a) in enumerate(calls)]):
+            yield await coro
+
 
 # ─── 全局单例：所有工具在这里注册 ───
 registry = ToolRegistry()
 
 
+def _student_tags(*kinds: str):
+    """学生本人数据类工具的失效标签,由 services.metrics 的写路径失效。"""
+    return lambda args, context, result: [student_tag(context["student_id"], k) for k in kinds]
+
+
+def _teacher_class_tags(args, context, result) -> list[str]:
+    """教师分析类工具:任教班级内任一学生的指标刷新即失效。"""
+    return handlers.teacher_metrics_tags(context["db"], context["teacher_user_id"])
+
+
+_STUDENT_METRICS_CACHE = ToolCachePolicy(ttl=300, tags=_student_tags("metrics"))
+# 档案还含姓名/班级:StudentCRUD.update / set_classes 等写路径失效 "profile"
+_STUDENT_PROFILE_CACHE = ToolCachePolicy(ttl=300, tags=_student_tags("metrics", "profile"))
+_CLASS_ANALYTICS_CACHE = ToolCachePolicy(ttl=120, tags=_teacher_class_tags)
+
+
 registry.register(
     name="query_my_profile",
     description=(
@@ -108,6 +244,8 @@ registry.register(
     },
     handler=handlers.query_my_profile,
     toolsets=["student"],
+    read_only=True,
+    cache=_STUDENT_PROFILE_CACHE,
 )
 
 
@@ -126,6 +264,8 @@ registry.register(
     },
     handler=handlers.query_my_abilities,
     toolsets=["student"],
+    read_only=True,
+    cache=_STUDENT_METRICS_CACHE,
 )
 
 
@@ -150,6 +290,8 @@ registry.register(
     },
     handler=handlers.query_my_recent_activity,
     toolsets=["student"],
+    read_only=True,
+    cache=ToolCachePolicy(ttl=120, tags=_student_tags("activity")),
 )
 
 
@@ -178,6 +320,9 @@ registry.register(
     },
     handler=handlers.query_my_homeworks,
     toolsets=["student"],
+    read_only=True,
+    # 评分/评语不一定改变指标,作业写路径(HomeworkCRUD)单独失效 "homework"
+    cache=ToolCachePolicy(ttl=120, tags=_student_tags("metrics", "homework")),
 )
 
 
@@ -201,6 +346,7 @@ registry.register(
     },
     handler=handlers.query_my_recent_chats,
     toolsets=["student"],
+    read_only=True,
 )
 
 
@@ -230,6 +376,7 @@ registry.register(
     },
     handler=handlers.recommend_grammar_exercises,
     toolsets=["student"],
+    read_only=True,
 )
 
 
@@ -258,6 +405,7 @@ registry.register(
     },
     handler=handlers.search_knowledge_base,
     toolsets=["student","teacher"],
+    read_only=True,
 )
 
 
@@ -281,6 +429,8 @@ registry.register(
     },
     handler=handlers.query_class_overview,
     toolsets=["teacher"],
+    read_only=True,
+    cache=_CLASS_ANALYTICS_CACHE,
 )
 
 
@@ -311,6 +461,8 @@ registry.register(
     },
     handler=handlers.query_student_by_uid,
     toolsets=["teacher"],
+    read_only=True,
+    cache=_CLASS_ANALYTICS_CACHE,
 )
 
 
@@ -345,6 +497,8 @@ registry.register(
     },
     handler=handlers.find_struggling_students,
     toolsets=["teacher"],
+    read_only=True,
+    cache=_CLASS_ANALYTICS_CACHE,
 )
 
 
@@ -372,6 +526,8 @@ registry.register(
     },
     handler=handlers.recommend_exam_focus,
     toolsets=["teacher"],
+    read_only=True,
+    cache=_CLASS_ANALYTICS_CACHE,
 )
 
 
@@ -447,6 +603,7 @@ registry.register(
     },
     handler=handlers.generate_writing_topic,
     toolsets=["teacher"],
+    read_only=True,
 )
 
 
@@ -481,6 +638,7 @@ registry.register(
     },
     handler=handlers.generate_exam_paper,
     toolsets=["teacher"],
+    read_only=True,
 )
 
 
@@ -515,6 +673,7 @@ registry.register(
     },
     handler=handlers.evaluate_student_writing,
     toolsets=["student"],
+    read_only=True,
 )
 
 
@@ -547,4 +706,5 @@ registry.register(
     },
     handler=handlers.generate_daily_learning_plan,
     toolsets=["student"],
+    read_only=True,
 )
\ No newline at end of file
@@ -112,6 +112,7 @@ class ClassOverviewResult(BaseModel):
     total_classes: int = Field(ge=0)
     classes: list[ClassOverviewItem]
     summary: str
+    stats_refreshed_at: str | None = Field(default=None, description="班级聚合的刷新时间(数据新鲜度)")
 
 
 class StudentByUidResult(BaseModel):
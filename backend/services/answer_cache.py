@@ -0,0 +1,232 @@
+"""学生对话的语义答案缓存。
+
+同一个班在作业高峰期会反复问几乎一样的语法问题。对"未调用工具、由公共知识库强命中支撑"
+的回答按问题向量缓存,后续问题与缓存问题的余弦相似度 >= 阈值时直接回放缓存回答,
+不再调用 LLM。
+
+分区键:角色 + toolset + 系统提示词/模型指纹 + 公共知识库版本,任一变化都不会命中旧答案。
+以下情况一律绕过(既不查也不存):
+- 问题涉及本人数据(我的作业/成绩/进度…),这类问题应由 query_my_* 工具实时回答;
+- 会话中已有历史轮次(追问依赖上下文,同一句话含义不同);
+- 回答过程中调用过任何工具、检索结果含私有/会话文档、或 RAG 未强命中。
+
+进程内 LRU + TTL;知识库文档变更时由 invalidate_answer_cache 清空本进程缓存,
+其他进程通过知识库版本号(定期从数据库读取)感知变化。
+"""
+
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Iterator
+
+from sqlalchemy.orm import Session
+
+from crud.repositories import KnowledgeBaseCRUD
+from services.embedding import EMBEDDING_MODEL, embed_text
+
+try:
+    import numpy as np
+except ImportError:  # 可选依赖:未安装时答案缓存不可用
+    np = None
+
+logger = logging.getLogger(__name__)
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+# 问题向量余弦相似度阈值;过低会把"Dativ 和 Akkusativ 的区别"与"Dativ 的用法"当成同一问题
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_SIZE = max(1, int(os.getenv("ANSWER_CACHE_SIZE", "512")))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", str(6 * 3600)))
+# 公共知识库版本号在进程内的缓存秒数(跨进程感知文档变更的最大延迟)
+ANSWER_CACHE_KB_VERSION_TTL = float(os.getenv("ANSWER_CACHE_KB_VERSION_TTL", "30"))
+# 回放时每个 token 事件的字符数
+ANSWER_CACHE_REPLAY_CHARS = max(1, int(os.getenv("ANSWER_CACHE_REPLAY_CHARS", "8")))
+
+# 涉及本人学习数据的问题交给 query_my_* 工具,不走缓存
+_PERSONAL_QUERY_RE = re.compile(
+    r"我的|我(最近|这周|上周|本周|今天|昨天|之前|上次|目前|现在)|"
+    r"作业|成绩|分数|进度|能力|档案|学习记录|学习情况|聊过|"
+    r"\b(mein|meine|meinen|meinem|meiner|my)\b",
+    re.IGNORECASE,
+)
+
+
+def is_personal_query(query: str) -> bool:
+    return bool(_PERSONAL_QUERY_RE.search(query or ""))
+
+
+def cache_scope(role: str, toolset: str | None, system_prompt: str, model: str) -> str:
+    """分区键的静态部分:提示词或模型变了,旧答案自然失效。"""
+    fingerprint = hashlib.sha256(f"{model}\n{system_prompt}".encode("utf-8")).hexdigest()[:16]
+    return f"{role}:{toolset or '-'}:{fingerprint}"
+
+
+class AnswerCache:
+    """按分区存放 (单位化问题向量, 回答);查询时在分区内做一次矩阵点积。"""
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        # entry_id -> (写入时刻, 分区键, 单位向量, 回答, 附加信息)
+        self._data: OrderedDict[int, tuple[float, str, Any, str, dict]] = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.invalidations = 0
+
+    def _expired(self, stored_at: float, now: float) -> bool:
+        return self.ttl_seconds > 0 and now - stored_at > self.ttl_seconds
+
+    def get(self, partition: str, vec) -> tuple[str, dict, float] | None:
+        now = time.monotonic()
+        with self._lock:
+            ids, vecs = [], []
+            for entry_id, (stored_at, part, v, _, _) in list(self._data.items()):
+                if self._expired(stored_at, now):
+                    del self._data[entry_id]
+                elif part == partition:
+                    ids.append(entry_id)
+                    vecs.append(v)
+            if not ids:
+                self.misses += 1
+                return None
+            sims = np.stack(vecs) @ vec
+            best = int(np.argmax(sims))
+            similarity = float(sims[best])
+            if similarity < ANSWER_CACHE_THRESHOLD:
+                self.misses += 1
+                return None
+            entry_id = ids[best]
+            self._data.move_to_end(entry_id)
+            self.hits += 1
+            _, _, _, reply, info = self._data[entry_id]
+            return reply, dict(info), similarity
+
+    def put(self, partition: str, vec, reply: str, info: dict) -> None:
+        with self._lock:
+            self._next_id += 1
+            self._data[self._next_id] = (time.monotonic(), partition, vec, reply, dict(info))
+            self.stores += 1
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self) -> int:
+        with self._lock:
+            n = len(self._data)
+            self._data.clear()
+            self.invalidations += n
+            return n
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "invalidations": self.invalidations,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+_ANSWER_CACHE = AnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL)
+_KB_VERSION: tuple[float, str] | None = None
+_KB_VERSION_LOCK = threading.Lock()
+
+
+def _public_kb_version(db: Session) -> str:
+    global _KB_VERSION
+    now = time.monotonic()
+    with _KB_VERSION_LOCK:
+        if _KB_VERSION is not None and now - _KB_VERSION[0] < ANSWER_CACHE_KB_VERSION_TTL:
+            return _KB_VERSION[1]
+    versions = KnowledgeBaseCRUD.list_public_document_versions(db)
+    raw = "\n".join(f"{doc_id}:{v}" for doc_id, v in sorted(versions.items()))
+    version = hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+    with _KB_VERSION_LOCK:
+        _KB_VERSION = (now, version)
+    return version
+
+
+def _query_vector(query: str):
+    # 与 RAG 检索用同一个 embed_text,问题向量已在 embedding 缓存里,不额外调用 API
+    vec_list, _ = embed_text(query)
+    vec = np.asarray(vec_list, dtype=np.float32)
+    norm = float(np.linalg.norm(vec))
+    return vec / norm if norm > 0 else vec
+
+
+def is_cacheable_turn(query: str, history_turns: int) -> bool:
+    """只有会话首轮、且不涉及本人数据的问题参与缓存。"""
+    return (
+        ANSWER_CACHE_ENABLED
+        and np is not None
+        and history_turns == 0
+        and bool((query or "").strip())
+        and not is_personal_query(query)
+    )
+
+
+def lookup_answer(db: Session, query: str, scope: str) -> dict | None:
+    """命中时返回 {"reply", "similarity", "rag_top_score", "sources"};未命中或出错返回 None。"""
+    try:
+        partition = f"{scope}:{EMBEDDING_MODEL}:{_public_kb_version(db)}"
+        hit = _ANSWER_CACHE.get(partition, _query_vector(query))
+    except Exception as e:
+        logger.warning(f"answer cache lookup failed: {type(e).__name__}: {e}")
+        return None
+    if hit is None:
+        return None
+    reply, info, similarity = hit
+    return {"reply": reply, "similarity": similarity, **info}
+
+
+def store_answer(
+    db: Session,
+    query: str,
+    scope: str,
+    reply: str,
+    rag_top_score: float,
+    rag_sources: list[str],
+) -> bool:
+    """存入缓存;调用方需先确认本轮未调用工具。检索结果含私有文档时不存。"""
+    if not reply or not rag_sources or not all(s.startswith("[公共]") for s in rag_sources):
+        return False
+    try:
+        partition = f"{scope}:{EMBEDDING_MODEL}:{_public_kb_version(db)}"
+        _ANSWER_CACHE.put(
+            partition,
+            _query_vector(query),
+            reply,
+            {"rag_top_score": float(rag_top_score), "sources": list(rag_sources)},
+        )
+        return True
+    except Exception as e:
+        logger.warning(f"answer cache store failed: {type(e).__name__}: {e}")
+        return False
+
+
+def replay_deltas(reply: str) -> Iterator[str]:
+    """把缓存回答切成小段,按 token 事件回放给前端。"""
+    for i in range(0, len(reply), ANSWER_CACHE_REPLAY_CHARS):
+        yield reply[i:i + ANSWER_CACHE_REPLAY_CHARS]
+
+
+def invalidate_answer_cache(doc_ids: list[int] | None = None) -> int:
+    """知识库文档变更后调用:答案无法精确追溯到文档,直接清空本进程缓存并强制刷新版本号。"""
+    global _KB_VERSION
+    with _KB_VERSION_LOCK:
+        _KB_VERSION = None
+    return _ANSWER_CACHE.clear()
+
+
+def answer_cache_stats() -> dict[str, Any]:
+    """返回答案缓存的命中统计(进程级)。"""
+    return _ANSWER_CACHE.stats()
@@ -0,0 +1,108 @@
+"""班级聚合(class_metric_stats)的读取与刷新。
+
+教师分析类工具(query_class_overview / find_struggling_students / recommend_exam_focus)
+读这里的预计算行,而不是每次把全班学生、能力、错题加载进来逐个统计:
+
+- 学生指标写回(services.metrics)和错题写入(ErrorBookService)时把所在班级标记为 dirty;
+- 读取只返回已有的行(不写库,工具可以只读并发执行),连同 refreshed_at 作为数据新鲜度;
+  缺失、dirty 或超过 CLASS_STATS_MAX_AGE 的班级交给后台线程重算,下次读取即为新值;
+- 指标后台巡检顺带重算 dirty 和尚无聚合行的班级。
+"""
+from __future__ import annotations
+
+import logging
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Any
+
+from sqlalchemy.orm import Session
+
+from crud.repositories import ClassMetricStatsCRUD
+
+logger = logging.getLogger(__name__)
+
+# 预计算行的最长有效期(秒):近 7 天活跃人数随时间滑动,超期即使不 dirty 也重算
+CLASS_STATS_MAX_AGE = float(os.getenv("CLASS_STATS_MAX_AGE", "600"))
+CLASS_STATS_ACTIVE_DAYS = 7
+
+
+def _is_stale(row: dict[str, Any] | None, now: datetime) -> bool:
+    if row is None or row["dirty"]:
+        return True
+    refreshed_at = row["refreshed_at"]
+    if refreshed_at.tzinfo is None:
+        refreshed_at = refreshed_at.replace(tzinfo=timezone.utc)
+    return now - refreshed_at > timedelta(seconds=CLASS_STATS_MAX_AGE)
+
+
+def get_class_stats(db: Session, class_ids: list[int]) -> dict[int, dict[str, Any]]:
+    """返回 {class_id: 聚合行},只读;过期的班级登记到后台重算。还没有聚合行的班级不出现在结果里。"""
+    ids = sorted({int(c) for c in class_ids})
+    rows = ClassMetricStatsCRUD.get_many(db, ids)
+    now = datetime.now(timezone.utc)
+    stale = [cid for cid in ids if _is_stale(rows.get(cid), now)]
+    if stale:
+        request_class_stats_rebuild(stale)
+    return rows
+
+
+# ─── 后台重算 ───
+
+_rebuild_lock = threading.Lock()
+_rebuild_pending: set[int] = set()
+_rebuilding = False
+
+
+def request_class_stats_rebuild(class_ids: list[int]) -> None:
+    """登记待重算班级;后台线程至多一个,运行中登记的班级在下一轮一并重算。"""
+    global _rebuilding
+    with _rebuild_lock:
+        _rebuild_pending.update(int(c) for c in class_ids)
+        if _rebuilding:
+            return
+        _rebuilding = True
+    threading.Thread(target=_rebuild_loop, name="class-stats-rebuild", daemon=True).start()
+
+
+def _rebuild_loop() -> None:
+    global _rebuilding
+    from db.session import SessionLocal
+
+    while True:
+        with _rebuild_lock:
+            if not _rebuild_pending:
+                _rebuilding = False
+                return
+            ids = sorted(_rebuild_pending)
+            _rebuild_pending.clear()
+        db = SessionLocal()
+        try:
+            ClassMetricStatsCRUD.rebuild(db, ids, active_days=CLASS_STATS_ACTIVE_DAYS)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.warning(f"class stats rebuild failed for {len(ids)} classes: {type(e).__name__}: {e}")
+        finally:
+            db.close()
+
+
+def stats_refreshed_at(rows: list[dict[str, Any]]) -> str | None:
+    """多行聚合里最早的刷新时间(ISO 格式),作为工具结果的数据新鲜度。"""
+    times = [r["refreshed_at"] for r in rows if r.get("refreshed_at")]
+    return min(times).isoformat() if times else None
+
+
+def refresh_dirty_class_stats(db: Session, limit: int = 500) -> int:
+    """重算被标记为 dirty 的班级,返回重算班级数。"""
+    total = 0
+    while True:
+        ids = ClassMetricStatsCRUD.list_dirty_class_ids(db, limit)
+        if not ids:
+            break
+        ClassMetricStatsCRUD.rebuild(db, ids, active_days=CLASS_STATS_ACTIVE_DAYS)
+        db.commit()
+        total += len(ids)
+        if len(ids) < limit:
+            break
+    return total
@@ -1,8 +1,15 @@
 """
 embedding.py - 调嵌入API把文本变为向量
 """
+import hashlib
+import logging
 import os
-from typing import Any
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable
 
 import requests
 from requests.adapters import HTTPAdapter
@@ -17,33 +24,64 @@ EMBEDDING_API_URL = os.getenv(
 )
 EMBEDDING_TIMEOUT = float(os.getenv("EMBEDDING_TIMEOUT", "120"))
 EMBEDDING_BATCH_SIZE = max(1, int(os.getenv("EMBEDDING_BATCH_SIZE", "16")))
+# 并发批量向量化:同时在途的批次数、自适应批大小下限、限流/超时后的重试次数与退避基数(秒)
+EMBEDDING_CONCURRENCY = max(1, int(os.getenv("EMBEDDING_CONCURRENCY", "4")))
+EMBEDDING_MIN_BATCH_SIZE = max(1, min(EMBEDDING_BATCH_SIZE, int(os.getenv("EMBEDDING_MIN_BATCH_SIZE", "2"))))
+EMBEDDING_THROTTLE_RETRIES = max(0, int(os.getenv("EMBEDDING_THROTTLE_RETRIES", "5")))
+EMBEDDING_THROTTLE_BACKOFF = float(os.getenv("EMBEDDING_THROTTLE_BACKOFF", "1.0"))
+
+logger = logging.getLogger(__name__)
+
+# 查询向量缓存:进程内 LRU(一级) + 可选 Postgres 表 embedding_cache(二级,重启后仍有效)
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+EMBEDDING_CACHE_SIZE = max(1, int(os.getenv("EMBEDDING_CACHE_SIZE", "2048")))
+EMBEDDING_CACHE_TTL = float(os.getenv("EMBEDDING_CACHE_TTL", "86400"))
+EMBEDDING_CACHE_DB_ENABLED = os.getenv("EMBEDDING_CACHE_DB_ENABLED", "false").lower() == "true"
+EMBEDDING_CACHE_DB_TTL_DAYS = int(os.getenv("EMBEDDING_CACHE_DB_TTL_DAYS", "30"))
 
 
 def _session() -> requests.Session:
+    # 429 不在底层重试:交给 embed_texts 的自适应批大小处理(缩批 + 退避),避免各线程各自盲目重放
     retry = Retry(
         total=4,
         connect=3,
-        read=3,
+        read=1,
         backoff_factor=0.8,
-        status_forcelist=(429, 500, 502, 503, 504),
+        status_forcelist=(500, 502, 503, 504),
         allowed_methods=("POST",),
     )
+    adapter = HTTPAdapter(
+        max_retries=retry,
+        pool_connections=EMBEDDING_CONCURRENCY,
+        pool_maxsize=EMBEDDING_CONCURRENCY * 2,
+    )
     s = requests.Session()
-    s.mount("https://", HTTPAdapter(max_retries=retry))
-    s.mount("http://", HTTPAdapter(max_retries=retry))
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
     return s
 
 
 _SESSION: requests.Session | None = None
+_SESSION_LOCK = threading.Lock()
 
 
 def _get_session() -> requests.Session:
     global _SESSION
     if _SESSION is None:
-        _SESSION = _session()
+        with _SESSION_LOCK:
+            if _SESSION is None:
+                _SESSION = _session()
     return _SESSION
 
 
+class EmbeddingThrottled(RuntimeError):
+    """429 / 读超时:服务端压力类错误,应缩小批次并退避重试,而不是拆成单条。"""
+
+
+class EmbeddingNetworkError(RuntimeError):
+    """连不上 API(DNS / 防火墙 / 5xx 重试耗尽等):缩批、拆分都无济于事,直接报错。"""
+
+
 def _vector_to_pg_literal(vec: list[float]) -> str:
     return "[" + ",".join(f"{x:.8f}" for x in vec) + "]"
 
@@ -98,8 +136,13 @@ def _post_embeddings(payload: dict[str, Any]) -> dict[str, Any]:
             headers=headers,
             timeout=(20, EMBEDDING_TIMEOUT),
         )
+        if resp.status_code == 429:
+            raise EmbeddingThrottled(f"embedding 被限流(429): {resp.text[:200]}")
         resp.raise_for_status()
         return resp.json()
+    except requests.exceptions.ReadTimeout as e:
+        # 只有已连上、服务端处理太慢才算限流;连接失败/重试耗尽走下面带排查提示的分支
+        raise EmbeddingThrottled(f"embedding 请求超时: {e!s}") from e
     except requests.exceptions.HTTPError as e:
         body = ""
         if e.response is not None:
@@ -115,39 +158,336 @@ def _post_embeddings(payload: dict[str, Any]) -> dict[str, Any]:
             "请确认本机/服务器能访问 dashscope.aliyuncs.com（公司网络或防火墙可能拦截 HTTPS），"
             "核对 QWEN_API_KEY 是否有效；可稍后点击「重建索引」重试。"
         )
-        raise RuntimeError(f"embedding 网络请求失败: {e!s}。{hint}") from e
+        raise EmbeddingNetworkError(f"embedding 网络请求失败: {e!s}。{hint}") from e
 
 
-def _embed_one_batch(batch: list[str]) -> list[list[float]]:
+def _embed_one_batch(batch: list[str], delay: float = 0.0) -> tuple[list[list[float]], int]:
+    """返回 (向量列表, 本批 token 数);delay>0 时先退避再请求(限流重试)。"""
+    if delay > 0:
+        time.sleep(delay)
     payload: dict[str, Any] = {"model": EMBEDDING_MODEL, "input": batch}
     data = _post_embeddings(payload)
-    return _parse_embedding_response(data, len(batch))
+    usage = data.get("usage") or {}
+    tokens = int(usage.get("total_tokens") or usage.get("prompt_tokens") or 0)
+    return _parse_embedding_response(data, len(batch)), tokens
+
+
+class AdaptiveBatchSizer:
+    """AIMD 批大小控制:连续成功缓慢加 1,遇到限流/超时减半,范围 [min_size, max_size]。"""
+
+    def __init__(self, max_size: int, min_size: int = 1, grow_after: int = 4):
+        self.max_size = max(1, max_size)
+        self.min_size = max(1, min(min_size, self.max_size))
+        self.grow_after = grow_after
+        self._size = self.max_size
+        self._streak = 0
+        self._lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        with self._lock:
+            return self._size
+
+    def on_success(self) -> None:
+        with self._lock:
+            self._streak += 1
+            if self._streak >= self.grow_after and self._size < self.max_size:
+                self._size += 1
+                self._streak = 0
+
+    def on_throttle(self) -> int:
+        with self._lock:
+            self._streak = 0
+            self._size = max(self.min_size, self._size // 2)
+            return self._size
+
+
+# 进程级共享:多个入库任务同时向量化时,在途请求总数仍受 EMBEDDING_CONCURRENCY 约束
+_BATCH_SIZER = AdaptiveBatchSizer(EMBEDDING_BATCH_SIZE, EMBEDDING_MIN_BATCH_SIZE)
+_EMBED_EXECUTOR: ThreadPoolExecutor | None = None
+_EXECUTOR_LOCK = threading.Lock()
+
 
+def _get_executor() -> ThreadPoolExecutor:
+    global _EMBED_EXECUTOR
+    if _EMBED_EXECUTOR is None:
+        with _EXECUTOR_LOCK:
+            if _EMBED_EXECUTOR is None:
+                _EMBED_EXECUTOR = ThreadPoolExecutor(
+                    max_workers=EMBEDDING_CONCURRENCY,
+                    thread_name_prefix="embedding",
+                )
+    return _EMBED_EXECUTOR
 
-def embed_texts(texts: list[str]) -> tuple[list[list[float]], list[str]]:
+
+def embed_texts(
+    texts: list[str],
+    with_literals: bool = True,
+    progress: Callable[[int, int], None] | None = None,
+    stats: dict[str, Any] | None = None,
+) -> tuple[list[list[float]], list[str]]:
     """
     批量调用 embedding API，减少 HTTP 往返，降低 Connection aborted 概率。
     返回 (embedding_list, pgvector_literal 列表)
+
+    with_literals=False 时不生成文本字面量(批量入库走二进制 COPY,无需格式化),第二项为空列表。
+
+    多批时同时保持 EMBEDDING_CONCURRENCY 个批次在途:
+    - 429/超时:缩小批大小,把该批按新大小拆开,退避后重排到队首;
+    - 其它错误(如某条输入非法):对半拆分定位坏输入,单条仍失败才抛出。
+    progress: 可选,每完成一批回调 (已完成数, 总数);stats: 可选,写入吞吐统计。
     """
     if not texts:
         return [], []
-    all_emb: list[list[float]] = []
-    for i in range(0, len(texts), EMBEDDING_BATCH_SIZE):
-        batch = texts[i : i + EMBEDDING_BATCH_SIZE]
+    started = time.perf_counter()
+    total = len(texts)
+    results: list[list[float] | None] = [None] * total
+    counters = {"requests": 0, "throttled": 0, "splits": 0, "tokens": 0}
+    done = 0
+
+    # 待发送片段:(起始下标, 长度, 已限流重试次数)
+    pending: deque[tuple[int, int, int]] = deque()
+    batch_size = _BATCH_SIZER.size
+    for i in range(0, total, batch_size):
+        pending.append((i, min(batch_size, total - i), 0))
+
+    def store(start: int, vecs: list[list[float]]) -> None:
+        nonlocal done
+        results[start : start + len(vecs)] = vecs
+        done += len(vecs)
+        if progress:
+            progress(done, total)
+
+    if len(pending) == 1:
+        # 单批(含检索查询):直接在调用线程执行,不经过线程池
+        start, n, _ = pending.popleft()
+        vecs, tokens = _embed_with_retry(texts[start : start + n], counters)
+        counters["tokens"] += tokens
+        store(start, vecs)
+    else:
+        executor = _get_executor()
+        in_flight: dict[Future, tuple[int, int, int]] = {}
         try:
-            all_emb.extend(_embed_one_batch(batch))
+            while pending or in_flight:
+                while pending and len(in_flight) < EMBEDDING_CONCURRENCY:
+                    start, n, attempt = pending.popleft()
+                    delay = EMBEDDING_THROTTLE_BACKOFF * (2 ** (attempt - 1)) if attempt else 0.0
+                    fut = executor.submit(_embed_one_batch, texts[start : start + n], delay)
+                    in_flight[fut] = (start, n, attempt)
+                    counters["requests"] += 1
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    start, n, attempt = in_flight.pop(fut)
+                    try:
+                        vecs, tokens = fut.result()
+                    except EmbeddingThrottled:
+                        counters["throttled"] += 1
+                        if attempt >= EMBEDDING_THROTTLE_RETRIES:
+                            raise
+                        new_size = _BATCH_SIZER.on_throttle()
+                        parts = [
+                            (start + j, min(new_size, n - j), attempt + 1)
+                            for j in range(0, n, new_size)
+                        ]
+                        pending.extendleft(reversed(parts))
+                        continue
+                    except EmbeddingNetworkError:
+                        raise
+                    except RuntimeError:
+                        if n <= 1:
+                            raise
+                        counters["splits"] += 1
+                        half = n // 2
+                        pending.appendleft((start + half, n - half, attempt))
+                        pending.appendleft((start, half, attempt))
+                        continue
+                    _BATCH_SIZER.on_success()
+                    counters["tokens"] += tokens
+                    store(start, vecs)
+        finally:
+            for fut in in_flight:
+                fut.cancel()
+
+    all_emb = [v for v in results if v is not None]
+    elapsed = time.perf_counter() - started
+    summary = {
+        "texts": total,
+        "tokens": counters["tokens"],
+        "requests": counters["requests"] or 1,
+        "throttled": counters["throttled"],
+        "splits": counters["splits"],
+        "batch_size": _BATCH_SIZER.size,
+        "concurrency": EMBEDDING_CONCURRENCY,
+        "elapsed_ms": round(elapsed * 1000, 1),
+        "texts_per_s": round(total / elapsed, 1) if elapsed > 0 else 0.0,
+        "tokens_per_s": round(counters["tokens"] / elapsed, 1) if elapsed > 0 else 0.0,
+    }
+    if stats is not None:
+        stats.update(summary)
+    if total > EMBEDDING_BATCH_SIZE:
+        logger.info(
+            "embed_texts: %(texts)d texts, %(tokens)d tokens in %(elapsed_ms).0fms "
+            "(%(texts_per_s).1f texts/s, %(tokens_per_s).1f tokens/s, "
+            "requests=%(requests)d throttled=%(throttled)d splits=%(splits)d batch=%(batch_size)d)",
+            summary,
+        )
+    literals = [_vector_to_pg_literal(e) for e in all_emb] if with_literals else []
+    return all_emb, literals
+
+
+def _embed_with_retry(batch: list[str], counters: dict[str, int]) -> tuple[list[list[float]], int]:
+    """单批同步路径:限流时退避重试,其它错误对半拆分。"""
+    attempt = 0
+    while True:
+        counters["requests"] += 1
+        delay = EMBEDDING_THROTTLE_BACKOFF * (2 ** (attempt - 1)) if attempt else 0.0
+        try:
+            return _embed_one_batch(batch, delay)
+        except EmbeddingThrottled:
+            counters["throttled"] += 1
+            if attempt >= EMBEDDING_THROTTLE_RETRIES:
+                raise
+            _BATCH_SIZER.on_throttle()
+            attempt += 1
+        except EmbeddingNetworkError:
+            raise
         except RuntimeError:
             if len(batch) <= 1:
                 raise
-            for t in batch:
-                all_emb.extend(_embed_one_batch([t]))
-    literals = [_vector_to_pg_literal(e) for e in all_emb]
-    return all_emb, literals
+            counters["splits"] += 1
+            half = len(batch) // 2
+            left, lt = _embed_with_retry(batch[:half], counters)
+            right, rt = _embed_with_retry(batch[half:], counters)
+            return left + right, lt + rt
+
+
+def normalize_cache_text(text: str) -> str:
+    """缓存键归一化:Unicode NFC + 折叠空白。不改大小写(德语名词大小写有语义)。"""
+    return " ".join(unicodedata.normalize("NFC", text or "").split())
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """线程安全的 LRU + TTL 向量缓存,键为 (model, 归一化文本)。"""
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._data: OrderedDict[tuple[str, str], tuple[float, list[float], str]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.db_hits = 0
+
+    def get(self, key: tuple[str, str]) -> tuple[list[float], str] | None:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            stored_at, vec, literal = item
+            if self.ttl_seconds > 0 and time.monotonic() - stored_at > self.ttl_seconds:
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return vec, literal
+
+    def put(self, key: tuple[str, str], vec: list[float], literal: str) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic(), vec, literal)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def record_db_hit(self) -> None:
+        with self._lock:
+            self.db_hits += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "db_hits": self.db_hits,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+_QUERY_CACHE = EmbeddingCache(EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_TTL)
+
+
+def embedding_cache_stats() -> dict[str, Any]:
+    """返回查询向量缓存的命中统计(进程级)。"""
+    return _QUERY_CACHE.stats()
+
+
+def _db_cache_get(model: str, key_hash: str) -> tuple[list[float], str] | None:
+    """二级缓存读取。任何数据库异常都视为未命中,不影响主流程。"""
+    try:
+        from crud.repositories import EmbeddingCacheCRUD
+        from db.session import SessionLocal
+
+        db = SessionLocal()
+        try:
+            return EmbeddingCacheCRUD.get(db, model, key_hash, max_age_days=EMBEDDING_CACHE_DB_TTL_DAYS)
+        finally:
+            db.close()
+    except Exception:
+        return None
+
+
+def _db_cache_put(model: str, key_hash: str, literal: str) -> None:
+    try:
+        from crud.repositories import EmbeddingCacheCRUD
+        from db.session import SessionLocal
+
+        db = SessionLocal()
+        try:
+            EmbeddingCacheCRUD.put(db, model, key_hash, literal)
+        finally:
+            db.close()
+    except Exception:
+        pass
 
 
 def embed_text(text: str) -> tuple[list[float], str]:
     """
     返回 (embedding_list, pgvector_literal)
+
+    用于检索查询:先查进程内 LRU,再查可选的数据库二级缓存,都未命中才调 API。
     """
-    embs, literals = embed_texts([text])
+    if not EMBEDDING_CACHE_ENABLED:
+        embs, literals = embed_texts([text])
+        return embs[0], literals[0]
+
+    normalized = normalize_cache_text(text)
+    key = (EMBEDDING_MODEL, normalized)
+    cached = _QUERY_CACHE.get(key)
+    if cached is not None:
+        return cached
+
+    key_hash = text_hash(normalized)
+    if EMBEDDING_CACHE_DB_ENABLED:
+        stored = _db_cache_get(EMBEDDING_MODEL, key_hash)
+        if stored is not None:
+            _QUERY_CACHE.record_db_hit()
+            _QUERY_CACHE.put(key, *stored)
+            return stored
+
+    embs, literals = embed_texts([normalized or text])
+    _QUERY_CACHE.put(key, embs[0], literals[0])
+    if EMBEDDING_CACHE_DB_ENABLED:
+        _db_cache_put(EMBEDDING_MODEL, key_hash, literals[0])
     return embs[0], literals[0]
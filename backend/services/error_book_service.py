@@ -6,6 +6,7 @@ from typing import Any
 from sqlalchemy import select
 from sqlalchemy.orm import Session
 
+from crud.repositories import ClassMetricStatsCRUD
 from models.entities import ErrorBookEntry, ErrorBookCategory
 
 
@@ -55,6 +56,7 @@ class ErrorBookService:
             return 0
 
         count = 0
+        added = 0
         for wq in wrong_questions:
             try:
                 question_text = wq.get("question", "")
@@ -83,7 +85,11 @@ class ErrorBookService:
                         correct_answer=wq.get("correct_answer", ""),
                         analysis=analysis_template or "请参考正确答案复习。",
                     ))
+                    added += 1
                 count += 1
             except Exception as e:
                 logger.warning(f"写入错题失败: {e}")
+        if added:
+            # 错题热点随之变化,与错题一起由调用方提交
+            ClassMetricStatsCRUD.mark_dirty_for_students(db, [student_id])
         return count
\ No newline at end of file
@@ -2,11 +2,28 @@
 kb_ingest.py - 文档提取+切块+入库
 """
 import json
+import os
+from collections.abc import Iterable, Iterator
 from pathlib import Path
+from typing import Callable
 
-from pypdf import PdfReader
+from sqlalchemy.orm import Session
 
-from services.embedding import embed_texts
+from crud.repositories import KnowledgeBaseCRUD
+from db.session import SessionLocal
+from services.embedding import EMBEDDING_MODEL, embed_texts, text_hash
+from services.pdf_extract import iter_pdf_pages, pdf_page_count
+from services.answer_cache import invalidate_answer_cache
+from services.rerank import invalidate_rerank_cache
+from services.vector_index import notify_documents_changed
+
+# 进度回调:(百分比 0-100, 阶段名)
+ProgressCallback = Callable[[int, str], None]
+
+# 流式入库:每攒够这么多 chunk 就向量化并写库一次,内存占用与文档总页数无关
+KB_INGEST_CHUNK_BATCH = max(1, int(os.getenv("KB_INGEST_CHUNK_BATCH", "256")))
+# 纯文本文件按块读取的字符数
+KB_TEXT_READ_BLOCK = 1 << 16
 
 # 与管理员界面展示一致：抽不到文本时的说明
 KB_EMPTY_TEXT_HINT = (
@@ -16,36 +33,36 @@ KB_EMPTY_TEXT_HINT = (
 )
 
 # 1.文本提取
-#   先用 pypdf 提取 -> 失败再用 PyMuPDF 兜底
-#   得到一长串纯文本
-def _extract_text_from_pdf(path: Path) -> str:
-    reader = PdfReader(str(path))
-    pages = []
-    for p in reader.pages:
-        pages.append(p.extract_text() or "")
-    text = "\n".join(pages).strip()
-    if text:
-        return text
-    # 部分 PDF 用 pypdf 抽不到字，PyMuPDF 有时能抽到（仍非 OCR，纯图片页仍为空）
-    try:
-        import fitz  # PyMuPDF
+#   逐段产出 (页码, 文本);PDF 的逐页提取/多进程分片见 services.pdf_extract
+def _iter_plain_text(path: Path) -> Iterator[tuple[int | None, str]]:
+    with path.open("r", encoding="utf-8", errors="ignore") as f:
+        while True:
+            block = f.read(KB_TEXT_READ_BLOCK)
+            if not block:
+                break
+            yield None, block
+
+
+def _is_pdf(path: Path, mime_type: str | None) -> bool:
+    return path.suffix.lower() == ".pdf" or bool(mime_type and "pdf" in mime_type.lower())
+
 
-        doc = fitz.open(path)
-        try:
-            parts = [(page.get_text() or "") for page in doc]
-        finally:
-            doc.close()
-        return "\n".join(parts).strip()
-    except Exception:
-        return ""
+def iter_document_pages(path: Path, mime_type: str | None = None) -> Iterator[tuple[int | None, str]]:
+    """逐段产出 (页码, 文本);纯文本文件页码为 None。各段直接拼接即为全文。"""
+    if _is_pdf(path, mime_type):
+        return iter_pdf_pages(path)
+    return _iter_plain_text(path)
 
 
+def count_document_pages(path: Path, mime_type: str | None = None) -> int | None:
+    """PDF 总页数(用于进度);非 PDF 或无法读取时返回 None。"""
+    if not _is_pdf(path, mime_type):
+        return None
+    return pdf_page_count(path)
+
 
 def extract_text(path: Path, mime_type: str | None = None) -> str:
-    suffix = path.suffix.lower()
-    if suffix == ".pdf" or (mime_type and "pdf" in mime_type.lower()):
-        return _extract_text_from_pdf(path)
-    return path.read_text(encoding="utf-8", errors="ignore")
+    return "".join(text for _, text in iter_document_pages(path, mime_type)).strip()
 
 
 # 新增函数，用以识别pdf的索引页/页码列表
@@ -92,70 +109,240 @@ def _looks_like_index_page(content: str) -> tuple[bool, dict]:
 
 # 2.切块
 #   按 700字符 固定长度切，相邻 chunk 重叠 100 字符
-def chunk_text(text: str, chunk_size: int = 700, overlap: int = 100) -> list[dict]:
-    """将文本切成 chunks。
-    
+#   流式:只在内存里保留当前窗口附近的文本,页码随 chunk 写入 metadata
+def iter_chunks(
+    pages: Iterable[tuple[int | None, str]],
+    chunk_size: int = 700,
+    overlap: int = 100,
+) -> Iterator[dict]:
+    """将逐页文本流切成 chunks。
+
     在原始字符切分基础上，主动识别并丢弃索引页/页码列表噪音。
+    metadata 中 start/end 为全文字符偏移;来自 PDF 时附带 page_start/page_end(从 1 开始)。
     """
-    cleaned = (text or "").replace("\r\n", "\n").strip()
-    if not cleaned:
-        return []
-    chunks: list[dict] = []
+    buf = ""
+    buf_off = 0  # buf[0] 在全文中的偏移
     start = 0
     idx = 0
-    n = len(cleaned)
     skipped_count = 0
-    
-    while start < n:
+    page_marks: list[tuple[int, int | None]] = []  # (该页起始偏移, 页码)
+
+    def page_at(pos: int) -> int | None:
+        page = None
+        for off, no in page_marks:
+            if off > pos:
+                break
+            page = no
+        return page
+
+    def emit(s: int, e: int) -> dict | None:
+        nonlocal idx, skipped_count
+        content = buf[s - buf_off : e - buf_off].strip()
+        if not content:
+            return None
+        # 检测是否是索引页噪音
+        is_index, debug = _looks_like_index_page(content)
+        if is_index:
+            skipped_count += 1
+            preview = content[:60].replace("\n", " ")
+            print(
+                f"[INGEST] skip index page chunk: "
+                f"lines={debug['total_lines']}, "
+                f"short_ratio={debug['short_ratio']:.2f}, "
+                f"num_ratio={debug['ends_with_num_ratio']:.2f} | {preview}",
+                flush=True,
+            )
+            return None
+        meta: dict = {"start": s, "end": e}
+        page_start = page_at(s)
+        if page_start is not None:
+            meta["page_start"] = page_start
+            meta["page_end"] = page_at(max(s, e - 1))
+        chunk = {
+            "chunk_index": idx,
+            "content": content,
+            "token_count": max(1, len(content) // 4),
+            "metadata_json": json.dumps(meta, ensure_ascii=False),
+        }
+        idx += 1
+        return chunk
+
+    def advance(new_start: int) -> None:
+        nonlocal buf, buf_off, start
+        start = new_start
+        buf = buf[start - buf_off :]
+        buf_off = start
+        # 只保留覆盖 start 之后的页标记
+        while len(page_marks) > 1 and page_marks[1][0] <= start:
+            page_marks.pop(0)
+
+    carry = ""  # 上一页末尾的 "\r",可能与下一页开头的 "\n" 组成跨页的 "\r\n"
+    for page_no, text in pages:
+        text = carry + (text or "")
+        carry = ""
+        if text.endswith("\r"):
+            text, carry = text[:-1], "\r"
+        text = text.replace("\r\n", "\n")
+        if not buf and buf_off == 0:
+            # 与整篇 strip() 一致:丢掉文档开头的空白
+            text = text.lstrip()
+            if not text:
+                continue
+        page_marks.append((buf_off + len(buf), page_no))
+        buf += text
+        # 窗口末尾之后还有非空白文本时才切出:恰好到结尾的窗口、以及后面只剩空白
+        # (如空白的末页,收尾时会被 rstrip 掉)的窗口都留给收尾处理,与整篇切分一致
+        tail = buf_off + len(buf.rstrip())
+        while start + chunk_size < tail:
+            end = start + chunk_size
+            chunk = emit(start, end)
+            if chunk:
+                yield chunk
+            advance(max(0, end - overlap))
+
+    buf = (buf + carry).rstrip()
+    n = buf_off + len(buf)
+    while buf and start < n:
         end = min(start + chunk_size, n)
-        content = cleaned[start:end].strip()
-        if content:
-            # 检测是否是索引页噪音
-            is_index, debug = _looks_like_index_page(content)
-            if is_index:
-                skipped_count += 1
-                preview = content[:60].replace("\n", " ")
-                print(
-                    f"[INGEST] skip index page chunk: "
-                    f"lines={debug['total_lines']}, "
-                    f"short_ratio={debug['short_ratio']:.2f}, "
-                    f"num_ratio={debug['ends_with_num_ratio']:.2f} | {preview}",
-                    flush=True,
-                )
-            else:
-                chunks.append(
-                    {
-                        "chunk_index": idx,
-                        "content": content,
-                        "token_count": max(1, len(content) // 4),
-                        "metadata_json": json.dumps(
-                            {"start": start, "end": end}, ensure_ascii=False
-                        ),
-                    }
-                )
-                idx += 1
+        chunk = emit(start, end)
+        if chunk:
+            yield chunk
         if end >= n:
             break
-        start = max(0, end - overlap)
-    
+        advance(max(0, end - overlap))
+
     if skipped_count:
         print(
             f"[INGEST] chunked {idx} content chunks, skipped {skipped_count} index pages",
             flush=True,
         )
-    return chunks
+
+
+def chunk_text(text: str, chunk_size: int = 700, overlap: int = 100) -> list[dict]:
+    """将整段文本切成 chunks(见 iter_chunks)。"""
+    cleaned = (text or "").replace("\r\n", "\n").strip()
+    return list(iter_chunks([(None, cleaned)], chunk_size=chunk_size, overlap=overlap))
 
 
 # 3.向量化
 #   把每个 chunk 调一次阿里云 text-embedding-v3 API
 #   每个 chunk -> 一个 1024 维向量(1024个浮点数)
-def enrich_chunks_with_embeddings(chunks: list[dict]) -> list[dict]:
-    texts = [c["content"] for c in chunks]
-    embeddings, pg_literals = embed_texts(texts)
+#   只保留浮点列表,由 KnowledgeBaseCRUD.append_chunks 按需二进制写入
+def enrich_chunks_with_embeddings(
+    chunks: list[dict],
+    progress: Callable[[int, int], None] | None = None,
+    db: Session | None = None,
+    lookup_db: Session | None = None,
+) -> list[dict]:
+    """为 chunks 补上 embedding / content_hash / embedding_model。
+
+    按正文 sha256 去重:同一文档内重复的片段只嵌入一次;传入 db 时还会复用库里
+    (任意文档)同哈希、同模型的已有向量,重建索引或重复上传同一本教材只为新增/改动的片段调 API。
+    lookup_db: 可选的第二个会话,在 db 中查不到时再查一次(流式重建时 db 已删掉旧 chunks,
+    旧向量只在另一个会话里可见)。
+    progress: 可选,每完成一批回调 (已完成数, 总数)。
+    """
+    hashes = [text_hash(c["content"]) for c in chunks]
+    known: dict[str, list[float]] = {}
+    for session in (db, lookup_db):
+        if session is None or not hashes:
+            continue
+        rest = [h for h in hashes if h not in known]
+        if rest:
+            known.update(KnowledgeBaseCRUD.get_embeddings_by_hash(session, rest, EMBEDDING_MODEL))
+
+    missing: dict[str, str] = {}
+    for h, c in zip(hashes, chunks):
+        if h not in known and h not in missing:
+            missing[h] = c["content"]
+    reused = sum(1 for h in hashes if h in known)
+    total = len(chunks)
+
+    def on_progress(done: int, _n: int) -> None:
+        if progress:
+            progress(min(total, reused + done), total)
+
+    if missing:
+        embeddings, _ = embed_texts(list(missing.values()), with_literals=False, progress=on_progress)
+        known.update(zip(missing.keys(), embeddings))
+    print(
+        f"[INGEST] embeddings: chunks={total}, reused={reused}, "
+        f"embedded={len(missing)}, deduped={total - reused - len(missing)}",
+        flush=True,
+    )
     out = []
-    for i, c in enumerate(chunks):
+    for h, c in zip(hashes, chunks):
         c2 = dict(c)
-        c2["embedding"] = embeddings[i]
-        c2["embedding_vector"] = pg_literals[i]
+        c2["embedding"] = known[h]
+        c2["content_hash"] = h
+        c2["embedding_model"] = EMBEDDING_MODEL
         out.append(c2)
+    if progress:
+        progress(total, total)
     return out
+
+
+class EmptyDocumentError(Exception):
+    """文档抽不到可索引文本(重试无意义)。"""
+
+
+# 4.完整入库流程:逐页提取 → 切块 → 每 KB_INGEST_CHUNK_BATCH 个 chunk 向量化并写库,并维护 kb_documents.status
+#   旧 chunks 的删除与新 chunks 的写入在同一事务内,提交前检索仍看到旧索引
+def ingest_document(db: Session, doc_id: int, progress: ProgressCallback | None = None) -> int:
+    """同步执行一次文档入库,返回写入的 chunk 数。
+
+    失败时把文档置为 failed 并继续抛出异常,由调用方(任务队列)决定是否重试。
+    """
+    def report(pct: int, stage: str) -> None:
+        if progress:
+            progress(pct, stage)
+
+    doc = KnowledgeBaseCRUD.get_document(db, doc_id)
+    if not doc:
+        raise LookupError(f"文档不存在: {doc_id}")
+    path = Path(doc["source_path"])
+    mime_type = doc.get("mime_type")
+    # 另开一个会话查旧向量:主事务删除旧 chunks 后自己看不到它们,这个会话仍能看到已提交的旧数据
+    lookup_db = SessionLocal()
+    try:
+        report(5, "extracting")
+        total_pages = count_document_pages(path, mime_type)
+        KnowledgeBaseCRUD.delete_chunks(db, doc_id)
+        written = 0
+        batch: list[dict] = []
+
+        def flush() -> None:
+            nonlocal written, batch
+            enriched = enrich_chunks_with_embeddings(batch, db=db, lookup_db=lookup_db)
+            KnowledgeBaseCRUD.append_chunks(db, doc_id, enriched)
+            written += len(enriched)
+            last_page = json.loads(enriched[-1]["metadata_json"]).get("page_end")
+            if total_pages and last_page:
+                report(5 + int(85 * last_page / total_pages), "embedding")
+            else:
+                report(30, "embedding")
+            batch = []
+
+        for chunk in iter_chunks(iter_document_pages(path, mime_type)):
+            batch.append(chunk)
+            if len(batch) >= KB_INGEST_CHUNK_BATCH:
+                flush()
+        if batch:
+            flush()
+        if not written:
+            raise EmptyDocumentError(KB_EMPTY_TEXT_HINT)
+        report(90, "writing")
+        db.commit()
+        KnowledgeBaseCRUD.set_document_status(db, doc_id, "ready", None, chunk_count=written)
+        # 状态与 chunk_count 提交后再通知:内存索引按 ready 文档的 updated_at/chunk_count 判断版本
+        invalidate_rerank_cache([doc_id])
+        invalidate_answer_cache([doc_id])
+        notify_documents_changed([doc_id])
+        report(100, "done")
+        return written
+    except Exception as e:
+        db.rollback()
+        KnowledgeBaseCRUD.set_document_status(db, doc_id, "failed", str(e)[:500])
+        raise
+    finally:
+        lookup_db.close()
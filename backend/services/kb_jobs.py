@@ -0,0 +1,230 @@
+"""
+kb_jobs.py - 知识库入库任务队列(数据库表 kb_ingest_jobs + 进程内工作线程池)
+
+上传/重建索引只负责登记任务并立即返回;工作线程用 SELECT ... FOR UPDATE SKIP LOCKED
+抢占任务,多个 uvicorn 进程同时跑也不会重复处理。无需 Redis/Celery 等外部 broker。
+同一文档最多一个 queued/running 任务(部分唯一索引);执行期间再持有按文档的 advisory lock,
+心跳超时被重新排队的任务即使原工作线程还活着,也不会并发入库同一文档。
+
+独立运行入库进程(API 进程可设 KB_INGEST_WORKERS=0): python scripts/run_kb_worker.py
+"""
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from crud.repositories import KbIngestJobCRUD, KnowledgeBaseCRUD
+from db.session import SessionLocal, engine
+from services.kb_ingest import EmptyDocumentError, ingest_document
+
+logger = logging.getLogger(__name__)
+
+# 本进程的入库并发数(0 = 本进程不消费队列)
+KB_INGEST_WORKERS = max(0, int(os.getenv("KB_INGEST_WORKERS", "2")))
+KB_INGEST_MAX_ATTEMPTS = max(1, int(os.getenv("KB_INGEST_MAX_ATTEMPTS", "3")))
+KB_INGEST_RETRY_BACKOFF = float(os.getenv("KB_INGEST_RETRY_BACKOFF", "30"))
+KB_INGEST_POLL_INTERVAL = float(os.getenv("KB_INGEST_POLL_INTERVAL", "2"))
+# running 任务超过该时长没有心跳,视为进程已退出,重新排队
+KB_INGEST_STALE_SECONDS = float(os.getenv("KB_INGEST_STALE_SECONDS", "900"))
+
+
+def enqueue_ingest(db: Session, doc_id: int) -> dict:
+    """登记入库任务,文档状态置为 processing,并唤醒本进程的空闲工作线程。"""
+    KnowledgeBaseCRUD.set_document_status(db, doc_id, "processing", None)
+    job = KbIngestJobCRUD.enqueue(db, doc_id, max_attempts=KB_INGEST_MAX_ATTEMPTS)
+    _wakeup.set()
+    return job
+
+
+def job_status_payload(job: dict | None) -> dict | None:
+    """任务行 → 接口返回结构。"""
+    if not job:
+        return None
+    return {
+        "job_id": job["id"],
+        "document_id": job["document_id"],
+        "status": job["status"],
+        "progress": job["progress"],
+        "stage": job["stage"],
+        "attempts": job["attempts"],
+        "max_attempts": job["max_attempts"],
+        "error_message": job["error_message"],
+        "created_at": job["created_at"].isoformat() if job.get("created_at") else None,
+        "started_at": job["started_at"].isoformat() if job.get("started_at") else None,
+        "finished_at": job["finished_at"].isoformat() if job.get("finished_at") else None,
+    }
+
+
+# advisory lock 键:高 16 位为命名空间,低 48 位为文档 id(BIGSERIAL,不能截断成 INTEGER)
+_INGEST_LOCK_NAMESPACE = 0x4B42  # "KB"
+
+
+def _ingest_lock_key(doc_id: int) -> int:
+    key = (_INGEST_LOCK_NAMESPACE << 48) | (doc_id & ((1 << 48) - 1))
+    return key - (1 << 64) if key >= 1 << 63 else key
+
+
+def run_job(job: dict) -> None:
+    """执行一个已领取的任务(独立 Session),负责进度、重试与终态。"""
+    job_id = int(job["id"])
+    doc_id = int(job["document_id"])
+    # 按文档加会话级 advisory lock,整个入库期间持有;拿不到说明另一个工作线程仍在处理该文档
+    lock_conn = engine.connect()
+    try:
+        locked = lock_conn.execute(
+            text("SELECT pg_try_advisory_lock(CAST(:key AS BIGINT))"),
+            {"key": _ingest_lock_key(doc_id)},
+        ).scalar()
+        lock_conn.commit()
+        if not locked:
+            db = SessionLocal()
+            try:
+                KbIngestJobCRUD.release(db, job_id, KB_INGEST_POLL_INTERVAL)
+            finally:
+                db.close()
+            logger.info(f"kb job {job_id} doc={doc_id} is being ingested elsewhere, released")
+            return
+        try:
+            _run_locked_job(job, job_id, doc_id)
+        finally:
+            lock_conn.execute(
+                text("SELECT pg_advisory_unlock(CAST(:key AS BIGINT))"),
+                {"key": _ingest_lock_key(doc_id)},
+            )
+            lock_conn.commit()
+    finally:
+        lock_conn.close()
+
+
+def _run_locked_job(job: dict, job_id: int, doc_id: int) -> None:
+    db = SessionLocal()
+    progress_db = SessionLocal()
+    last_report = {"at": 0.0, "stage": None}
+
+    def report(pct: int, stage: str) -> None:
+        # 进度写库节流:同一阶段内最多每秒一次,阶段切换时立即写
+        now = time.monotonic()
+        if stage == last_report["stage"] and now - last_report["at"] < 1.0:
+            return
+        last_report["at"], last_report["stage"] = now, stage
+        try:
+            KbIngestJobCRUD.update_progress(progress_db, job_id, pct, stage)
+        except Exception as e:
+            progress_db.rollback()
+            logger.debug(f"kb job {job_id} progress update skipped: {e}")
+
+    try:
+        t0 = time.perf_counter()
+        count = ingest_document(db, doc_id, progress=report)
+        KbIngestJobCRUD.mark_succeeded(db, job_id)
+        logger.info(f"kb job {job_id} doc={doc_id} ingested {count} chunks in {time.perf_counter() - t0:.1f}s")
+    except (EmptyDocumentError, LookupError) as e:
+        KbIngestJobCRUD.mark_failed(db, job_id, str(e))
+        logger.warning(f"kb job {job_id} doc={doc_id} failed permanently: {e}")
+    except Exception as e:
+        db.rollback()
+        attempts = int(job["attempts"])
+        if attempts < int(job["max_attempts"]):
+            delay = KB_INGEST_RETRY_BACKOFF * attempts
+            KnowledgeBaseCRUD.set_document_status(db, doc_id, "processing", None)
+            KbIngestJobCRUD.mark_failed(db, job_id, f"{type(e).__name__}: {e}", retry_delay_seconds=delay)
+            logger.warning(f"kb job {job_id} doc={doc_id} attempt {attempts} failed, retry in {delay:.0f}s: {e}")
+        else:
+            KbIngestJobCRUD.mark_failed(db, job_id, f"{type(e).__name__}: {e}")
+            logger.error(f"kb job {job_id} doc={doc_id} failed after {attempts} attempts: {e}")
+    finally:
+        progress_db.close()
+        db.close()
+
+
+# ─── 工作线程池 ───
+
+_wakeup = threading.Event()
+_stop = threading.Event()
+_threads: list[threading.Thread] = []
+_lock = threading.Lock()
+_requeue_lock = threading.Lock()
+_last_requeue = float("-inf")
+
+
+def _requeue_stale_jobs(force: bool = False) -> None:
+    """心跳超时的 running 任务放回队列;工作线程每 KB_INGEST_STALE_SECONDS 检查一次(进程内只由一个线程执行)。"""
+    global _last_requeue
+    with _requeue_lock:
+        now = time.monotonic()
+        if not force and now - _last_requeue < KB_INGEST_STALE_SECONDS:
+            return
+        _last_requeue = now
+    db = SessionLocal()
+    try:
+        requeued = KbIngestJobCRUD.requeue_stale(db, KB_INGEST_STALE_SECONDS)
+        if requeued:
+            logger.info(f"kb workers: requeued {requeued} stale running jobs")
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"kb workers: requeue stale jobs failed: {type(e).__name__}: {e}")
+    finally:
+        db.close()
+
+
+def _worker_loop(worker_id: str) -> None:
+    while not _stop.is_set():
+        _requeue_stale_jobs()
+        job = None
+        db = SessionLocal()
+        try:
+            job = KbIngestJobCRUD.claim_next(db, worker_id)
+        except Exception as e:
+            db.rollback()
+            logger.warning(f"kb worker {worker_id} claim failed: {type(e).__name__}: {e}")
+        finally:
+            db.close()
+
+        if job is None:
+            _wakeup.wait(KB_INGEST_POLL_INTERVAL)
+            _wakeup.clear()
+            continue
+        try:
+            run_job(job)
+        except Exception as e:
+            # 数据库抖动时加锁/释放/标记失败本身也可能抛错:记日志后继续,任务由心跳超时恢复
+            logger.warning(f"kb worker {worker_id} job {job.get('id')} aborted: {type(e).__name__}: {e}")
+            _stop.wait(KB_INGEST_POLL_INTERVAL)
+
+
+def start_ingest_workers(num_workers: int | None = None) -> int:
+    """启动本进程的入库工作线程(幂等),返回线程数。"""
+    n = KB_INGEST_WORKERS if num_workers is None else max(0, num_workers)
+    with _lock:
+        if _threads or n == 0:
+            return len(_threads)
+        _requeue_stale_jobs(force=True)
+        _stop.clear()
+        prefix = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        for i in range(n):
+            t = threading.Thread(
+                target=_worker_loop,
+                args=(f"{prefix}-{i}",),
+                name=f"kb-ingest-{i}",
+                daemon=True,
+            )
+            t.start()
+            _threads.append(t)
+        logger.info(f"kb workers: started {n} ingest threads")
+        return n
+
+
+def stop_ingest_workers(timeout: float = 5.0) -> None:
+    """通知工作线程退出(正在处理的任务会跑完或由心跳超时恢复)。"""
+    with _lock:
+        _stop.set()
+        _wakeup.set()
+        for t in _threads:
+            t.join(timeout=timeout)
+        _threads.clear()
+
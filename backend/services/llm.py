@@ -1,9 +1,6 @@
 import json
 import os
-import requests
 import logging
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
 
 from crud.repositories import (
     StudentCRUD,
@@ -12,6 +9,7 @@ from crud.repositories import (
     TeacherChatMessageCRUD,
 )
 from db.session import SessionLocal
+from services.llm_transport import LLMHTTPError, LLMTransport
 
 logger = logging.getLogger(__name__)
 
@@ -73,23 +71,6 @@ LMSTUDIO_API_KEY = _env_or_default("LMSTUDIO_API_KEY", "")
 LLM_TIMEOUT = float(_env_or_default("LLM_TIMEOUT", "180"))
 
 
-def _build_http_session() -> requests.Session:
-    retry = Retry(
-        total=3,
-        connect=2,
-        read=2,
-        backoff_factor=0.8,
-        status_forcelist=(429, 500, 502, 503, 504),
-        allowed_methods=("POST",),
-    )
-    s = requests.Session()
-    s.mount("https://", HTTPAdapter(max_retries=retry))
-    s.mount("http://", HTTPAdapter(max_retries=retry))
-    return s
-
-
-_HTTP_SESSION = _build_http_session()
-
 if LLM_PROVIDER == "lmstudio":
     MODEL_ID = _env_or_default("LLM_MODEL", _env_or_default("LMSTUDIO_MODEL", "qwen2.5-7b-instruct"))
     API_URL = f"{LMSTUDIO_BASE_URL}/v1/chat/completions"
@@ -99,6 +80,14 @@ else:
     API_URL = QWEN_API_URL
     API_KEY = QWEN_API_KEY
 
+# 所有 LLM 请求共用的连接池 / 重试 / 计时(见 services.llm_transport)
+_TRANSPORT = LLMTransport(LLM_PROVIDER, API_URL, API_KEY, LLM_TIMEOUT)
+
+
+def llm_transport_stats() -> dict:
+    """返回 LLM 请求的连接复用率、重试次数与 connect/TTFB/total 分位数(进程级)。"""
+    return _TRANSPORT.stats()
+
 logger.info(f"LLM_PROVIDER={LLM_PROVIDER}, MODEL_ID={MODEL_ID}, API_URL={API_URL}")
 if LLM_PROVIDER == "qwen":
     if not API_KEY:
@@ -189,38 +178,22 @@ def generate_response(messages, system_instruction=None, max_tokens: int = 1024)
         "temperature": 0.7,
         "top_p": 0.95
     }
-    headers = {"Content-Type": "application/json"}
-    if API_KEY:
-        headers["Authorization"] = f"Bearer {API_KEY.strip()}"
-
     if _debug_llm_logs_enabled():
-        safe_headers = dict(headers)
-        if "Authorization" in safe_headers:
-            safe_headers["Authorization"] = "Bearer ***"
         logger.debug(f"LLM 请求 URL={API_URL} model={payload.get('model')} messages={len(conversation)}")
     
-    response = None
     try:
         if not API_KEY:
-            logger.error("[API] 错误: QWEN_API_KEY 未配置", flush=True)
+            logger.error("[API] 错误: QWEN_API_KEY 未配置")
             return ""
         
-        response = _HTTP_SESSION.post(
-            API_URL,
-            headers=headers,
-            json=payload,
-            timeout=(20, LLM_TIMEOUT),
-        )
-        response.raise_for_status()
-        data = response.json()
+        data, timing = _TRANSPORT.post_json(payload)
+        logger.debug(f"LLM 请求耗时: {timing}")
         return data.get("choices", [{}])[0].get("message", {}).get("content", "")
+    except LLMHTTPError as e:
+        logger.error(f"LLM 响应异常: status={e.status_code}, body={e.body}")
+        return ""
     except Exception as e:
-        logger.error(f"[API] 调用失败: {type(e).__name__}: {str(e)}", flush=True)
-        try:
-            if response is not None:
-                logger.error(f"LLM 响应异常: status={response.status_code}, body={response.text[:500]}")
-        except Exception:
-            pass
+        logger.error(f"[API] 调用失败: {type(e).__name__}: {str(e)}")
         return ""
 
 
@@ -331,6 +304,7 @@ def get_client():
 import json as _json_for_agent
 
 from services.agent_tools.registry import registry as agent_registry
+from services.tool_cache import get_tool_cache
 
 # 工具显示名映射(用户可见的中文名)
 TOOL_DISPLAY_NAMES = {
@@ -389,8 +363,9 @@ def generate_response_with_tools(
                     "msgs_count": len(msgs),
                     "tool_count": len(tool_schemas),
                 })
+                http_timing: dict = {}
                 try:
-                    data = _call_llm_with_tools(msgs, tool_schemas)
+                    data = _call_llm_with_tools(msgs, tool_schemas, http_timing)
                 except Exception as e:
                     logger.error(f"Agent LLM 调用失败: {type(e).__name__}: {e}")
                     span.mark_failed(f"{type(e).__name__}: {e}")
@@ -408,6 +383,7 @@ def generate_response_with_tools(
                 span.set_output({
                     "finish_reason": finish_reason,
                     "has_tool_calls": bool(msg.get("tool_calls")),
+                    "http": http_timing,
                 })
         else:
             try:
@@ -430,36 +406,20 @@ def generate_response_with_tools(
         logger.info(f"Agent tool_calls: {[tc['function']['name'] for tc in msg['tool_calls']]}")
         msgs.append(msg)
 
-        # ─── 执行每个工具调用(用 trace span 包裹) ───
-        for tc in msg["tool_calls"]:
-            tool_name = tc["function"]["name"]
-            try:
-                tool_args = _json_for_agent.loads(tc["function"]["arguments"])
-            except Exception:
-                tool_args = {}
-
-            tool_calls_used.append({
-                "name": tool_name,
-                "display_name": TOOL_DISPLAY_NAMES.get(tool_name, tool_name),
-                "args": tool_args,
-                "iteration": iteration + 1,
-            })
+        # ─── 执行本轮工具调用(只读工具并发,每个用 trace span 包裹) ───
+        parsed = [_parse_streaming_tool_call(tc, iteration) for tc in msg["tool_calls"]]
+        for _, _, start_event in parsed:
+            tool_calls_used.append({k: start_event[k] for k in ("name", "display_name", "args", "iteration")})
 
-            if trace:
-                with trace.span("tool_call", tool_name) as span:
-                    span.set_input({"args": tool_args, "iteration": iteration + 1})
-                    result = agent_registry.call(tool_name, tool_args, context)
-                    span.set_output({
-                        "keys": list(result.keys()) if isinstance(result, dict) else [],
-                        "has_error": isinstance(result, dict) and "error" in result,
-                    })
-                    if isinstance(result, dict) and "error" in result:
-                        span.mark_failed(str(result.get("error", ""))[:200])
-            else:
-                result = agent_registry.call(tool_name, tool_args, context)
-            
-            logger.info(f"[AGENT-TOOL] {tool_name}({tool_args}) -> {str(result)[:200]}")
+        results: list = [None] * len(parsed)
+        for idx, (result, _, _) in agent_registry.call_batch(
+            [(name, args) for name, args, _ in parsed],
+            context,
+            invoke=lambda name, args, ctx: _run_tool_call(name, args, iteration, ctx, trace),
+        ):
+            results[idx] = result
 
+        for tc, result in zip(msg["tool_calls"], results):
             msgs.append({
                 "role": "tool",
                 "tool_call_id": tc["id"],
@@ -472,7 +432,68 @@ def generate_response_with_tools(
     return "(处理超过最大轮次,请简化问题后重试)", tool_calls_used
 
 
-def generate_response_with_tools_streaming(
+def _parse_streaming_tool_call(tc: dict, iteration: int) -> tuple[str, dict, dict]:
+    """解析一条 tool_call,返回 (工具名, 参数, tool_call_start 事件)。"""
+    tool_name = tc["function"]["name"]
+    try:
+        tool_args = json.loads(tc["function"]["arguments"])
+    except Exception:
+        tool_args = {}
+    return tool_name, tool_args, {
+        "event": "tool_call_start",
+        "name": tool_name,
+        "display_name": TOOL_DISPLAY_NAMES.get(tool_name, tool_name),
+        "args": tool_args,
+        "iteration": iteration + 1,
+    }
+
+
+def _run_tool_call(
+    tool_name: str,
+    tool_args: dict,
+    iteration: int,
+    context: dict,
+    trace=None,
+) -> tuple[dict, str, bool]:
+    """执行工具并记录 trace span,返回 (结果, 给前端的摘要, 是否成功)。
+
+    同步阻塞(工具大多是 DB 查询);由 agent_registry.call_batch / acall_batch 调度,
+    只读工具可能在多个线程里同时执行,context["db"] 此时是各自独立的 session。
+    """
+    # 用 trace 包工具调用
+    tool_span = None
+    if trace:
+        tool_span = trace.span("tool_call", tool_name)
+        tool_span_cm = tool_span.__enter__()
+        tool_span_cm.set_input({"args": tool_args, "iteration": iteration + 1})
+    
+    try:
+        result, cache_status = agent_registry.call_with_cache_status(tool_name, tool_args, context)
+    except Exception as e:
+        result, cache_status = {"error": f"{type(e).__name__}: {e}"}, None
+    
+    # 生成简短摘要给前端展示(避免推 5KB JSON)
+    summary = _summarize_tool_result(result)
+    success = not (isinstance(result, dict) and "error" in result)
+    
+    if trace and tool_span:
+        output = {
+            "keys": list(result.keys()) if isinstance(result, dict) else [],
+            "has_error": not success,
+        }
+        if cache_status:
+            output["cache"] = cache_status
+            output["cache_hit_rate"] = get_tool_cache().hit_rate(tool_name)
+        tool_span_cm.set_output(output)
+        if not success:
+            tool_span_cm.mark_failed(str(result.get("error", ""))[:200])
+        tool_span.__exit__(None, None, None)
+    
+    logger.info(f"[AGENT-TOOL] {tool_name}({tool_args}) -> {str(result)[:200]}")
+    return result, summary, success
+
+
+async def agenerate_response_with_tools_streaming(
     messages: list[dict],
     system_instruction: str | None = None,
     context: dict | None = None,
@@ -480,15 +501,16 @@ def generate_response_with_tools_streaming(
     toolset: str | None = None,
     trace=None,
 ):
-    """流式版的 Agent 主循环。
-    
-    yields 事件 dict,可被外层 endpoint 转为 SSE 推送给前端。
-    
-    yield 的事件类型:
+    """流式版的 Agent 主循环(async generator)。
+
+    yields 事件 dict,可被外层 endpoint 转为 SSE 推送给前端:
         {"event": "tool_call_start", "name": "...", "args": {...}, "iteration": N}
         {"event": "tool_call_done", "name": "...", "success": bool, "summary": "..."}
         {"event": "token", "delta": "..."}
         {"event": "done", "reply": "...", "tool_calls_used": [...]}
+
+    LLM 流在事件循环上用 httpx 异步读取;工具调用(同步 DB 查询)放到线程池执行,
+    不占用事件循环。
     """
     if context is None:
         context = {}
@@ -504,12 +526,10 @@ def generate_response_with_tools_streaming(
         tool_schemas = agent_registry.get_schemas()
     
     tool_calls_used: list[dict] = []
-    final_reply = ""
     
     for iteration in range(max_iterations):
-        logger.info(f"[STREAM] Agent iteration {iteration + 1}/{max_iterations}, msgs={len(msgs)}")
+        logger.info(f"[ASTREAM] Agent iteration {iteration + 1}/{max_iterations}, msgs={len(msgs)}")
         
-        # 用 trace 包裹这次 LLM 调用
         llm_span = None
         if trace:
             llm_span = trace.span("llm_call", f"qwen_iter_{iteration + 1}")
@@ -520,36 +540,31 @@ def generate_response_with_tools_streaming(
                 "streaming": True,
             })
         
-        # 累积本轮 LLM 输出
         iteration_content = ""
         iteration_tool_calls = []
         usage_info = {"input_tokens": 0, "output_tokens": 0}
         finish_reason = ""
+        http_timing: dict = {}
         
         try:
-            for event in _call_llm_with_tools_streaming(msgs, tool_schemas):
+            async for event in _acall_llm_with_tools_streaming(msgs, tool_schemas):
                 etype = event["type"]
                 
                 if etype == "token":
                     iteration_content += event["delta"]
                     yield {"event": "token", "delta": event["delta"]}
-                
                 elif etype == "tool_calls":
                     iteration_tool_calls = event["calls"]
-                    if event.get("content"):
-                        # 部分模型在 tool_calls 前会先输出一段 content,这里累积但不重新 yield
-                        # token 事件已在 token 分支推过
-                        pass
-                
                 elif etype == "usage":
                     usage_info["input_tokens"] = event["input_tokens"]
                     usage_info["output_tokens"] = event["output_tokens"]
-                
                 elif etype == "done":
                     finish_reason = event["finish_reason"]
+                elif etype == "http_timing":
+                    http_timing = {k: v for k, v in event.items() if k != "type"}
         
         except Exception as e:
-            logger.error(f"[STREAM] LLM 调用失败: {type(e).__name__}: {e}", exc_info=True)
+            logger.error(f"[ASTREAM] LLM 调用失败: {type(e).__name__}: {e}", exc_info=True)
             if llm_span:
                 llm_span_cm.mark_failed(f"{type(e).__name__}: {e}")
                 llm_span.__exit__(type(e), e, e.__traceback__)
@@ -564,98 +579,53 @@ def generate_response_with_tools_streaming(
                 llm_span_cm.set_output({
                     "finish_reason": finish_reason,
                     "has_tool_calls": bool(iteration_tool_calls),
+                    "http": http_timing,
                 })
                 llm_span.__exit__(None, None, None)
         
-        # 不调工具,流程结束
         if not iteration_tool_calls:
-            final_reply = iteration_content
             if trace:
                 trace.iterations_used = iteration + 1
             yield {
                 "event": "done",
-                "reply": final_reply,
+                "reply": iteration_content,
                 "tool_calls_used": tool_calls_used,
             }
             return
         
-        # 要调工具——把当前 assistant message 加入 msgs(含 tool_calls)
         msgs.append({
             "role": "assistant",
             "content": iteration_content if iteration_content else None,
             "tool_calls": iteration_tool_calls,
         })
         
-        # 逐个调用工具
-        for tc in iteration_tool_calls:
-            tool_name = tc["function"]["name"]
-            try:
-                tool_args = json.loads(tc["function"]["arguments"])
-            except Exception:
-                tool_args = {}
-            
-            display_name = TOOL_DISPLAY_NAMES.get(tool_name, tool_name)
-            
-            tool_calls_used.append({
-                "name": tool_name,
-                "display_name": display_name,
-                "args": tool_args,
-                "iteration": iteration + 1,
-            })
-            
-            # 推送 tool_call_start 事件
-            yield {
-                "event": "tool_call_start",
-                "name": tool_name,
-                "display_name": display_name,
-                "args": tool_args,
-                "iteration": iteration + 1,
-            }
-            
-            # 用 trace 包工具调用
-            tool_span = None
-            if trace:
-                tool_span = trace.span("tool_call", tool_name)
-                tool_span_cm = tool_span.__enter__()
-                tool_span_cm.set_input({"args": tool_args, "iteration": iteration + 1})
-            
-            try:
-                result = agent_registry.call(tool_name, tool_args, context)
-            except Exception as e:
-                result = {"error": f"{type(e).__name__}: {e}"}
-            
-            # 生成简短摘要给前端展示(避免推 5KB JSON)
-            summary = _summarize_tool_result(result)
-            success = not (isinstance(result, dict) and "error" in result)
-            
-            if trace and tool_span:
-                tool_span_cm.set_output({
-                    "keys": list(result.keys()) if isinstance(result, dict) else [],
-                    "has_error": not success,
-                })
-                if not success:
-                    tool_span_cm.mark_failed(str(result.get("error", ""))[:200])
-                tool_span.__exit__(None, None, None)
-            
-            logger.info(f"[STREAM-TOOL] {tool_name}({tool_args}) -> {str(result)[:200]}")
-            
-            # 推送 tool_call_done 事件
+        parsed = [_parse_streaming_tool_call(tc, iteration) for tc in iteration_tool_calls]
+        for _, _, start_event in parsed:
+            tool_calls_used.append({k: start_event[k] for k in ("name", "display_name", "args", "iteration")})
+            yield start_event
+        
+        results: list = [None] * len(parsed)
+        async for idx, (result, summary, success) in agent_registry.acall_batch(
+            [(name, args) for name, args, _ in parsed],
+            context,
+            invoke=lambda name, args, ctx: _run_tool_call(name, args, iteration, ctx, trace),
+        ):
+            results[idx] = result
             yield {
                 "event": "tool_call_done",
-                "name": tool_name,
+                "name": parsed[idx][0],
                 "success": success,
                 "summary": summary,
             }
-            
-            # 把工具结果加入 msgs(供下一轮 LLM 调用)
+        
+        for tc, result in zip(iteration_tool_calls, results):
             msgs.append({
                 "role": "tool",
                 "tool_call_id": tc["id"],
                 "content": json.dumps(result, ensure_ascii=False),
             })
     
-    # max_iterations reached
-    logger.warning(f"[STREAM] Agent reached max_iterations={max_iterations}")
+    logger.warning(f"[ASTREAM] Agent reached max_iterations={max_iterations}")
     if trace:
         trace.iterations_used = max_iterations
     yield {
@@ -699,44 +669,27 @@ def _summarize_tool_result(result: dict | str) -> str:
 
 
 
-def _call_llm_with_tools(messages: list[dict], tools: list[dict]) -> dict:
+def _call_llm_with_tools(messages: list[dict], tools: list[dict], timing: dict | None = None) -> dict:
     """实际调用 LLM 接口的低层函数,返回原始 JSON。
 
     复用现有的 provider 切换逻辑（API_URL / API_KEY / MODEL_ID 已经是 provider-aware 的）。
+    timing: 传入 dict 时写入本次请求的 connect/TTFB/total 耗时。
     """
-    import requests
-
     payload = {
         "model": MODEL_ID,
         "messages": messages,
         "tools": tools,
     }
-    headers = {
-        "Content-Type": "application/json",
-    }
-    if API_KEY:
-        headers["Authorization"] = f"Bearer {API_KEY.strip()}"
 
     logger.debug(f"Agent-LLM POST {API_URL} model={MODEL_ID}, msgs={len(messages)}, tools={len(tools)}")
 
-    resp = requests.post(API_URL, json=payload, headers=headers, timeout=LLM_TIMEOUT)
-    resp.raise_for_status()
-    return resp.json()
+    data, result = _TRANSPORT.post_json(payload)
+    if timing is not None:
+        timing.update(result)
+    return data
 
 
-def _call_llm_with_tools_streaming(messages: list[dict], tool_schemas: list[dict]):
-    """流式调用 LLM(返回 generator,逐 chunk yield)。
-    
-    yields:
-        {"type": "token", "delta": "..."}        - 输出 token
-        {"type": "tool_calls", "calls": [...]}   - 完整 tool_calls(LLM 决定调工具时)
-        {"type": "done", "finish_reason": "stop"} - 结束
-        {"type": "usage", "input_tokens": N, "output_tokens": M} - 用量(OpenAI 兼容协议返回)
-    
-    DashScope OpenAI 兼容协议的 streaming 行为:
-    - finish_reason="tool_calls" 时,arguments 是分多个 chunk 拼接的
-    - finish_reason="stop" 时,content 是逐 token 流出的
-    """
+def _streaming_payload(messages: list[dict], tool_schemas: list[dict]) -> dict:
     payload = {
         "model": MODEL_ID,
         "messages": messages,
@@ -749,92 +702,118 @@ def _call_llm_with_tools_streaming(messages: list[dict], tool_schemas: list[dict
     }
     if not tool_schemas:
         payload.pop("tools")
-    
-    headers = {"Content-Type": "application/json"}
-    if API_KEY:
-        headers["Authorization"] = f"Bearer {API_KEY.strip()}"
-    
-    # 累积:tool_calls 是分 chunk 拼接的,需要在结束时返回完整对象
-    accumulated_tool_calls: dict[int, dict] = {}
-    accumulated_content = ""
-    
-    with requests.post(
-        API_URL,
-        json=payload,
-        headers=headers,
-        stream=True,
-        timeout=180,
-    ) as resp:
-        if resp.status_code != 200:
-            err_body = resp.text[:500]
-            raise RuntimeError(f"LLM HTTP {resp.status_code}: {err_body}")
-        
-        for line in resp.iter_lines(decode_unicode=True):
-            if not line:
-                continue
-            if not line.startswith("data: "):
-                continue
-            data_str = line[len("data: "):].strip()
-            if data_str == "[DONE]":
-                break
-            
-            try:
-                chunk = json.loads(data_str)
-            except json.JSONDecodeError:
-                logger.warning(f"streaming: 解析 chunk 失败: {data_str[:100]}")
-                continue
-            
-            # 处理 usage(最后一条 chunk 才会有)
-            if chunk.get("usage"):
-                u = chunk["usage"]
-                yield {
-                    "type": "usage",
-                    "input_tokens": u.get("prompt_tokens", 0),
-                    "output_tokens": u.get("completion_tokens", 0),
+    return payload
+
+
+class _StreamChunkParser:
+    """解析 OpenAI 兼容协议的 SSE 行,同步/异步两条流式路径共用。
+
+    DashScope OpenAI 兼容协议的 streaming 行为:
+    - finish_reason="tool_calls" 时,arguments 是分多个 chunk 拼接的
+    - finish_reason="stop" 时,content 是逐 token 流出的
+    """
+
+    def __init__(self):
+        # 累积:tool_calls 是分 chunk 拼接的,需要在结束时返回完整对象
+        self.tool_calls: dict[int, dict] = {}
+        self.content = ""
+        self.finished = False  # 收到 [DONE]
+
+    def feed(self, line: str) -> list[dict]:
+        if not line or not line.startswith("data: "):
+            return []
+        data_str = line[len("data: "):].strip()
+        if data_str == "[DONE]":
+            self.finished = True
+            return []
+
+        try:
+            chunk = json.loads(data_str)
+        except json.JSONDecodeError:
+            logger.warning(f"streaming: 解析 chunk 失败: {data_str[:100]}")
+            return []
+
+        events: list[dict] = []
+        # 处理 usage(最后一条 chunk 才会有)
+        if chunk.get("usage"):
+            u = chunk["usage"]
+            events.append({
+                "type": "usage",
+                "input_tokens": u.get("prompt_tokens", 0),
+                "output_tokens": u.get("completion_tokens", 0),
+            })
+
+        choices = chunk.get("choices", [])
+        if not choices:
+            return events
+
+        choice = choices[0]
+        delta = choice.get("delta", {})
+        finish_reason = choice.get("finish_reason")
+
+        # token content delta
+        content_delta = delta.get("content")
+        if content_delta:
+            self.content += content_delta
+            events.append({"type": "token", "delta": content_delta})
+
+        # tool_calls(分 chunk 拼接)
+        for tc in delta.get("tool_calls", []):
+            idx = tc.get("index", 0)
+            if idx not in self.tool_calls:
+                self.tool_calls[idx] = {
+                    "id": "",
+                    "type": "function",
+                    "function": {"name": "", "arguments": ""},
                 }
-            
-            choices = chunk.get("choices", [])
-            if not choices:
-                continue
-            
-            choice = choices[0]
-            delta = choice.get("delta", {})
-            finish_reason = choice.get("finish_reason")
-            
-            # token content delta
-            content_delta = delta.get("content")
-            if content_delta:
-                accumulated_content += content_delta
-                yield {"type": "token", "delta": content_delta}
-            
-            # tool_calls(分 chunk 拼接)
-            tc_chunks = delta.get("tool_calls", [])
-            for tc in tc_chunks:
-                idx = tc.get("index", 0)
-                if idx not in accumulated_tool_calls:
-                    accumulated_tool_calls[idx] = {
-                        "id": "",
-                        "type": "function",
-                        "function": {"name": "", "arguments": ""},
-                    }
-                
-                if tc.get("id"):
-                    accumulated_tool_calls[idx]["id"] = tc["id"]
-                
-                fn = tc.get("function", {})
-                if fn.get("name"):
-                    accumulated_tool_calls[idx]["function"]["name"] += fn["name"]
-                if fn.get("arguments") is not None:  # 可能是空字符串
-                    accumulated_tool_calls[idx]["function"]["arguments"] += fn["arguments"]
-            
-            # 流结束信号
-            if finish_reason:
-                # 把累积的 tool_calls 返回(如果有)
-                if accumulated_tool_calls:
-                    yield {
-                        "type": "tool_calls",
-                        "calls": [accumulated_tool_calls[i] for i in sorted(accumulated_tool_calls.keys())],
-                        "content": accumulated_content,
-                    }
-                yield {"type": "done", "finish_reason": finish_reason}
-                return
\ No newline at end of file
+
+            if tc.get("id"):
+                self.tool_calls[idx]["id"] = tc["id"]
+
+            fn = tc.get("function", {})
+            if fn.get("name"):
+                self.tool_calls[idx]["function"]["name"] += fn["name"]
+            if fn.get("arguments") is not None:  # 可能是空字符串
+                self.tool_calls[idx]["function"]["arguments"] += fn["arguments"]
+
+        # 流结束信号
+        if finish_reason:
+            # 把累积的 tool_calls 返回(如果有)
+            if self.tool_calls:
+                events.append({
+                    "type": "tool_calls",
+                    "calls": [self.tool_calls[i] for i in sorted(self.tool_calls.keys())],
+                    "content": self.content,
+                })
+            events.append({"type": "done", "finish_reason": finish_reason})
+        return events
+
+
+# ─── 异步流式路径 ───
+# SSE 接口只走异步路径:在事件循环上等 LLM,不会让每条打开的流占住一个线程池线程
+# (最长 LLM_TIMEOUT 秒),只有 DB / 工具调用短暂借用线程池。
+
+async def aclose_async_client() -> None:
+    """应用关闭时调用,释放连接池。"""
+    await _TRANSPORT.aclose()
+    _TRANSPORT.close()
+
+
+async def _acall_llm_with_tools_streaming(messages: list[dict], tool_schemas: list[dict]):
+    """流式调用 LLM,逐 chunk yield:
+
+        {"type": "token", "delta": "..."}        - 输出 token
+        {"type": "tool_calls", "calls": [...]}   - 完整 tool_calls(LLM 决定调工具时)
+        {"type": "done", "finish_reason": "stop"} - 结束
+        {"type": "usage", "input_tokens": N, "output_tokens": M} - 用量(OpenAI 兼容协议返回)
+        {"type": "http_timing", "connect_ms", "ttfb_ms", "total_ms", ...} - 请求计时(流结束后)
+    """
+    parser = _StreamChunkParser()
+    timing: dict = {}
+    async with _TRANSPORT.astream_lines(_streaming_payload(messages, tool_schemas), timing) as lines:
+        async for line in lines:
+            for event in parser.feed(line):
+                yield event
+            if parser.finished:
+                break
+    yield {"type": "http_timing", **timing}
@@ -0,0 +1,350 @@
+"""LLM HTTP 传输层。
+
+所有 LLM 调用(普通补全 / 带工具 / 流式,同步与异步)共用这里的连接池:
+- 进程内各一个 httpx.Client / httpx.AsyncClient,keep-alive 复用 TCP+TLS 连接,池大小可配;
+- 装了 h2 时启用 HTTP/2(多个请求复用同一条连接);
+- 按 provider 的重试/退避策略:只在拿到响应体之前重试(连接失败、429/5xx),流开始后不重试;
+- 请求级计时:connect(新建连接的 TCP+TLS,复用连接为 0)、TTFB(发出请求到收到响应头)、total。
+
+计时通过 httpcore 的 trace 扩展采集,汇总见 llm_transport_stats()。
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Iterator
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+LLM_POOL_SIZE = max(1, int(os.getenv("LLM_POOL_SIZE", "32")))
+# 异步路径承载大量并发 SSE 流,池要大得多
+LLM_ASYNC_POOL_SIZE = max(1, int(os.getenv("LLM_ASYNC_POOL_SIZE", os.getenv("LLM_ASYNC_MAX_CONNECTIONS", "500"))))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "60"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+LLM_HTTP2 = os.getenv("LLM_HTTP2", "true").lower() == "true"
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    max_retries: int
+    backoff: float  # 第 n 次重试前等待 backoff * 2**(n-1) 秒(有 Retry-After 时取其值)
+    max_backoff: float
+    retry_statuses: frozenset[int]
+
+
+# DashScope 会限流(429)且偶发网关错误;本地 LM Studio 基本只有启动中的 502/503
+_DEFAULT_POLICIES = {
+    "qwen": RetryPolicy(3, 0.8, 8.0, frozenset({429, 500, 502, 503, 504})),
+    "lmstudio": RetryPolicy(1, 0.3, 1.0, frozenset({502, 503})),
+}
+
+
+def retry_policy(provider: str) -> RetryPolicy:
+    base = _DEFAULT_POLICIES.get(provider, _DEFAULT_POLICIES["qwen"])
+    return RetryPolicy(
+        max_retries=int(os.getenv("LLM_MAX_RETRIES", str(base.max_retries))),
+        backoff=float(os.getenv("LLM_RETRY_BACKOFF", str(base.backoff))),
+        max_backoff=base.max_backoff,
+        retry_statuses=base.retry_statuses,
+    )
+
+
+class LLMHTTPError(RuntimeError):
+    """重试用尽后仍为非 2xx 响应。"""
+
+    def __init__(self, status_code: int, body: str):
+        super().__init__(f"LLM HTTP {status_code}: {body}")
+        self.status_code = status_code
+        self.body = body
+
+
+# 连接阶段的异常一定没有把请求发出去,可以安全重试;
+# 读超时/协议错误时请求可能已被处理,只对非流式请求重试(与原 urllib3 Retry 的 read=2 一致)
+_RETRY_ALWAYS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+_RETRY_NON_STREAM = (httpx.ReadTimeout, httpx.RemoteProtocolError, httpx.ReadError)
+
+
+def _http2_available() -> bool:
+    if not LLM_HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class _RequestTimer:
+    """httpcore trace 回调:记录连接建立与响应头到达的时刻。"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.connect_started: float | None = None
+        self.connect_done: float | None = None
+        self.headers_done: float | None = None
+
+    def _on(self, event_name: str) -> None:
+        now = time.perf_counter()
+        if event_name == "connection.connect_tcp.started":
+            self.connect_started = now
+        elif event_name in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+            self.connect_done = now
+        elif event_name.endswith("receive_response_headers.complete"):
+            self.headers_done = now
+
+    def __call__(self, event_name: str, info: dict) -> None:
+        self._on(event_name)
+
+    async def atrace(self, event_name: str, info: dict) -> None:
+        self._on(event_name)
+
+    def result(self, attempts: int) -> dict[str, Any]:
+        end = time.perf_counter()
+        reused = self.connect_started is None
+        return {
+            "connect_ms": 0.0 if reused else round(((self.connect_done or end) - self.connect_started) * 1000, 1),
+            "ttfb_ms": round(((self.headers_done or end) - self.started) * 1000, 1),
+            "total_ms": round((end - self.started) * 1000, 1),
+            "reused_connection": reused,
+            "attempts": attempts,
+        }
+
+
+class TransportMetrics:
+    """进程级请求计时汇总,保留最近 window 次请求用于分位数。"""
+
+    def __init__(self, window: int = 1000):
+        self._lock = threading.Lock()
+        self._recent: dict[str, deque] = {
+            k: deque(maxlen=window) for k in ("connect_ms", "ttfb_ms", "total_ms")
+        }
+        self.requests = 0
+        self.reused = 0
+        self.retries = 0
+        self.errors = 0
+
+    def record(self, timing: dict[str, Any]) -> None:
+        with self._lock:
+            self.requests += 1
+            self.reused += int(timing["reused_connection"])
+            self.retries += max(0, timing["attempts"] - 1)
+            for k, q in self._recent.items():
+                q.append(timing[k])
+
+    def record_error(self) -> None:
+        with self._lock:
+            self.errors += 1
+
+    @staticmethod
+    def _pct(values: list[float], pct: float) -> float:
+        if not values:
+            return 0.0
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            out: dict[str, Any] = {
+                "requests": self.requests,
+                "errors": self.errors,
+                "retries": self.retries,
+                "connection_reuse_rate": round(self.reused / self.requests, 4) if self.requests else 0.0,
+            }
+            for k, q in self._recent.items():
+                values = list(q)
+                out[k] = {"p50": self._pct(values, 50), "p95": self._pct(values, 95)}
+            return out
+
+
+class LLMTransport:
+    """一个 provider 端点的共享传输。线程安全;异步方法需在同一个事件循环中使用。"""
+
+    def __init__(self, provider: str, url: str, api_key: str, timeout: float):
+        self.provider = provider
+        self.url = url
+        self.api_key = api_key
+        self.timeout = timeout
+        self.policy = retry_policy(provider)
+        self.http2 = _http2_available()
+        self.metrics = TransportMetrics()
+        self._client: httpx.Client | None = None
+        self._async_client: httpx.AsyncClient | None = None
+        self._lock = threading.Lock()
+
+    # ─── 客户端 ───
+
+    def _timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(self.timeout, connect=LLM_CONNECT_TIMEOUT)
+
+    def _headers(self) -> dict[str, str]:
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key.strip()}"
+        return headers
+
+    @property
+    def client(self) -> httpx.Client:
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = httpx.Client(
+                        http2=self.http2,
+                        timeout=self._timeout(),
+                        limits=httpx.Limits(
+                            max_connections=LLM_POOL_SIZE,
+                            max_keepalive_connections=LLM_POOL_SIZE,
+                            keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+                        ),
+                    )
+        return self._client
+
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(
+                http2=self.http2,
+                timeout=self._timeout(),
+                limits=httpx.Limits(
+                    max_connections=LLM_ASYNC_POOL_SIZE,
+                    max_keepalive_connections=min(LLM_ASYNC_POOL_SIZE, 100),
+                    keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+                ),
+            )
+        return self._async_client
+
+    # ─── 重试 ───
+
+    def _delay(self, attempt: int, resp: httpx.Response | None) -> float:
+        if resp is not None:
+            retry_after = resp.headers.get("retry-after")
+            if retry_after:
+                try:
+                    return min(self.policy.max_backoff, max(0.0, float(retry_after)))
+                except ValueError:
+                    pass
+        return min(self.policy.max_backoff, self.policy.backoff * (2 ** attempt))
+
+    def _should_retry_exc(self, e: Exception, attempt: int, stream: bool) -> bool:
+        if attempt >= self.policy.max_retries:
+            return False
+        return isinstance(e, _RETRY_ALWAYS) or (not stream and isinstance(e, _RETRY_NON_STREAM))
+
+    def _send(self, payload: dict, stream: bool) -> tuple[httpx.Response, _RequestTimer, int]:
+        attempt = 0
+        while True:
+            timer = _RequestTimer()
+            request = self.client.build_request(
+                "POST", self.url, json=payload, headers=self._headers(),
+                extensions={"trace": timer},
+            )
+            try:
+                resp = self.client.send(request, stream=stream)
+            except httpx.TransportError as e:
+                if not self._should_retry_exc(e, attempt, stream):
+                    self.metrics.record_error()
+                    raise
+                delay = self._delay(attempt, None)
+                logger.warning(f"[LLM] {type(e).__name__}, retry {attempt + 1} in {delay:.1f}s")
+            else:
+                if resp.status_code < 400:
+                    return resp, timer, attempt + 1
+                body = (resp.read() if stream else resp.content).decode("utf-8", errors="replace")[:500]
+                resp.close()
+                if resp.status_code not in self.policy.retry_statuses or attempt >= self.policy.max_retries:
+                    self.metrics.record_error()
+                    raise LLMHTTPError(resp.status_code, body)
+                delay = self._delay(attempt, resp)
+                logger.warning(f"[LLM] HTTP {resp.status_code}, retry {attempt + 1} in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+
+    async def _asend(self, payload: dict, stream: bool) -> tuple[httpx.Response, _RequestTimer, int]:
+        attempt = 0
+        while True:
+            timer = _RequestTimer()
+            request = self.async_client.build_request(
+                "POST", self.url, json=payload, headers=self._headers(),
+                extensions={"trace": timer.atrace},
+            )
+            try:
+                resp = await self.async_client.send(request, stream=stream)
+            except httpx.TransportError as e:
+                if not self._should_retry_exc(e, attempt, stream):
+                    self.metrics.record_error()
+                    raise
+                delay = self._delay(attempt, None)
+                logger.warning(f"[LLM] {type(e).__name__}, retry {attempt + 1} in {delay:.1f}s")
+            else:
+                if resp.status_code < 400:
+                    return resp, timer, attempt + 1
+                body = (await resp.aread()).decode("utf-8", errors="replace")[:500]
+                await resp.aclose()
+                if resp.status_code not in self.policy.retry_statuses or attempt >= self.policy.max_retries:
+                    self.metrics.record_error()
+                    raise LLMHTTPError(resp.status_code, body)
+                delay = self._delay(attempt, resp)
+                logger.warning(f"[LLM] HTTP {resp.status_code}, retry {attempt + 1} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    # ─── 对外接口 ───
+
+    def post_json(self, payload: dict) -> tuple[dict, dict[str, Any]]:
+        """非流式请求,返回 (响应 JSON, 计时)。"""
+        resp, timer, attempts = self._send(payload, stream=False)
+        data = resp.json()
+        timing = timer.result(attempts)
+        self.metrics.record(timing)
+        return data, timing
+
+    @contextmanager
+    def stream_lines(self, payload: dict, timing: dict | None = None) -> Iterator[Iterator[str]]:
+        """流式请求,产出逐行迭代器;退出时把计时写入 timing(若传入)。"""
+        resp, timer, attempts = self._send(payload, stream=True)
+        try:
+            yield resp.iter_lines()
+        finally:
+            resp.close()
+            result = timer.result(attempts)
+            self.metrics.record(result)
+            if timing is not None:
+                timing.update(result)
+
+    @asynccontextmanager
+    async def astream_lines(self, payload: dict, timing: dict | None = None) -> AsyncIterator[AsyncIterator[str]]:
+        resp, timer, attempts = await self._asend(payload, stream=True)
+        try:
+            yield resp.aiter_lines()
+        finally:
+            await resp.aclose()
+            result = timer.result(attempts)
+            self.metrics.record(result)
+            if timing is not None:
+                timing.update(result)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "provider": self.provider,
+            "http2": self.http2,
+            "pool_size": LLM_POOL_SIZE,
+            "async_pool_size": LLM_ASYNC_POOL_SIZE,
+            "max_retries": self.policy.max_retries,
+            **self.metrics.stats(),
+        }
+
+    def close(self) -> None:
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    async def aclose(self) -> None:
+        if self._async_client is not None:
+            client, self._async_client = self._async_client, None
+            await client.aclose()
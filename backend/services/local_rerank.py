@@ -0,0 +1,141 @@
+"""本地 CPU 精排。
+
+远程 gte-rerank 超时/不可用时的兜底排序,不依赖网络:
+- features(默认): 候选集内的 BM25F(标题 + 正文,按查询词 idf 总量归一为绝对分)与召回阶段的
+  embedding 余弦相似度加权融合;
+- cross_encoder: 若安装了 sentence-transformers,用小型多语 cross-encoder 打分,加载失败自动退回 features。
+
+由 RAG_LOCAL_RERANKER 选择实现;分数都归一到 [0, 1],返回格式与 services.rerank.rerank 一致。
+"""
+
+import logging
+import math
+import os
+import re
+import threading
+from collections import Counter
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+RAG_LOCAL_RERANKER = os.getenv("RAG_LOCAL_RERANKER", "features").strip().lower()
+# BM25F 与余弦相似度的融合权重(余弦权重 = 1 - 该值)
+RAG_LOCAL_RERANK_BM25_WEIGHT = float(os.getenv("RAG_LOCAL_RERANK_BM25_WEIGHT", "0.5"))
+RAG_LOCAL_RERANK_TITLE_WEIGHT = float(os.getenv("RAG_LOCAL_RERANK_TITLE_WEIGHT", "2.0"))
+RAG_CROSS_ENCODER_MODEL = os.getenv(
+    "RAG_CROSS_ENCODER_MODEL", "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1"
+)
+
+_BM25_K1 = 1.2
+_BM25_B = 0.75
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def _tokenize(text: str) -> list[str]:
+    return [t.lower() for t in _TOKEN_RE.findall(text or "")]
+
+
+def _bm25f_scores(query: str, documents: list[str], titles: list[str]) -> list[float]:
+    """只在候选集内计算 BM25F:idf 与平均长度都取自这几十个候选。
+
+    返回 [0, 1] 的绝对分:BM25F 除以查询词 idf 之和(每个查询词恰好命中一次时为 1,封顶 1)。
+    不按候选集最高分归一,否则只命中 "der" 这类常见词的无关候选也会拿到满分。
+    """
+    q_terms = set(_tokenize(query))
+    if not q_terms or not documents:
+        return [0.0] * len(documents)
+    fields = [
+        ([Counter(_tokenize(d)) for d in documents], 1.0),
+        ([Counter(_tokenize(t)) for t in titles], RAG_LOCAL_RERANK_TITLE_WEIGHT),
+    ]
+    n = len(documents)
+    avg_len = [max(1.0, sum(sum(c.values()) for c in counts) / n) for counts, _ in fields]
+    df = {t: sum(1 for i in range(n) if any(counts[i][t] for counts, _ in fields)) for t in q_terms}
+    idf = {t: math.log(1 + (n - df[t] + 0.5) / (df[t] + 0.5)) for t in q_terms}
+    # 在所有候选里都出现的词 idf 很小,对覆盖度几乎没有贡献;候选里都没有的查询词拉低所有候选
+    idf_mass = sum(idf.values())
+
+    scores = []
+    for i in range(n):
+        s = 0.0
+        for t in q_terms:
+            # 各字段按自身长度归一后加权求和得到伪词频,再套 BM25 饱和函数
+            tf = 0.0
+            for (counts, weight), avg in zip(fields, avg_len):
+                length = sum(counts[i].values())
+                tf += weight * counts[i][t] / (1 - _BM25_B + _BM25_B * length / avg)
+            if tf <= 0:
+                continue
+            s += idf[t] * tf * (_BM25_K1 + 1) / (tf + _BM25_K1)
+        scores.append(min(1.0, s / idf_mass) if idf_mass > 0 else 0.0)
+    return scores
+
+
+def _feature_scores(
+    query: str,
+    documents: list[str],
+    titles: list[str],
+    vector_scores: list[Optional[float]],
+) -> list[float]:
+    bm25 = _bm25f_scores(query, documents, titles)
+    known = [v for v in vector_scores if v is not None]
+    # 只有关键词召回到的候选没有余弦分,按候选集最低值保守处理
+    fill = min(known) if known else 0.0
+    w = RAG_LOCAL_RERANK_BM25_WEIGHT if known else 1.0
+    return [
+        w * b + (1 - w) * max(0.0, min(1.0, fill if v is None else v))
+        for b, v in zip(bm25, vector_scores)
+    ]
+
+
+_CROSS_ENCODER = None
+_CROSS_ENCODER_FAILED = False
+_CROSS_ENCODER_LOCK = threading.Lock()
+
+
+def _get_cross_encoder():
+    global _CROSS_ENCODER, _CROSS_ENCODER_FAILED
+    if _CROSS_ENCODER is not None or _CROSS_ENCODER_FAILED:
+        return _CROSS_ENCODER
+    with _CROSS_ENCODER_LOCK:
+        if _CROSS_ENCODER is None and not _CROSS_ENCODER_FAILED:
+            try:
+                from sentence_transformers import CrossEncoder
+
+                _CROSS_ENCODER = CrossEncoder(RAG_CROSS_ENCODER_MODEL, device="cpu")
+                logger.info(f"local rerank: loaded cross-encoder {RAG_CROSS_ENCODER_MODEL}")
+            except Exception as e:
+                _CROSS_ENCODER_FAILED = True
+                logger.warning(
+                    f"local rerank: cross-encoder unavailable ({type(e).__name__}: {e}), using features"
+                )
+    return _CROSS_ENCODER
+
+
+def local_rerank(
+    query: str,
+    documents: list[str],
+    top_n: int = 5,
+    titles: list[str] | None = None,
+    vector_scores: list[Optional[float]] | None = None,
+) -> list[dict]:
+    """本地精排,返回 [{"index": 原始序号, "score": 0~1}],按分数降序取前 top_n。"""
+    if not query or not documents:
+        return []
+    titles = titles or [""] * len(documents)
+    vector_scores = vector_scores or [None] * len(documents)
+
+    scores: list[float] | None = None
+    if RAG_LOCAL_RERANKER == "cross_encoder":
+        model = _get_cross_encoder()
+        if model is not None:
+            try:
+                raw = model.predict([(query, d) for d in documents])
+                scores = [1 / (1 + math.exp(-float(x))) for x in raw]
+            except Exception as e:
+                logger.warning(f"local rerank: cross-encoder predict failed: {type(e).__name__}: {e}")
+    if scores is None:
+        scores = _feature_scores(query, documents, titles, vector_scores)
+
+    order = sorted(range(len(documents)), key=lambda i: scores[i], reverse=True)
+    return [{"index": i, "score": float(scores[i])} for i in order[:top_n]]
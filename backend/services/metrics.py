@@ -1,11 +1,23 @@
 from __future__ import annotations
 
-from datetime import datetime, timedelta
+import logging
+import os
+import threading
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Any, Iterable
 
 from sqlalchemy import case, func, select
 from sqlalchemy.orm import Session
 
-from crud.repositories import LearningSessionCRUD, StudentAbilityCRUD
+from crud.repositories import (
+    ActivityRollupCRUD,
+    ClassMetricStatsCRUD,
+    LearningSessionCRUD,
+    StudentAbilityCRUD,
+    StudentCRUD,
+    StudentMetricStatsCRUD,
+)
 from models.entities import (
     ChatMessage,
     ChatSession,
@@ -17,6 +29,15 @@ from models.entities import (
     WritingSession,
 )
 from schemas.entities import LearningSessionCreate, StudentAbilityUpsert
+from services.tool_cache import invalidate_tool_cache, student_tag
+
+logger = logging.getLogger(__name__)
+
+# 积极度练习次数的统计窗口(自然日)
+METRICS_WINDOW_DAYS = 7
+# 后台巡检间隔(秒):重算积极度不是今天算的学生(窗口滑动/本周时长清零),并为没有统计行的学生回填;0 关闭
+METRICS_SWEEP_INTERVAL = float(os.getenv("METRICS_SWEEP_INTERVAL", "900"))
+METRICS_SWEEP_BATCH = max(1, int(os.getenv("METRICS_SWEEP_BATCH", "500")))
 
 
 def parse_duration_minutes(duration_text: str | None) -> int:
@@ -45,8 +66,12 @@ def track_learning_activity(
     module: str,
     duration_minutes: int,
     content: str | None = None,
+    session_date: datetime | None = None,
 ) -> None:
-    """记录学习行为到 learning_sessions，作为后续统计的数据来源。"""
+    """记录学习行为到 learning_sessions，作为后续统计的数据来源。
+
+    session_date 为行为发生时间,延后写入时由调用方传入;缺省为当前时间。
+    """
     if duration_minutes <= 0:
         return
     LearningSessionCRUD.create(
@@ -56,32 +81,25 @@ def track_learning_activity(
             module=module,
             duration_minutes=duration_minutes,
             content=content,
-            session_date=datetime.now(),
+            session_date=session_date or datetime.now(),
         ),
     )
+    invalidate_tool_cache(student_tag(student_id, "activity"))
 
 
 def compute_student_interaction_minutes(db: Session, student_id: int, days: int = 7) -> int:
-    """按会话真实时间跨度统计互动时长，并结合用户发言数做下限保护。"""
-    cutoff = datetime.utcnow() - timedelta(days=days)
+    """按会话真实时间跨度统计互动时长，并结合用户发言数做下限保护。
+
+    读 student_chat_daily 的按天汇总,窗口为最近 days 个自然日。
+    """
+    rows = ActivityRollupCRUD.chat_session_spans(db, [student_id], _window_start(days))
+    return _interaction_minutes_from_sessions([(first_ts, last_ts, user_count) for _, first_ts, last_ts, user_count in rows])
 
-    rows = db.execute(
-        select(
-            ChatMessage.session_id,
-            func.min(ChatMessage.created_at).label("first_ts"),
-            func.max(ChatMessage.created_at).label("last_ts"),
-            func.sum(case((ChatMessage.role == "user", 1), else_=0)).label("user_count"),
-        )
-        .join(ChatSession, ChatSession.id == ChatMessage.session_id)
-        .where(
-            ChatSession.student_id == student_id,
-            ChatMessage.created_at >= cutoff,
-        )
-        .group_by(ChatMessage.session_id)
-    ).all()
 
+def _interaction_minutes_from_sessions(rows: Iterable[tuple[Any, Any, Any]]) -> int:
+    """rows: 每个会话的 (首条消息时间, 末条消息时间, 用户发言数)。"""
     total_minutes = 0
-    for _, first_ts, last_ts, user_count in rows:
+    for first_ts, last_ts, user_count in rows:
         if not first_ts or not last_ts:
             continue
         span_minutes = int(max(0, (last_ts - first_ts).total_seconds()) // 60)
@@ -92,9 +110,29 @@ def compute_student_interaction_minutes(db: Session, student_id: int, days: int
     return total_minutes
 
 
+def _active_score_from(
+    week_minutes: int,
+    interaction_minutes: int,
+    grammar_cnt: int,
+    speaking_cnt: int,
+    writing_cnt: int,
+    homework_cnt: int,
+) -> int:
+    time_score = min(55, week_minutes * 0.65)
+    interaction_score = min(25, interaction_minutes * 0.5)
+    practice_score = min(20, grammar_cnt * 2 + speaking_cnt * 4 + writing_cnt * 3 + homework_cnt * 3)
+
+    return int(round(min(100, time_score + interaction_score + practice_score)))
+
+
+def _window_start(days: int) -> date:
+    """练习次数窗口的起始日:最近 days 个自然日(含今天),与 student_metric_daily 的按天计数一致。"""
+    return date.today() - timedelta(days=days - 1)
+
+
 def compute_student_active_score(db: Session, student_id: int, days: int = 7) -> int:
     """根据最近学习行为自动计算积极度，范围 0-100。"""
-    cutoff = datetime.utcnow() - timedelta(days=days)
+    cutoff = datetime.combine(_window_start(days), datetime.min.time())
 
     week_minutes = LearningSessionCRUD.week_minutes(db, student_id)
     interaction_minutes = compute_student_interaction_minutes(db, student_id, days=days)
@@ -125,11 +163,7 @@ def compute_student_active_score(db: Session, student_id: int, days: int = 7) ->
         )
     ) or 0
 
-    time_score = min(55, week_minutes * 0.65)
-    interaction_score = min(25, interaction_minutes * 0.5)
-    practice_score = min(20, grammar_cnt * 2 + speaking_cnt * 4 + writing_cnt * 3 + homework_cnt * 3)
-
-    return int(round(min(100, time_score + interaction_score + practice_score)))
+    return _active_score_from(week_minutes, interaction_minutes, grammar_cnt, speaking_cnt, writing_cnt, homework_cnt)
 
 
 def refresh_student_active_score(db: Session, student_id: int, days: int = 7) -> int:
@@ -160,7 +194,6 @@ def compute_student_ability_profile(db: Session, student_id: int) -> dict[str, i
             GrammarSubmission.is_correct.is_(True),
         )
     ) or 0
-    grammar_acc = (correct_grammar / total_grammar * 100) if total_grammar else 0
 
     speaking_avg = db.execute(
         select(
@@ -203,6 +236,38 @@ def compute_student_ability_profile(db: Session, student_id: int) -> dict[str, i
     )
     homework_avg = float(homework_avg_score or 0)
 
+    return _ability_profile_from(
+        total_grammar=total_grammar,
+        correct_grammar=correct_grammar,
+        sp_total=sp_total,
+        sp_pron=sp_pron,
+        sp_flu=sp_flu,
+        sp_into=sp_into,
+        writing_cnt=writing_cnt,
+        avg_writing_len=avg_writing_len,
+        vocab_cnt=vocab_cnt,
+        chat_user_cnt=chat_user_cnt,
+        homework_avg=homework_avg,
+    )
+
+
+def _ability_profile_from(
+    *,
+    total_grammar: int,
+    correct_grammar: int,
+    sp_total: float,
+    sp_pron: float,
+    sp_flu: float,
+    sp_into: float,
+    writing_cnt: int,
+    avg_writing_len: float,
+    vocab_cnt: int,
+    chat_user_cnt: int,
+    homework_avg: float,
+) -> dict[str, int | str]:
+    """由聚合后的行为数据计算能力画像(单个学生与批量计算共用)。"""
+    grammar_acc = (correct_grammar / total_grammar * 100) if total_grammar else 0
+
     listening = _clamp_score(sp_total * 0.45 + sp_pron * 0.30 + sp_into * 0.25)
     speaking = _clamp_score(sp_total * 0.35 + sp_flu * 0.45 + min(100, chat_user_cnt * 2) * 0.20)
     reading = _clamp_score(grammar_acc * 0.60 + min(100, vocab_cnt * 3) * 0.25 + homework_avg * 0.15)
@@ -234,6 +299,16 @@ def compute_student_ability_profile(db: Session, student_id: int) -> dict[str, i
     }
 
 
+def _overall_score_from(profile: dict[str, int | str]) -> float:
+    return round(
+        profile["listening"] * 0.25
+        + profile["speaking"] * 0.30
+        + profile["reading"] * 0.20
+        + profile["writing"] * 0.25,
+        1,
+    )
+
+
 def refresh_student_performance(db: Session, student_id: int) -> dict[str, float | int | str]:
     """刷新学生综合评分与能力画像。"""
     student = db.scalar(select(Student).where(Student.id == student_id))
@@ -241,13 +316,7 @@ def refresh_student_performance(db: Session, student_id: int) -> dict[str, float
         return {"overall_score": 0.0, "weak_point": "暂无"}
 
     profile = compute_student_ability_profile(db, student_id)
-    overall = round(
-        profile["listening"] * 0.25
-        + profile["speaking"] * 0.30
-        + profile["reading"] * 0.20
-        + profile["writing"] * 0.25,
-        1,
-    )
+    overall = _overall_score_from(profile)
 
     StudentAbilityCRUD.upsert(
         db,
@@ -271,12 +340,439 @@ def refresh_student_performance(db: Session, student_id: int) -> dict[str, float
     }
 
 
-def refresh_student_metrics(db: Session, student_id: int) -> dict[str, float | int | str]:
-    """统一刷新积极度、综合评分、能力画像。"""
-    active = refresh_student_active_score(db, student_id)
-    perf = refresh_student_performance(db, student_id)
+# 批量计算时每批学生数(IN 列表长度上限)
+METRICS_BATCH_CHUNK = 1000
+
+
+def _collect_stats_chunk(db: Session, ids: list[int]) -> dict[int, dict[str, float]]:
+    """从原始行为表聚合 student_metric_stats 的各项累计量(每张表一条 GROUP BY)。"""
+    stats: dict[int, dict[str, float]] = {sid: {} for sid in ids}
+
+    for sid, total, correct in db.execute(
+        select(
+            GrammarSubmission.student_id,
+            func.count(GrammarSubmission.id),
+            func.sum(case((GrammarSubmission.is_correct.is_(True), 1), else_=0)),
+        )
+        .where(GrammarSubmission.student_id.in_(ids))
+        .group_by(GrammarSubmission.student_id)
+    ):
+        stats[sid].update(grammar_total=int(total or 0), grammar_correct=int(correct or 0))
+
+    # 同一条测评的四项分数同时写入,以总分非空作为"已评分"
+    scored = SpeakingEvaluation.total_score.is_not(None)
+    for sid, n, total, pron, flu, into in db.execute(
+        select(
+            SpeakingEvaluation.student_id,
+            func.count(SpeakingEvaluation.id),
+            func.sum(SpeakingEvaluation.total_score),
+            func.sum(func.coalesce(SpeakingEvaluation.pronunciation_score, 0)),
+            func.sum(func.coalesce(SpeakingEvaluation.fluency_score, 0)),
+            func.sum(func.coalesce(SpeakingEvaluation.intonation_score, 0)),
+        )
+        .where(SpeakingEvaluation.student_id.in_(ids), scored)
+        .group_by(SpeakingEvaluation.student_id)
+    ):
+        stats[sid].update(
+            speaking_scored=int(n or 0),
+            speaking_total_sum=float(total or 0),
+            speaking_pron_sum=float(pron or 0),
+            speaking_flu_sum=float(flu or 0),
+            speaking_into_sum=float(into or 0),
+        )
+
+    for sid, n, length_sum in db.execute(
+        select(
+            WritingSession.student_id,
+            func.count(WritingSession.id),
+            func.sum(func.length(WritingSession.user_text)),
+        )
+        .where(WritingSession.student_id.in_(ids))
+        .group_by(WritingSession.student_id)
+    ):
+        stats[sid].update(writing_count=int(n or 0), writing_len_sum=int(length_sum or 0))
+
+    for sid, n in db.execute(
+        select(StudentVocabCollection.student_id, func.count(StudentVocabCollection.id))
+        .where(StudentVocabCollection.student_id.in_(ids))
+        .group_by(StudentVocabCollection.student_id)
+    ):
+        stats[sid]["vocab_count"] = int(n or 0)
+
+    for sid, n in db.execute(
+        select(ChatSession.student_id, func.count(ChatMessage.id))
+        .join(ChatSession, ChatSession.id == ChatMessage.session_id)
+        .where(ChatSession.student_id.in_(ids), ChatMessage.role == "user")
+        .group_by(ChatSession.student_id)
+    ):
+        stats[sid]["chat_user_messages"] = int(n or 0)
+
+    for sid, n, score_sum in db.execute(
+        select(Homework.student_id, func.count(Homework.id), func.sum(Homework.score))
+        .where(Homework.student_id.in_(ids), Homework.status == "已完成", Homework.score.is_not(None))
+        .group_by(Homework.student_id)
+    ):
+        stats[sid].update(homework_scored=int(n or 0), homework_score_sum=float(score_sum or 0))
+
+    return stats
+
+
+def _collect_daily_chunk(db: Session, ids: list[int], since: date) -> dict[int, dict[date, dict[str, int]]]:
+    """从原始行为表聚合 [since, 今天] 的按天练习次数。"""
+    daily: dict[int, dict[date, dict[str, int]]] = defaultdict(lambda: defaultdict(dict))
+    since_ts = datetime.combine(since, datetime.min.time())
+    sources = [
+        ("grammar_count", GrammarSubmission.student_id, GrammarSubmission.submitted_at, []),
+        ("speaking_count", SpeakingEvaluation.student_id, SpeakingEvaluation.evaluated_at, []),
+        ("writing_count", WritingSession.student_id, WritingSession.created_at, []),
+        (
+            "homework_count",
+            Homework.student_id,
+            func.coalesce(Homework.submitted_at, Homework.created_at),
+            [Homework.status == "已完成"],
+        ),
+    ]
+    for counter, student_col, ts_col, extra in sources:
+        day_col = func.date(ts_col)
+        for sid, day, n in db.execute(
+            select(student_col, day_col, func.count())
+            .where(student_col.in_(ids), ts_col >= since_ts, *extra)
+            .group_by(student_col, day_col)
+        ):
+            daily[sid][day][counter] = int(n or 0)
+    return daily
+
+
+def _week_minutes_chunk(db: Session, ids: list[int]) -> dict[int, int]:
+    week_start = date.today() - timedelta(days=date.today().weekday())
+    return ActivityRollupCRUD.minutes_since_many(db, ids, week_start)
+
+
+def _interaction_minutes_chunk(db: Session, ids: list[int], days: int) -> dict[int, int]:
+    sessions_by_student: dict[int, list[tuple]] = defaultdict(list)
+    for sid, first_ts, last_ts, user_count in ActivityRollupCRUD.chat_session_spans(db, ids, _window_start(days)):
+        sessions_by_student[sid].append((first_ts, last_ts, user_count))
+    return {sid: _interaction_minutes_from_sessions(rows) for sid, rows in sessions_by_student.items()}
+
+
+def compute_interaction_minutes_batch(
+    db: Session, student_ids: Iterable[int], days: int = METRICS_WINDOW_DAYS
+) -> dict[int, int]:
+    """批量版 compute_student_interaction_minutes,只读;没有对话的学生不出现在结果里。"""
+    ids = sorted({int(i) for i in student_ids})
+    result: dict[int, int] = {}
+    for i in range(0, len(ids), METRICS_BATCH_CHUNK):
+        result.update(_interaction_minutes_chunk(db, ids[i:i + METRICS_BATCH_CHUNK], days))
+    return result
+
+
+def _avg(total: float, n: int) -> float:
+    return float(total) / n if n else 0.0
+
+
+def _derive_metrics(
+    stats: dict[str, Any],
+    window: dict[str, int],
+    week_minutes: int,
+    interaction_minutes: int,
+) -> dict[str, Any]:
+    """由累计量 + 窗口计数推导积极度、能力画像与综合分(批量重建与增量事件共用)。"""
+    active = _active_score_from(
+        week_minutes,
+        interaction_minutes,
+        int(window.get("grammar_count", 0)),
+        int(window.get("speaking_count", 0)),
+        int(window.get("writing_count", 0)),
+        int(window.get("homework_count", 0)),
+    )
+    speaking_n = int(stats.get("speaking_scored") or 0)
+    writing_n = int(stats.get("writing_count") or 0)
+    profile = _ability_profile_from(
+        total_grammar=int(stats.get("grammar_total") or 0),
+        correct_grammar=int(stats.get("grammar_correct") or 0),
+        sp_total=_avg(stats.get("speaking_total_sum") or 0, speaking_n),
+        sp_pron=_avg(stats.get("speaking_pron_sum") or 0, speaking_n),
+        sp_flu=_avg(stats.get("speaking_flu_sum") or 0, speaking_n),
+        sp_into=_avg(stats.get("speaking_into_sum") or 0, speaking_n),
+        writing_cnt=writing_n,
+        avg_writing_len=_avg(stats.get("writing_len_sum") or 0, writing_n),
+        vocab_cnt=int(stats.get("vocab_count") or 0),
+        chat_user_cnt=int(stats.get("chat_user_messages") or 0),
+        homework_avg=_avg(stats.get("homework_score_sum") or 0, int(stats.get("homework_scored") or 0)),
+    )
     return {
         "active_score": active,
-        "overall_score": float(perf.get("overall_score", 0.0)),
-        "weak_point": str(perf.get("weak_point", "暂无")),
+        "overall_score": _overall_score_from(profile),
+        "weak_point": str(profile["weak_point"]),
+        "listening": int(profile["listening"]),
+        "speaking": int(profile["speaking"]),
+        "reading": int(profile["reading"]),
+        "writing": int(profile["writing"]),
+        "diagnosis": str(profile["diagnosis"]),
+        "interaction_minutes": interaction_minutes,
+    }
+
+
+def compute_student_metrics_batch(
+    db: Session, student_ids: Iterable[int], days: int = METRICS_WINDOW_DAYS
+) -> dict[int, dict[str, Any]]:
+    """集合式计算一批学生的积极度、能力画像与综合分。
+
+    每类行为数据一条 GROUP BY 查询,查询条数与学生人数无关;不存在的学生 id 不出现在结果里。
+
+    返回 {student_id: {active_score, overall_score, weak_point, listening, speaking,
+    reading, writing, diagnosis, interaction_minutes}}。
+    """
+    return {sid: item[0] for sid, item in _compute_batch(db, student_ids, days).items()}
+
+
+def _compute_batch(
+    db: Session, student_ids: Iterable[int], days: int
+) -> dict[int, tuple[dict[str, Any], dict[str, float], dict[date, dict[str, int]]]]:
+    """返回 {student_id: (指标, 累计量, 按天计数)}。"""
+    ids = sorted({int(i) for i in student_ids})
+    since = _window_start(days)
+    out: dict[int, tuple[dict[str, Any], dict[str, float], dict[date, dict[str, int]]]] = {}
+    for i in range(0, len(ids), METRICS_BATCH_CHUNK):
+        chunk = list(db.scalars(select(Student.id).where(Student.id.in_(ids[i:i + METRICS_BATCH_CHUNK]))))
+        if not chunk:
+            continue
+        stats = _collect_stats_chunk(db, chunk)
+        daily = _collect_daily_chunk(db, chunk, since)
+        week_minutes = _week_minutes_chunk(db, chunk)
+        interaction = _interaction_minutes_chunk(db, chunk, days)
+        for sid in chunk:
+            days_map = {day: dict(counts) for day, counts in daily.get(sid, {}).items()}
+            window = defaultdict(int)
+            for counts in days_map.values():
+                for k, v in counts.items():
+                    window[k] += v
+            metrics = _derive_metrics(stats[sid], window, week_minutes.get(sid, 0), interaction.get(sid, 0))
+            out[sid] = (metrics, stats[sid], days_map)
+    return out
+
+
+def _write_metrics(db: Session, metrics: dict[int, dict[str, Any]]) -> set[int]:
+    """写回 students 与 student_abilities(只改有变化的行),不提交;返回有变化的学生 id。"""
+    changed = set(StudentCRUD.bulk_update_metrics(db, metrics))
+    changed |= set(StudentAbilityCRUD.bulk_upsert(db, metrics))
+    # 班级聚合(能力均值/薄弱点分布/活跃人数)随之过期
+    ClassMetricStatsCRUD.mark_dirty_for_students(db, sorted(changed))
+    return changed
+
+
+def _after_metrics_commit(db: Session, student_ids: Iterable[int], changed: set[int]) -> None:
+    # 提交会让会话里已加载的 Student 全部过期;一次性重新加载,避免调用方逐个懒加载
+    db.scalars(select(Student).where(Student.id.in_(list(student_ids)))).all()
+    # 积极度/能力画像/综合分已变,丢弃 Agent 工具里基于旧值的缓存结果
+    if changed:
+        invalidate_tool_cache(*(student_tag(sid, "metrics") for sid in sorted(changed)))
+
+
+def refresh_student_metrics_batch(
+    db: Session, student_ids: Iterable[int], days: int = METRICS_WINDOW_DAYS
+) -> dict[int, dict[str, Any]]:
+    """从原始行为表全量重算一批学生的指标,并重建其 student_metric_stats / student_metric_daily。
+
+    用于回填、后台巡检与纠偏;日常写路径走 record_metric_event 增量更新。
+    写回只改动数值有变化的行,整批一次提交。返回值同 compute_student_metrics_batch。
+    """
+    computed = _compute_batch(db, student_ids, days)
+    if not computed:
+        return {}
+    metrics = {sid: item[0] for sid, item in computed.items()}
+    StudentMetricStatsCRUD.replace_many(
+        db,
+        stats={sid: item[1] for sid, item in computed.items()},
+        daily={sid: item[2] for sid, item in computed.items()},
+        since=_window_start(days),
+        active_as_of=date.today(),
+    )
+    changed = _write_metrics(db, metrics)
+    db.commit()
+    _after_metrics_commit(db, metrics, changed)
+    return metrics
+
+
+def refresh_student_metrics(db: Session, student_id: int) -> dict[str, float | int | str]:
+    """从原始行为表全量重算单个学生的积极度、综合评分、能力画像。"""
+    return _metrics_payload(refresh_student_metrics_batch(db, [student_id]).get(student_id))
+
+
+def _metrics_payload(metrics: dict[str, Any] | None) -> dict[str, float | int | str]:
+    if metrics is None:
+        return {"active_score": 0, "overall_score": 0.0, "weak_point": "暂无"}
+    return {
+        "active_score": metrics["active_score"],
+        "overall_score": float(metrics["overall_score"]),
+        "weak_point": metrics["weak_point"],
+    }
+
+
+def student_metrics_snapshot(student: Student) -> dict[str, float | int | str]:
+    """读路径:直接返回 students 表上已维护好的指标,不做计算也不写库。"""
+    return {
+        "active_score": int(student.active_score or 0),
+        "overall_score": float(student.overall_score or 0),
+        "weak_point": student.weak_point or "暂无",
     }
+
+
+# ─── 增量事件 ───
+# 每类事件给出 (累计量增量, 当天练习计数增量);写路径在原始数据落库后调用 record_metric_event。
+
+def _learning_event() -> tuple[dict, dict]:
+    # 只影响本周学习时长 / 互动时长,重新推导积极度即可
+    return {}, {}
+
+
+def _grammar_event(submitted: int = 1, correct: int = 0) -> tuple[dict, dict]:
+    """submitted: 新增提交条数;correct: 正确条数的变化(重答同一题时可为负)。"""
+    return {"grammar_total": submitted, "grammar_correct": correct}, {"grammar_count": submitted}
+
+
+def _speaking_event(
+    total_score: float | None = None,
+    pronunciation_score: float | None = None,
+    fluency_score: float | None = None,
+    intonation_score: float | None = None,
+) -> tuple[dict, dict]:
+    if total_score is None:
+        return {}, {"speaking_count": 1}
+    return {
+        "speaking_scored": 1,
+        "speaking_total_sum": float(total_score),
+        "speaking_pron_sum": float(pronunciation_score or 0),
+        "speaking_flu_sum": float(fluency_score or 0),
+        "speaking_into_sum": float(intonation_score or 0),
+    }, {"speaking_count": 1}
+
+
+def _writing_event(text_length: int) -> tuple[dict, dict]:
+    return {"writing_count": 1, "writing_len_sum": int(text_length)}, {"writing_count": 1}
+
+
+def _vocab_event(delta: int) -> tuple[dict, dict]:
+    return {"vocab_count": int(delta)}, {}
+
+
+def _chat_event(user_messages: int = 1) -> tuple[dict, dict]:
+    return {"chat_user_messages": int(user_messages)}, {}
+
+
+def _homework_completed_event(score: float | None = None) -> tuple[dict, dict]:
+    counters = {"homework_scored": 1, "homework_score_sum": float(score)} if score is not None else {}
+    return counters, {"homework_count": 1}
+
+
+def _homework_scored_event(old_score: float | None, new_score: float | None) -> tuple[dict, dict]:
+    """已完成作业被(重新)评分。"""
+    return {
+        "homework_scored": (new_score is not None) - (old_score is not None),
+        "homework_score_sum": float(new_score or 0) - float(old_score or 0),
+    }, {}
+
+
+_METRIC_EVENTS = {
+    "learning": _learning_event,
+    "grammar_submission": _grammar_event,
+    "speaking_evaluation": _speaking_event,
+    "writing_session": _writing_event,
+    "vocab_collection": _vocab_event,
+    "chat_message": _chat_event,
+    "homework_completed": _homework_completed_event,
+    "homework_scored": _homework_scored_event,
+}
+
+
+def record_metric_event(db: Session, student_id: int, kind: str, **payload) -> dict[str, float | int | str] | None:
+    """写路径事件:增量更新累计量与当天计数,再只为该学生推导并写回指标。
+
+    需在原始数据提交之后调用。该学生还没有统计行时改为全量重建(原始数据已包含本次写入)。
+    统计失败不影响主流程:回滚并返回 None,偏差由后台巡检全量重建纠正。
+    """
+    counters, daily = _METRIC_EVENTS[kind](**payload)
+    today = date.today()
+    try:
+        stats = StudentMetricStatsCRUD.apply_deltas(db, student_id, counters, active_as_of=today)
+        if stats is None:
+            return _metrics_payload(refresh_student_metrics_batch(db, [student_id]).get(student_id))
+        StudentMetricStatsCRUD.add_daily(db, student_id, today, daily)
+        window = StudentMetricStatsCRUD.window_counts(
+            db, [student_id], _window_start(METRICS_WINDOW_DAYS)
+        ).get(student_id, {})
+        metrics = _derive_metrics(
+            stats,
+            window,
+            LearningSessionCRUD.week_minutes(db, student_id),
+            compute_student_interaction_minutes(db, student_id, days=METRICS_WINDOW_DAYS),
+        )
+        changed = _write_metrics(db, {student_id: metrics})
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"metric event {kind} for student {student_id} failed: {type(e).__name__}: {e}")
+        return None
+    _after_metrics_commit(db, [student_id], changed)
+    return _metrics_payload(metrics)
+
+
+# ─── 后台巡检 ───
+
+def sweep_stale_student_metrics(db: Session, limit: int = METRICS_SWEEP_BATCH) -> int:
+    """全量重建积极度不是今天算的学生(窗口滑动、跨周清零)以及还没有统计行的学生,返回处理人数。"""
+    today = date.today()
+    total = 0
+    while True:
+        ids = StudentMetricStatsCRUD.list_stale_student_ids(db, today, limit)
+        if not ids:
+            break
+        refresh_student_metrics_batch(db, ids)
+        total += len(ids)
+        if len(ids) < limit:
+            break
+    StudentMetricStatsCRUD.prune_daily(db, _window_start(METRICS_WINDOW_DAYS) - timedelta(days=7))
+    db.commit()
+    return total
+
+
+_sweeper_stop = threading.Event()
+_sweeper_thread: threading.Thread | None = None
+
+
+def _sweeper_loop() -> None:
+    from db.session import SessionLocal
+    from services.class_stats import refresh_dirty_class_stats
+
+    while not _sweeper_stop.is_set():
+        db = SessionLocal()
+        try:
+            n = sweep_stale_student_metrics(db)
+            if n:
+                logger.info(f"metrics sweep: rebuilt {n} students")
+            n = refresh_dirty_class_stats(db)
+            if n:
+                logger.info(f"metrics sweep: rebuilt {n} class stats")
+        except Exception as e:
+            db.rollback()
+            logger.warning(f"metrics sweep failed: {type(e).__name__}: {e}")
+        finally:
+            db.close()
+        _sweeper_stop.wait(METRICS_SWEEP_INTERVAL)
+
+
+def start_metrics_sweeper() -> bool:
+    """启动本进程的指标巡检线程(幂等);METRICS_SWEEP_INTERVAL<=0 时不启动。"""
+    global _sweeper_thread
+    if METRICS_SWEEP_INTERVAL <= 0 or (_sweeper_thread and _sweeper_thread.is_alive()):
+        return False
+    _sweeper_stop.clear()
+    _sweeper_thread = threading.Thread(target=_sweeper_loop, name="metrics-sweeper", daemon=True)
+    _sweeper_thread.start()
+    return True
+
+
+def stop_metrics_sweeper(timeout: float = 5.0) -> None:
+    _sweeper_stop.set()
+    if _sweeper_thread:
+        _sweeper_thread.join(timeout=timeout)
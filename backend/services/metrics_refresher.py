@@ -0,0 +1,196 @@
+"""对话轮次结束后的学生指标刷新:合并、延后,移出请求路径。
+
+每轮对话结束时,流式接口只把"学生 X 有新的对话"登记到这里就推送 done:
+
+- 学习时长记录(learning_sessions)和会话 touch 逐条保留,在后台线程里写入;
+- 指标重算(record_metric_event,约十余条查询)按学生合并:同一学生两次执行至少间隔
+  METRICS_REFRESH_INTERVAL 秒,间隔内的后续轮次只累加待处理数据(计为 coalesced);
+- 停机时立即处理所有待处理学生。
+
+METRICS_REFRESH_INTERVAL<=0 时 submit 直接在调用线程里同步执行,行为与原先一致。
+"""
+from __future__ import annotations
+
+import heapq
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any
+
+from crud.repositories import ChatSessionCRUD
+from services.metrics import record_metric_event, track_learning_activity
+
+logger = logging.getLogger(__name__)
+
+METRICS_REFRESH_INTERVAL = float(os.getenv("METRICS_REFRESH_INTERVAL", "30"))
+
+
+@dataclass
+class _Pending:
+    """某学生尚未落库的对话轮次数据。activities 为 (模块, 分钟, 内容, 轮次结束时间)。"""
+
+    activities: list[tuple[str, int, str | None, datetime]] = field(default_factory=list)
+    session_ids: set[int] = field(default_factory=set)
+    user_messages: int = 0
+
+
+class CoalescingMetricsRefresher:
+    """按学生合并的延后刷新队列,单个后台线程消费。"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._cond = threading.Condition()
+        self._pending: dict[int, _Pending] = {}
+        self._due: list[tuple[float, int]] = []  # (到期时刻, student_id) 小顶堆
+        self._last_run: dict[int, float] = {}
+        self._thread: threading.Thread | None = None
+        self._stopping = False
+        self.submitted = 0
+        self.coalesced = 0
+        self.executed = 0
+        self.failed = 0
+
+    def submit(
+        self,
+        student_id: int,
+        session_id: int | None = None,
+        module: str | None = None,
+        duration_minutes: int = 0,
+        content: str | None = None,
+        user_messages: int = 1,
+    ) -> None:
+        # 学习记录按轮次结束时间落库,而不是后台实际写入的时间
+        occurred_at = datetime.now()
+        if self.interval <= 0:
+            pending = _Pending(user_messages=user_messages)
+            if module:
+                pending.activities.append((module, duration_minutes, content, occurred_at))
+            if session_id is not None:
+                pending.session_ids.add(session_id)
+            with self._cond:
+                self.submitted += 1
+            self._execute(student_id, pending)
+            return
+
+        self._ensure_started()
+        with self._cond:
+            self.submitted += 1
+            pending = self._pending.get(student_id)
+            if pending is None:
+                pending = self._pending[student_id] = _Pending()
+                # 距上次执行不足 interval 的,推迟到满 interval 时再执行
+                due = max(time.monotonic(), self._last_run.get(student_id, float("-inf")) + self.interval)
+                heapq.heappush(self._due, (due, student_id))
+                self._cond.notify()
+            else:
+                self.coalesced += 1
+            if module:
+                pending.activities.append((module, duration_minutes, content, occurred_at))
+            if session_id is not None:
+                pending.session_ids.add(session_id)
+            pending.user_messages += user_messages
+
+    def _ensure_started(self) -> None:
+        with self._cond:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._loop, name="metrics-refresher", daemon=True)
+            self._thread.start()
+
+    def _loop(self) -> None:
+        while True:
+            with self._cond:
+                while not self._stopping and (not self._due or self._due[0][0] > time.monotonic()):
+                    timeout = self._due[0][0] - time.monotonic() if self._due else None
+                    self._cond.wait(timeout)
+                if self._stopping and not self._due:
+                    return
+                # 停机时不再等待到期,依次立即处理
+                _, student_id = heapq.heappop(self._due)
+                pending = self._pending.pop(student_id)
+                now = time.monotonic()
+                self._last_run[student_id] = now
+                if len(self._last_run) > 10000:
+                    # 超过 interval 的记录已不影响调度
+                    self._last_run = {k: t for k, t in self._last_run.items() if now - t < self.interval}
+            self._execute(student_id, pending)
+
+    def _execute(self, student_id: int, pending: _Pending) -> None:
+        from db.session import SessionLocal
+
+        db = SessionLocal()
+        try:
+            for module, minutes, content, occurred_at in pending.activities:
+                track_learning_activity(
+                    db, student_id=student_id, module=module, duration_minutes=minutes, content=content,
+                    session_date=occurred_at,
+                )
+            for session_id in sorted(pending.session_ids):
+                ChatSessionCRUD.touch(db, session_id)
+            ok = record_metric_event(db, student_id, "chat_message", user_messages=pending.user_messages)
+            with self._cond:
+                if ok is None:
+                    self.failed += 1
+                else:
+                    self.executed += 1
+        except Exception as e:
+            db.rollback()
+            with self._cond:
+                self.failed += 1
+            logger.warning(f"deferred metrics refresh for student {student_id} failed: {type(e).__name__}: {e}")
+        finally:
+            db.close()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """处理完所有待处理学生后退出后台线程。"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread:
+            thread.join(timeout=timeout)
+
+    def stats(self) -> dict[str, Any]:
+        with self._cond:
+            return {
+                "interval_s": self.interval,
+                "submitted": self.submitted,
+                "coalesced": self.coalesced,
+                "executed": self.executed,
+                "failed": self.failed,
+                "pending": len(self._pending),
+                "coalesce_rate": round(self.coalesced / self.submitted, 4) if self.submitted else 0.0,
+            }
+
+
+_REFRESHER = CoalescingMetricsRefresher(METRICS_REFRESH_INTERVAL)
+
+
+def schedule_chat_metrics_refresh(
+    student_id: int,
+    session_id: int | None,
+    module: str,
+    duration_minutes: int,
+    content: str | None = None,
+) -> None:
+    """对话轮次结束:登记学习时长、会话 touch 与指标刷新,由后台合并执行。"""
+    _REFRESHER.submit(
+        student_id,
+        session_id=session_id,
+        module=module,
+        duration_minutes=duration_minutes,
+        content=content,
+    )
+
+
+def stop_metrics_refresher(timeout: float = 10.0) -> None:
+    _REFRESHER.stop(timeout=timeout)
+
+
+def metrics_refresh_stats() -> dict[str, Any]:
+    """返回合并刷新计数(进程级):coalesced 为被合并掉的轮次,executed 为实际执行的刷新。"""
+    return _REFRESHER.stats()
@@ -5,6 +5,7 @@
 - Span 用 contextmanager,自动记录耗时
 - 失败时不影响主业务(fail-safe)
 """
+import threading
 import time
 import uuid
 import logging
@@ -101,6 +102,7 @@ class ExecutionTrace:
         
         self.spans: list[Span] = []
         self._sequence_counter = 0
+        self._lock = threading.Lock()  # 同一轮的只读工具可能在多个线程里并发记录 span
         
         # 最终聚合数据
         self.reply_text: str | None = None
@@ -112,6 +114,11 @@ class ExecutionTrace:
         self.rag_used = False
         self.rag_top_score = 0.0
         self.iterations_used = 0
+        self.cache_hit = False  # 回复来自语义答案缓存(未调用 LLM)
+    
+    def elapsed_ms(self) -> int:
+        """距 trace 创建的毫秒数,用于在 span 里标注起止时刻、观察并发阶段的重叠。"""
+        return int((time.time() - self._start_time) * 1000)
     
     @contextmanager
     def span(self, span_type: str, span_name: str) -> Iterator[Span]:
@@ -123,11 +130,13 @@ class ExecutionTrace:
                 result = ...
                 span.set_output({"keys": list(result.keys())})
         """
-        self._sequence_counter += 1
+        with self._lock:
+            self._sequence_counter += 1
+            sequence = self._sequence_counter
         span_obj = Span(
             span_type=span_type,
             span_name=span_name,
-            sequence=self._sequence_counter,
+            sequence=sequence,
         )
         try:
             yield span_obj
@@ -136,7 +145,8 @@ class ExecutionTrace:
             raise
         finally:
             span_obj.finalize()
-            self.spans.append(span_obj)
+            with self._lock:
+                self.spans.append(span_obj)
     
     def finalize(
         self,
@@ -193,7 +203,7 @@ class ExecutionTrace:
                     total_llm_calls, total_tool_calls,
                     total_input_tokens, total_output_tokens, estimated_cost_yuan,
                     rag_used, rag_top_score, iterations_used,
-                    tools_called
+                    tools_called, cache_hit
                 ) VALUES (
                     :trace_id, :role, :user_id, :session_id,
                     :user_message, :user_message_length,
@@ -203,7 +213,7 @@ class ExecutionTrace:
                     :total_llm_calls, :total_tool_calls,
                     :total_input_tokens, :total_output_tokens, :estimated_cost_yuan,
                     :rag_used, :rag_top_score, :iterations_used,
-                    CAST(:tools_called AS JSONB)
+                    CAST(:tools_called AS JSONB), :cache_hit
                 )
             """), {
                 "trace_id": self.trace_id,
@@ -227,6 +237,7 @@ class ExecutionTrace:
                 "rag_top_score": self.rag_top_score if self.rag_top_score else None,
                 "iterations_used": self.iterations_used,
                 "tools_called": _json_dumps(agg["tools_called"]),
+                "cache_hit": self.cache_hit,
             })
             
             # 写 spans
@@ -0,0 +1,145 @@
+"""
+pdf_extract.py - PDF 逐页文本提取(顺序 / 多进程分片)
+
+本模块只依赖 pypdf / PyMuPDF,不导入数据库等重模块,
+子进程(spawn)按模块名导入本文件即可执行分片任务。
+"""
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterator
+
+from pypdf import PdfReader
+
+# 页数 >= 该阈值时按页段分片到进程池并行提取;KB_PDF_WORKERS<=1 关闭并行
+KB_PDF_PARALLEL_MIN_PAGES = int(os.getenv("KB_PDF_PARALLEL_MIN_PAGES", "200"))
+KB_PDF_WORKERS = int(os.getenv("KB_PDF_WORKERS", str(min(4, os.cpu_count() or 1))))
+# 每个分片包含的页数
+KB_PDF_SHARD_PAGES = max(1, int(os.getenv("KB_PDF_SHARD_PAGES", "32")))
+
+
+class _PageExtractor:
+    """单页提取:先 pypdf,抽不到字的页再用 PyMuPDF 兜底(按需打开一次)。"""
+
+    def __init__(self, path: Path, reader: PdfReader):
+        self.path = path
+        self.reader = reader
+        self._fallback = None
+
+    def extract(self, i: int) -> str:
+        try:
+            text = self.reader.pages[i].extract_text() or ""
+        except Exception:
+            text = ""
+        if text.strip():
+            return text
+        # 部分页 pypdf 抽不到字，PyMuPDF 有时能抽到（仍非 OCR，纯图片页仍为空）
+        try:
+            if self._fallback is None:
+                import fitz  # PyMuPDF
+
+                self._fallback = fitz.open(self.path)
+            return self._fallback.load_page(i).get_text() or ""
+        except Exception:
+            return ""
+
+    def close(self) -> None:
+        if self._fallback is not None:
+            self._fallback.close()
+            self._fallback = None
+
+
+def _iter_pages_pymupdf(path: Path, first: int = 0, last: int | None = None) -> Iterator[str]:
+    import fitz  # PyMuPDF
+
+    doc = fitz.open(path)
+    try:
+        end = doc.page_count if last is None else min(last, doc.page_count)
+        for i in range(first, end):
+            yield doc.load_page(i).get_text() or ""
+    finally:
+        doc.close()
+
+
+def extract_page_range(path: str, first: int, last: int) -> list[str]:
+    """提取 [first, last) 页的文本(进程池任务,参数需可 pickle)。"""
+    p = Path(path)
+    try:
+        reader = PdfReader(path)
+    except Exception:
+        return list(_iter_pages_pymupdf(p, first, last))
+    extractor = _PageExtractor(p, reader)
+    try:
+        return [extractor.extract(i) for i in range(first, min(last, len(reader.pages)))]
+    finally:
+        extractor.close()
+
+
+def pdf_page_count(path: Path) -> int | None:
+    try:
+        return len(PdfReader(str(path)).pages)
+    except Exception:
+        try:
+            import fitz  # PyMuPDF
+
+            doc = fitz.open(path)
+            try:
+                return doc.page_count
+            finally:
+                doc.close()
+        except Exception:
+            return None
+
+
+def _iter_pages_sequential(path: Path) -> Iterator[str]:
+    try:
+        reader = PdfReader(str(path))
+        page_count = len(reader.pages)
+    except Exception:
+        # pypdf 打不开(结构损坏等)时整份交给 PyMuPDF
+        yield from _iter_pages_pymupdf(path)
+        return
+    extractor = _PageExtractor(path, reader)
+    try:
+        for i in range(page_count):
+            yield extractor.extract(i)
+    finally:
+        extractor.close()
+
+
+def _iter_pages_parallel(path: Path, page_count: int, workers: int, shard_pages: int) -> Iterator[str]:
+    """按页段分片并行提取,按原顺序产出;在途分片数有上限,内存占用不随页数增长。"""
+    shards = deque((s, min(s + shard_pages, page_count)) for s in range(0, page_count, shard_pages))
+    # API 进程里有其它线程,fork 不安全,统一用 spawn
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+        in_flight: deque[Future] = deque()
+        try:
+            while shards or in_flight:
+                while shards and len(in_flight) < workers * 2:
+                    first, last = shards.popleft()
+                    in_flight.append(pool.submit(extract_page_range, str(path), first, last))
+                yield from in_flight.popleft().result()
+        finally:
+            for fut in in_flight:
+                fut.cancel()
+
+
+def iter_pdf_pages(path: Path, workers: int | None = None) -> Iterator[tuple[int, str]]:
+    """逐页产出 (页码, 文本),页码从 1 开始。
+
+    页与页之间补一个换行(第一页除外),拼起来与整篇 "\\n".join 的结果一致。
+    workers: 进程数,默认 KB_PDF_WORKERS;页数未达 KB_PDF_PARALLEL_MIN_PAGES 时仍顺序提取。
+    """
+    workers = KB_PDF_WORKERS if workers is None else workers
+    pages: Iterator[str] | None = None
+    if workers > 1:
+        page_count = pdf_page_count(path) or 0
+        if page_count >= max(2, KB_PDF_PARALLEL_MIN_PAGES):
+            pages = _iter_pages_parallel(path, page_count, workers, KB_PDF_SHARD_PAGES)
+    if pages is None:
+        pages = _iter_pages_sequential(path)
+    for i, text in enumerate(pages):
+        yield i + 1, ("\n" if i else "") + text
@@ -1,12 +1,16 @@
 import os
+import time
 import logging
-from typing import Any
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable
 
 from sqlalchemy.orm import Session
 
 from crud.repositories import KnowledgeBaseCRUD
+from db.session import SessionLocal
 from services.embedding import embed_text
-from services.rerank import rerank
+from services.rerank import rerank_with_budget
+from services.vector_index import get_public_index
 
 
 logger = logging.getLogger(__name__)
@@ -17,10 +21,20 @@ RAG_ENABLED = os.getenv("RAG_ENABLED", "true").lower() == "true"
 # 召回阶段:embedding + 关键词,各取 top_k
 RAG_RECALL_TOP_K = int(os.getenv("RAG_RECALL_TOP_K", "20"))
 RAG_RECALL_THRESHOLD = float(os.getenv("RAG_RECALL_THRESHOLD", "0.2"))
+# HNSW 近邻候选数 = top_k * 该倍数,可见性/阈值过滤在候选集上做
+RAG_VECTOR_CANDIDATE_FACTOR = max(1, int(os.getenv("RAG_VECTOR_CANDIDATE_FACTOR", "4")))
+# 查询时 hnsw.ef_search(越大召回越高、越慢);0 表示沿用数据库默认值(40)
+RAG_HNSW_EF_SEARCH = int(os.getenv("RAG_HNSW_EF_SEARCH", "100"))
+# 量化两阶段检索:binary / halfvec 粗排(需迁移 20261018_0005 的表达式索引),空值为全精度 HNSW
+RAG_VECTOR_QUANTIZATION = os.getenv("RAG_VECTOR_QUANTIZATION", "").strip().lower() or None
+# 粗排候选数 = candidate_k * 该倍数,再用全精度向量精排
+RAG_QUANT_RESCORE_FACTOR = max(1, int(os.getenv("RAG_QUANT_RESCORE_FACTOR", "4")))
 
 # 关键词检索:阈值更宽松,因为 ts_rank_cd 分数范围小
 RAG_KEYWORD_TOP_K = int(os.getenv("RAG_KEYWORD_TOP_K", "20"))
 RAG_KEYWORD_THRESHOLD = float(os.getenv("RAG_KEYWORD_THRESHOLD", "0.01"))
+# 全文检索配置:simple(原词) / german(德语词干化,如 Konjunktivs→konjunktiv)
+RAG_KEYWORD_TS_CONFIG = os.getenv("RAG_KEYWORD_TS_CONFIG", "simple").strip().lower()
 
 # RRF 融合参数(标准值 60)
 RRF_K = int(os.getenv("RAG_RRF_K", "60"))
@@ -28,6 +42,8 @@ RRF_K = int(os.getenv("RAG_RRF_K", "60"))
 # 精排阶段:严格,只保留真正相关的
 RAG_RERANK_TOP_N = int(os.getenv("RAG_RERANK_TOP_N", "3"))
 RAG_RERANK_THRESHOLD = float(os.getenv("RAG_RERANK_THRESHOLD", "0.3"))
+# 本地兜底精排(BM25F + 余弦 / cross-encoder)分数尺度不同,单独设阈值
+RAG_LOCAL_RERANK_THRESHOLD = float(os.getenv("RAG_LOCAL_RERANK_THRESHOLD", "0.3"))
 
 # 用于"是否对用户显示参考资料"的最终守门阈值
 RAG_STRONG_HIT_THRESHOLD = float(os.getenv("RAG_STRONG_HIT_THRESHOLD", "0.4"))
@@ -35,6 +51,22 @@ RAG_STRONG_HIT_THRESHOLD = float(os.getenv("RAG_STRONG_HIT_THRESHOLD", "0.4"))
 # 是否启用混合检索(可关闭做对比测试)
 HYBRID_SEARCH_ENABLED = os.getenv("HYBRID_SEARCH_ENABLED", "true").lower() == "true"
 
+# 混合检索时,关键词召回是否在独立连接上与 embedding+向量召回并行执行
+RAG_PARALLEL_RECALL = os.getenv("RAG_PARALLEL_RECALL", "true").lower() == "true"
+RAG_RECALL_WORKERS = max(1, int(os.getenv("RAG_RECALL_WORKERS", "8")))
+
+# 进程级线程池,避免每次请求创建线程
+_RECALL_EXECUTOR = ThreadPoolExecutor(max_workers=RAG_RECALL_WORKERS, thread_name_prefix="rag-recall")
+
+# 流式对话:检索在独立连接上与会话准备(建会话/写消息/读历史)并发执行
+RAG_PREFETCH_ENABLED = os.getenv("RAG_PREFETCH_ENABLED", "true").lower() == "true"
+RAG_PREFETCH_WORKERS = max(1, int(os.getenv("RAG_PREFETCH_WORKERS", "16")))
+# 流式对话的远程精排预算(ms):超时即用本地精排/融合结果开始生成,首 token 不被远程精排拖住
+RAG_STREAM_RERANK_BUDGET_MS = int(os.getenv("RAG_STREAM_RERANK_BUDGET_MS", "600"))
+
+# 与召回线程池分开:预取任务内部还会向 _RECALL_EXECUTOR 提交关键词召回,共用会互相等待
+_PREFETCH_EXECUTOR = ThreadPoolExecutor(max_workers=RAG_PREFETCH_WORKERS, thread_name_prefix="rag-prefetch")
+
 
 def _reciprocal_rank_fusion(
     rankings: list[list[dict]],
@@ -100,6 +132,7 @@ def search_knowledge(
     viewer_user_id: int | None = None,
     viewer_session_key: str | None = None,
     trace=None,    # ← 新增
+    rerank_budget_ms: int | None = None,
 ) -> list[dict]:
     """混合检索: embedding(语义) + keyword(BM25 风格) → RRF 融合 → rerank 精排。
     
@@ -114,9 +147,18 @@ def search_knowledge(
     
     if trace:
         with trace.span("rag_retrieval", "hybrid_search") as span:
-            span.set_input({"query": query[:200], "hybrid": HYBRID_SEARCH_ENABLED})
-            result = _do_search_knowledge(db, query, viewer_user_id, viewer_session_key)
-            span.set_output({"chunk_count": len(result)})
+            span.set_input({
+                "query": query[:200],
+                "hybrid": HYBRID_SEARCH_ENABLED,
+                "parallel_recall": RAG_PARALLEL_RECALL,
+                "rerank_budget_ms": rerank_budget_ms,
+            })
+            timings: dict[str, Any] = {}
+            result = _do_search_knowledge(
+                db, query, viewer_user_id, viewer_session_key,
+                timings=timings, rerank_budget_ms=rerank_budget_ms,
+            )
+            span.set_output({"chunk_count": len(result), "timings_ms": timings})
             if result:
                 span.set_rag_stats(
                     recall_count=len(result),
@@ -124,7 +166,117 @@ def search_knowledge(
                 )
             return result
     else:
-        return _do_search_knowledge(db, query, viewer_user_id, viewer_session_key)
+        return _do_search_knowledge(
+            db, query, viewer_user_id, viewer_session_key, rerank_budget_ms=rerank_budget_ms,
+        )
+
+
+def _elapsed_ms(start: float) -> int:
+    return int((time.perf_counter() - start) * 1000)
+
+
+def _vector_recall(
+    db: Session,
+    q: str,
+    viewer_user_id: int | None,
+    viewer_session_key: str | None,
+    timings: dict[str, Any],
+) -> list[dict]:
+    """embedding + 向量召回(一条分支)。"""
+    t0 = time.perf_counter()
+    try:
+        q_emb, q_vec = embed_text(q)
+        logger.debug(f"embed_text OK, vec len={len(q_vec) if q_vec else 0}")
+    except Exception as e:
+        logger.warning(f"embed_text FAILED: {type(e).__name__}: {e}")
+        q_emb, q_vec = None, None
+    timings["embedding"] = _elapsed_ms(t0)
+
+    if not q_vec:
+        return []
+    t1 = time.perf_counter()
+    index = get_public_index()
+    if index is not None:
+        # 公共库走进程内索引,私有/本会话文档仍在 SQL 里精确检索,按相似度合并
+        candidates = _public_index_recall(db, index, q_emb)
+        candidates += KnowledgeBaseCRUD.search_chunks_by_embedding(
+            db, q_vec,
+            top_k=RAG_RECALL_TOP_K,
+            score_threshold=RAG_RECALL_THRESHOLD,
+            viewer_user_id=viewer_user_id,
+            viewer_session_key=viewer_session_key,
+            include_public=False,
+        )
+        candidates.sort(key=lambda c: c["score"], reverse=True)
+        candidates = candidates[:RAG_RECALL_TOP_K]
+        timings["vector_search"] = _elapsed_ms(t1)
+        logger.info(f"vector recall (memory index): {len(candidates)} candidates")
+        return candidates
+    candidates = KnowledgeBaseCRUD.search_chunks_by_embedding(
+        db, q_vec,
+        top_k=RAG_RECALL_TOP_K,
+        score_threshold=RAG_RECALL_THRESHOLD,
+        viewer_user_id=viewer_user_id,
+        viewer_session_key=viewer_session_key,
+        candidate_k=RAG_RECALL_TOP_K * RAG_VECTOR_CANDIDATE_FACTOR,
+        ef_search=RAG_HNSW_EF_SEARCH or None,
+        quantization=RAG_VECTOR_QUANTIZATION,
+        rescore_k=RAG_RECALL_TOP_K * RAG_VECTOR_CANDIDATE_FACTOR * RAG_QUANT_RESCORE_FACTOR,
+    )
+    timings["vector_search"] = _elapsed_ms(t1)
+    logger.info(f"vector recall: {len(candidates)} candidates")
+    return candidates
+
+
+def _public_index_recall(db: Session, index, q_emb: list[float]) -> list[dict]:
+    hits = index.search(q_emb, top_k=RAG_RECALL_TOP_K, score_threshold=RAG_RECALL_THRESHOLD)
+    if not hits:
+        return []
+    scores = dict(hits)
+    rows = KnowledgeBaseCRUD.get_public_chunks_by_ids(db, list(scores))
+    for r in rows:
+        r["score"] = scores[r["id"]]
+    return rows
+
+
+def _keyword_recall(
+    db: Session,
+    q: str,
+    viewer_user_id: int | None,
+    viewer_session_key: str | None,
+    timings: dict[str, Any],
+) -> list[dict]:
+    """关键词召回(BM25 风格)。失败时返回空列表,不影响向量分支。"""
+    t0 = time.perf_counter()
+    try:
+        candidates = KnowledgeBaseCRUD.search_chunks_by_keyword(
+            db, q,
+            top_k=RAG_KEYWORD_TOP_K,
+            score_threshold=RAG_KEYWORD_THRESHOLD,
+            viewer_user_id=viewer_user_id,
+            viewer_session_key=viewer_session_key,
+            ts_config=RAG_KEYWORD_TS_CONFIG,
+        )
+        logger.info(f"keyword recall: {len(candidates)} candidates")
+    except Exception as e:
+        logger.warning(f"keyword search FAILED: {type(e).__name__}: {e}")
+        candidates = []
+    timings["keyword_search"] = _elapsed_ms(t0)
+    return candidates
+
+
+def _keyword_recall_own_session(
+    q: str,
+    viewer_user_id: int | None,
+    viewer_session_key: str | None,
+    timings: dict[str, Any],
+) -> list[dict]:
+    """在独立数据库连接上跑关键词召回(Session 不是线程安全的,不能共享请求的 db)。"""
+    db = SessionLocal()
+    try:
+        return _keyword_recall(db, q, viewer_user_id, viewer_session_key, timings)
+    finally:
+        db.close()
 
 
 def _do_search_knowledge(
@@ -132,8 +284,16 @@ def _do_search_knowledge(
     query: str,
     viewer_user_id: int | None = None,
     viewer_session_key: str | None = None,
+    timings: dict[str, Any] | None = None,
+    rerank_budget_ms: int | None = None,
 ) -> list[dict]:
-    """实际检索逻辑"""
+    """实际检索逻辑
+
+    timings: 可选,传入 dict 时回填各阶段耗时(ms),供 rag_retrieval span 记录。
+    rerank_budget_ms: 远程精排预算,None 时用 RAG_RERANK_BUDGET_MS。
+    """
+    if timings is None:
+        timings = {}
     
     if not RAG_ENABLED:
         logger.info("RAG_ENABLED=False, skip")
@@ -143,39 +303,27 @@ def _do_search_knowledge(
     if not q:
         return []
     
-    # ─── 阶段 1a: 向量召回 ───
-    try:
-        _, q_vec = embed_text(q)
-        logger.debug(f"embed_text OK, vec len={len(q_vec) if q_vec else 0}")
-    except Exception as e:
-        logger.warning(f"embed_text FAILED: {type(e).__name__}: {e}")
-        q_vec = None
-    
-    vector_candidates: list[dict] = []
-    if q_vec:
-        vector_candidates = KnowledgeBaseCRUD.search_chunks_by_embedding(
-            db, q_vec,
-            top_k=RAG_RECALL_TOP_K,
-            score_threshold=RAG_RECALL_THRESHOLD,
-            viewer_user_id=viewer_user_id,
-            viewer_session_key=viewer_session_key,
-        )
-        logger.info(f"vector recall: {len(vector_candidates)} candidates")
-    
-    # ─── 阶段 1b: 关键词召回(BM25 风格) ───
+    # ─── 阶段 1: 召回(向量 + 关键词) ───
+    # 关键词召回不依赖 embedding,混合模式下在独立连接上与"embedding → 向量召回"并行,
+    # 在 RRF 前 join。
+    recall_start = time.perf_counter()
     keyword_candidates: list[dict] = []
-    if HYBRID_SEARCH_ENABLED:
+    if HYBRID_SEARCH_ENABLED and RAG_PARALLEL_RECALL:
+        keyword_timings: dict[str, Any] = {}
+        keyword_future = _RECALL_EXECUTOR.submit(
+            _keyword_recall_own_session, q, viewer_user_id, viewer_session_key, keyword_timings,
+        )
+        vector_candidates = _vector_recall(db, q, viewer_user_id, viewer_session_key, timings)
         try:
-            keyword_candidates = KnowledgeBaseCRUD.search_chunks_by_keyword(
-                db, q,
-                top_k=RAG_KEYWORD_TOP_K,
-                score_threshold=RAG_KEYWORD_THRESHOLD,
-                viewer_user_id=viewer_user_id,
-                viewer_session_key=viewer_session_key,
-            )
-            logger.info(f"keyword recall: {len(keyword_candidates)} candidates")
+            keyword_candidates = keyword_future.result()
         except Exception as e:
-            logger.warning(f"keyword search FAILED: {type(e).__name__}: {e}")
+            logger.warning(f"keyword recall worker FAILED: {type(e).__name__}: {e}")
+        timings.update(keyword_timings)
+    else:
+        vector_candidates = _vector_recall(db, q, viewer_user_id, viewer_session_key, timings)
+        if HYBRID_SEARCH_ENABLED:
+            keyword_candidates = _keyword_recall(db, q, viewer_user_id, viewer_session_key, timings)
+    timings["recall_total"] = _elapsed_ms(recall_start)
     
     # 没有任何召回结果
     if not vector_candidates and not keyword_candidates:
@@ -209,18 +357,32 @@ def _do_search_knowledge(
     
     # ─── 阶段 2: rerank 精排 ───
     documents = [c.get("content", "") for c in candidates]
-    rerank_results = rerank(q, documents, top_n=RAG_RERANK_TOP_N)
+    rerank_start = time.perf_counter()
+    vector_scores = {c["id"]: c.get("score") for c in vector_candidates}
+    rerank_results, rerank_source = rerank_with_budget(
+        q,
+        documents,
+        top_n=RAG_RERANK_TOP_N,
+        chunk_ids=[c["id"] for c in candidates],
+        document_ids=[c["document_id"] for c in candidates],
+        titles=[c.get("title") or "" for c in candidates],
+        vector_scores=[vector_scores.get(c["id"]) for c in candidates],
+        budget_ms=rerank_budget_ms,
+    )
+    timings["rerank"] = _elapsed_ms(rerank_start)
+    timings["rerank_source"] = rerank_source
     
     if rerank_results is None:
         # Rerank 失败 - 回退到融合 Top-N
         logger.warning("rerank unavailable, fallback to fused top-N")
         return candidates[:RAG_RERANK_TOP_N]
     
+    threshold = RAG_LOCAL_RERANK_THRESHOLD if rerank_source == "local" else RAG_RERANK_THRESHOLD
     final = []
     for r in rerank_results:
         idx = r["index"]
         score = r["score"]
-        if score < RAG_RERANK_THRESHOLD:
+        if score < threshold:
             continue
         if idx < 0 or idx >= len(candidates):
             continue
@@ -229,8 +391,8 @@ def _do_search_knowledge(
         final.append(chunk)
     
     logger.info(
-        f"rerank done: {len(rerank_results)} reranked, "
-        f"after threshold {RAG_RERANK_THRESHOLD} kept {len(final)}"
+        f"rerank done ({rerank_source}): {len(rerank_results)} reranked, "
+        f"after threshold {threshold} kept {len(final)}"
     )
     for i, c in enumerate(final[:3]):
         sources_label = "+".join(["V" if s == 0 else "K" for s in c.get("_retrieval_sources", [0])])
@@ -250,6 +412,7 @@ def build_rag_context(
     viewer_user_id: int | None = None,
     viewer_session_key: str | None = None,
     trace=None,
+    rerank_budget_ms: int | None = None,
 ) -> tuple[str, list[str], float]:
     """构建 RAG 上下文。返回三元组:(context, sources_to_show, top_score)。"""
     rows = search_knowledge(
@@ -257,6 +420,7 @@ def build_rag_context(
         viewer_user_id=viewer_user_id,
         viewer_session_key=viewer_session_key,
         trace=trace, #透传
+        rerank_budget_ms=rerank_budget_ms,
     )
     if not rows:
         return "", [], 0.0
@@ -283,4 +447,47 @@ def build_rag_context(
         f"strong_hit={top_score >= RAG_STRONG_HIT_THRESHOLD}, "
         f"sources_shown={len(sources_to_show)}"
     )
-    return context, sources_to_show, top_score
\ No newline at end of file
+    return context, sources_to_show, top_score
+
+
+def prefetch_rag_context(
+    query: str,
+    viewer_user_id: int | None = None,
+    resolve_session_key: Callable[[Session], str | None] | None = None,
+    trace=None,
+    rerank_budget_ms: int | None = RAG_STREAM_RERANK_BUDGET_MS,
+) -> Future:
+    """在独立线程和数据库连接上提前执行 build_rag_context,调用方同时准备会话。
+
+    会话此时可能还没确定,resolve_session_key(db) 在工作线程里只读地推断 viewer_session_key;
+    调用方拿到结果后需核对推断的会话键与实际会话一致,不一致时重新检索。
+
+    Future 结果:(推断的 viewer_session_key, (context, sources_to_show, top_score))。
+    """
+    submitted_ms = trace.elapsed_ms() if trace else 0
+
+    def run():
+        db = SessionLocal()
+        try:
+            session_key = resolve_session_key(db) if resolve_session_key else None
+            if not trace:
+                return session_key, build_rag_context(
+                    db, query, viewer_user_id, session_key, rerank_budget_ms=rerank_budget_ms,
+                )
+            with trace.span("rag_prefetch", "speculative") as span:
+                start_ms = trace.elapsed_ms()
+                span.set_input({"viewer_session_key": session_key, "queue_ms": start_ms - submitted_ms})
+                result = build_rag_context(
+                    db, query, viewer_user_id, session_key,
+                    trace=trace, rerank_budget_ms=rerank_budget_ms,
+                )
+                span.set_output({
+                    "start_ms": start_ms,
+                    "end_ms": trace.elapsed_ms(),
+                    "top_score": round(result[2], 4),
+                })
+                return session_key, result
+        finally:
+            db.close()
+
+    return _PREFETCH_EXECUTOR.submit(run)
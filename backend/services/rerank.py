@@ -6,9 +6,19 @@
 """
 
 import os
-from typing import Optional
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, Optional
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from services.embedding import normalize_cache_text
+from services.local_rerank import local_rerank
 
 
 RERANK_ENABLED = os.getenv("RAG_RERANK_ENABLED", "true").lower() == "true"
@@ -20,11 +30,148 @@ RERANK_API_URL = os.getenv(
 RERANK_TIMEOUT = float(os.getenv("RAG_RERANK_TIMEOUT", "30"))
 RERANK_API_KEY = os.getenv("QWEN_API_KEY", "")
 
+# 精排后端:remote = DashScope(超预算/失败时用本地排序兜底);local = 只用本地 CPU 精排
+RERANK_BACKEND = os.getenv("RAG_RERANK_BACKEND", "remote").strip().lower()
+# 远程精排的等待预算(毫秒),超时即用本地排序;0 表示一直等远程结果
+RERANK_BUDGET_MS = int(os.getenv("RAG_RERANK_BUDGET_MS", "1500"))
+RERANK_LOCAL_FALLBACK = os.getenv("RAG_RERANK_LOCAL_FALLBACK", "true").lower() == "true"
+
+# 精排结果缓存:键为 (模型, 归一化 query, 候选 chunk id 顺序, top_n),文档重建/删除时按文档失效
+RERANK_CACHE_ENABLED = os.getenv("RAG_RERANK_CACHE_ENABLED", "true").lower() == "true"
+RERANK_CACHE_SIZE = max(1, int(os.getenv("RAG_RERANK_CACHE_SIZE", "1024")))
+RERANK_CACHE_TTL = float(os.getenv("RAG_RERANK_CACHE_TTL", "3600"))
+
+
+def _session() -> requests.Session:
+    # 与 services.embedding 一致的 keep-alive 连接池;精排在对话关键路径上,重试次数更少
+    retry = Retry(
+        total=2,
+        connect=2,
+        read=1,
+        backoff_factor=0.3,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("POST",),
+    )
+    s = requests.Session()
+    s.mount("https://", HTTPAdapter(max_retries=retry, pool_maxsize=16))
+    s.mount("http://", HTTPAdapter(max_retries=retry, pool_maxsize=16))
+    return s
+
+
+_SESSION: requests.Session | None = None
+_SESSION_LOCK = threading.Lock()
+
+
+def _get_session() -> requests.Session:
+    global _SESSION
+    if _SESSION is None:
+        with _SESSION_LOCK:
+            if _SESSION is None:
+                _SESSION = _session()
+    return _SESSION
+
+
+CacheKey = tuple[str, str, tuple[int, ...], int]
+
+
+class RerankCache:
+    """线程安全的 LRU + TTL 精排结果缓存,并维护 document_id → 键 的反向索引用于失效。
+
+    chunk id 由 BIGSERIAL 生成、重建后不会复用,所以即便别的进程(独立 worker)重建了文档、
+    本进程没收到失效通知,旧键也不会再被命中;失效主要是及时释放内存。
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._data: OrderedDict[CacheKey, tuple[float, list[dict], frozenset[int]]] = OrderedDict()
+        self._by_doc: dict[int, set[CacheKey]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _drop(self, key: CacheKey) -> None:
+        item = self._data.pop(key, None)
+        if item is None:
+            return
+        for doc_id in item[2]:
+            keys = self._by_doc.get(doc_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_doc[doc_id]
+
+    def get(self, key: CacheKey) -> list[dict] | None:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            if self.ttl_seconds > 0 and time.monotonic() - item[0] > self.ttl_seconds:
+                self._drop(key)
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return [dict(r) for r in item[1]]
+
+    def put(self, key: CacheKey, results: list[dict], doc_ids: frozenset[int]) -> None:
+        with self._lock:
+            self._drop(key)
+            self._data[key] = (time.monotonic(), [dict(r) for r in results], doc_ids)
+            for doc_id in doc_ids:
+                self._by_doc.setdefault(doc_id, set()).add(key)
+            while len(self._data) > self.max_size:
+                self._drop(next(iter(self._data)))
+
+    def invalidate_documents(self, doc_ids: list[int]) -> int:
+        with self._lock:
+            keys: set[CacheKey] = set()
+            for doc_id in doc_ids:
+                keys |= self._by_doc.get(int(doc_id), set())
+            for key in keys:
+                self._drop(key)
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._by_doc.clear()
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+_RERANK_CACHE = RerankCache(RERANK_CACHE_SIZE, RERANK_CACHE_TTL)
+
+
+def rerank_cache_stats() -> dict[str, Any]:
+    """返回精排缓存的命中统计(进程级)。"""
+    return _RERANK_CACHE.stats()
+
+
+def invalidate_rerank_cache(doc_ids: list[int]) -> int:
+    """文档重建索引/删除后调用,丢弃涉及这些文档的缓存项,返回丢弃条数。"""
+    return _RERANK_CACHE.invalidate_documents(doc_ids)
+
 
 def rerank(
     query: str,
     documents: list[str],
     top_n: int = 5,
+    chunk_ids: list[int] | None = None,
+    document_ids: list[int] | None = None,
 ) -> Optional[list[dict]]:
     """对候选文档做相关性重排。
 
@@ -32,6 +179,8 @@ def rerank(
         query: 用户查询
         documents: 候选文档文本列表（embedding 召回的 chunk 内容）
         top_n: 返回前 N 个
+        chunk_ids: 可选，与 documents 一一对应的 chunk id；给出时启用结果缓存
+        document_ids: 可选，候选 chunk 所属文档 id，用于按文档失效缓存
 
     Returns:
         成功时返回 list[dict]，每项包含 {"index": 原始序号, "score": 相关性分数}
@@ -45,6 +194,14 @@ def rerank(
         print("[RERANK] No API key, skip rerank", flush=True)
         return None
 
+    cache_key: CacheKey | None = None
+    if RERANK_CACHE_ENABLED and chunk_ids is not None and len(chunk_ids) == len(documents):
+        cache_key = (RERANK_MODEL, normalize_cache_text(query), tuple(int(i) for i in chunk_ids), top_n)
+        cached = _RERANK_CACHE.get(cache_key)
+        if cached is not None:
+            print(f"[RERANK] cache hit: {len(documents)} candidates", flush=True)
+            return cached
+
     payload = {
         "model": RERANK_MODEL,
         "input": {
@@ -62,7 +219,7 @@ def rerank(
     }
 
     try:
-        resp = requests.post(
+        resp = _get_session().post(
             RERANK_API_URL, json=payload, headers=headers, timeout=RERANK_TIMEOUT
         )
         if resp.status_code != 200:
@@ -88,10 +245,62 @@ def rerank(
             f"tokens={usage.get('total_tokens', '?')}",
             flush=True,
         )
+        if cache_key is not None:
+            _RERANK_CACHE.put(cache_key, normalized, frozenset(int(d) for d in (document_ids or [])))
         return normalized
     except requests.RequestException as e:
         print(f"[RERANK] request failed: {type(e).__name__}: {e}", flush=True)
         return None
     except (KeyError, ValueError) as e:
         print(f"[RERANK] parse failed: {type(e).__name__}: {e}", flush=True)
-        return None
\ No newline at end of file
+        return None
+
+
+# 远程精排放到独立线程执行,调用方只等 RERANK_BUDGET_MS;超时的请求继续跑完并写入缓存,下次同样的问题可直接命中
+_RERANK_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="rerank")
+
+
+def rerank_with_budget(
+    query: str,
+    documents: list[str],
+    top_n: int = 5,
+    chunk_ids: list[int] | None = None,
+    document_ids: list[int] | None = None,
+    titles: list[str] | None = None,
+    vector_scores: list[Optional[float]] | None = None,
+    budget_ms: int | None = None,
+) -> tuple[Optional[list[dict]], str]:
+    """按 RAG_RERANK_BACKEND 选择精排实现,并给远程精排加延迟上限。
+
+    budget_ms: 本次调用的远程精排预算,None 时用 RAG_RERANK_BUDGET_MS。
+
+    Returns:
+        (结果, 来源);来源为 "remote" / "local" / "none"。
+        结果为 None 时上层回退到融合 Top-N(精排关闭,或远程失败且未开本地兜底)。
+    """
+    if not RERANK_ENABLED or not query or not documents:
+        return None, "none"
+
+    def run_local() -> list[dict]:
+        return local_rerank(query, documents, top_n=top_n, titles=titles, vector_scores=vector_scores)
+
+    if RERANK_BACKEND == "local":
+        return run_local(), "local"
+
+    kwargs = {"top_n": top_n, "chunk_ids": chunk_ids, "document_ids": document_ids}
+    budget_ms = RERANK_BUDGET_MS if budget_ms is None else budget_ms
+    if budget_ms > 0:
+        future = _RERANK_EXECUTOR.submit(rerank, query, documents, **kwargs)
+        try:
+            results = future.result(timeout=budget_ms / 1000)
+        except FutureTimeoutError:
+            print(f"[RERANK] remote exceeded {budget_ms}ms budget", flush=True)
+            results = None
+    else:
+        results = rerank(query, documents, **kwargs)
+
+    if results is not None:
+        return results, "remote"
+    if RERANK_LOCAL_FALLBACK:
+        return run_local(), "local"
+    return None, "none"
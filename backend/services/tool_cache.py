@@ -0,0 +1,164 @@
+"""Agent 工具结果缓存。
+
+同一会话里 Agent 经常跨轮次、跨 iteration 重复调用 query_my_abilities / query_class_overview
+之类的聚合查询。工具在 ToolRegistry.register 时声明 ToolCachePolicy 后,
+ToolRegistry.call 会先查这里:
+
+- key: 工具名 + 参数 + 调用方身份(默认取 context 里的 student_id / teacher_user_id);
+- ttl: 每个工具单独设置;
+- tags: 失效标签,如 "student:12:metrics"。写路径(record_metric_event、
+  track_learning_activity、HomeworkCRUD、StudentCRUD.update / set_classes 等)
+  调用 invalidate_tool_cache 丢弃带该标签的条目。
+
+本模块不依赖数据库与 LLM 模块,写路径可以直接导入。
+"""
+
+import copy
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Hashable
+
+AGENT_TOOL_CACHE_ENABLED = os.getenv("AGENT_TOOL_CACHE_ENABLED", "true").lower() == "true"
+AGENT_TOOL_CACHE_SIZE = max(1, int(os.getenv("AGENT_TOOL_CACHE_SIZE", "2048")))
+
+CacheKey = tuple[str, Hashable]
+
+
+def student_tag(student_id: int, kind: str) -> str:
+    return f"student:{student_id}:{kind}"
+
+
+def _default_key(args: dict[str, Any], context: dict[str, Any]) -> Hashable:
+    return (
+        json.dumps(args, sort_keys=True, ensure_ascii=False, default=str),
+        context.get("student_id"),
+        context.get("teacher_user_id"),
+    )
+
+
+@dataclass(frozen=True)
+class ToolCachePolicy:
+    """工具缓存策略。
+
+    ttl: 秒;
+    key: (args, context) -> 可哈希对象,默认参数 + 调用方身份;
+    tags: (args, context, result) -> 失效标签列表,在写入缓存时计算(只在未命中时执行)。
+    """
+
+    ttl: float
+    key: Callable[[dict[str, Any], dict[str, Any]], Hashable] | None = None
+    tags: Callable[[dict[str, Any], dict[str, Any], Any], list[str]] | None = None
+
+    def make_key(self, args: dict[str, Any], context: dict[str, Any]) -> Hashable:
+        return (self.key or _default_key)(args, context)
+
+
+class ToolResultCache:
+    """LRU + TTL,带标签反向索引,便于按写路径精确失效。"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        # key -> (过期时刻, 结果, 标签)
+        self._data: OrderedDict[CacheKey, tuple[float, Any, frozenset[str]]] = OrderedDict()
+        self._by_tag: dict[str, set[CacheKey]] = {}
+        self._lock = threading.Lock()
+        self._hits: dict[str, int] = {}
+        self._misses: dict[str, int] = {}
+        self.invalidations = 0
+        # 失效计数器与各标签最近一次失效时的计数:未命中后执行工具期间,
+        # 若结果的某个标签被失效过,结果可能已过时,不再写入
+        self.epoch = 0
+        self._tag_epoch: dict[str, int] = {}
+
+    def _drop(self, key: CacheKey) -> None:
+        item = self._data.pop(key, None)
+        if item is None:
+            return
+        for tag in item[2]:
+            keys = self._by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_tag[tag]
+
+    def get(self, key: CacheKey) -> tuple[bool, Any]:
+        tool = key[0]
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and time.monotonic() > item[0]:
+                self._drop(key)
+                item = None
+            if item is None:
+                self._misses[tool] = self._misses.get(tool, 0) + 1
+                return False, None
+            self._data.move_to_end(key)
+            self._hits[tool] = self._hits.get(tool, 0) + 1
+            return True, copy.deepcopy(item[1])
+
+    def put(self, key: CacheKey, result: Any, ttl: float, tags: list[str], epoch: int) -> None:
+        """epoch 为执行工具前读到的 self.epoch。"""
+        with self._lock:
+            frozen = frozenset(tags)
+            if any(self._tag_epoch.get(tag, 0) > epoch for tag in frozen):
+                return
+            self._drop(key)
+            self._data[key] = (time.monotonic() + ttl, copy.deepcopy(result), frozen)
+            for tag in frozen:
+                self._by_tag.setdefault(tag, set()).add(key)
+            while len(self._data) > self.max_size:
+                self._drop(next(iter(self._data)))
+
+    def invalidate(self, tags: list[str]) -> int:
+        with self._lock:
+            self.epoch += 1
+            keys: set[CacheKey] = set()
+            for tag in tags:
+                self._tag_epoch[tag] = self.epoch
+                keys |= self._by_tag.get(tag, set())
+            for key in keys:
+                self._drop(key)
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def _tool_stats(self, tool: str) -> dict[str, Any]:
+        hits = self._hits.get(tool, 0)
+        lookups = hits + self._misses.get(tool, 0)
+        return {
+            "hits": hits,
+            "misses": lookups - hits,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+        }
+
+    def hit_rate(self, tool: str) -> float:
+        with self._lock:
+            return self._tool_stats(tool)["hit_rate"]
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "invalidations": self.invalidations,
+                "tools": {t: self._tool_stats(t) for t in sorted(set(self._hits) | set(self._misses))},
+            }
+
+
+_TOOL_CACHE = ToolResultCache(AGENT_TOOL_CACHE_SIZE)
+
+
+def get_tool_cache() -> ToolResultCache:
+    return _TOOL_CACHE
+
+
+def invalidate_tool_cache(*tags: str) -> int:
+    """写路径调用:丢弃带任一标签的工具缓存,返回丢弃条数。"""
+    return _TOOL_CACHE.invalidate(list(tags))
+
+
+def tool_cache_stats() -> dict[str, Any]:
+    """返回工具缓存按工具统计的命中率(进程级)。"""
+    return _TOOL_CACHE.stats()
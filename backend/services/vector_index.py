@@ -0,0 +1,332 @@
+"""
+vector_index.py - 公共知识库的进程内向量索引快照
+
+公共库只在管理员上传/重建/删除时变化,每轮对话都走 Postgres 做 ANN 不划算。
+开启 RAG_MEMORY_INDEX_ENABLED 后:
+- 公共文档(scope='public'、ready、激活、非临时)的 chunk 向量常驻内存(NumPy 平铺矩阵,
+  可选 hnswlib HNSW),检索时只回库按主键取正文;
+- 私有/临时文档仍在 SQL 里检索,由 services.rag 合并;
+- 按文档版本(updated_at/chunk_count/is_active)做增量同步:本进程内入库/删除后立即同步,
+  其它进程(如独立 worker)的改动由定期检查发现;
+- 同步后把快照写到 RAG_MEMORY_INDEX_DIR,重启时 mmap 加载,只补差异文档。
+"""
+import copy
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any
+
+from sqlalchemy.orm import Session
+
+from crud.repositories import KnowledgeBaseCRUD
+from db.session import SessionLocal
+from services.embedding import EMBEDDING_MODEL
+
+try:
+    import numpy as np
+except ImportError:  # 可选依赖:未安装时内存索引不可用,检索照常走 SQL
+    np = None
+
+logger = logging.getLogger(__name__)
+
+RAG_MEMORY_INDEX_ENABLED = os.getenv("RAG_MEMORY_INDEX_ENABLED", "false").lower() == "true"
+RAG_MEMORY_INDEX_DIR = Path(
+    os.getenv(
+        "RAG_MEMORY_INDEX_DIR",
+        str(Path(__file__).resolve().parent.parent / "storage" / "vector_index"),
+    )
+)
+# flat = 精确内积(NumPy);hnswlib = 近似检索(需安装 hnswlib,未安装时退回 flat)
+RAG_MEMORY_INDEX_BACKEND = os.getenv("RAG_MEMORY_INDEX_BACKEND", "flat").strip().lower()
+# 检查数据库中公共文档版本的间隔(秒),发现其它进程的改动
+RAG_MEMORY_INDEX_SYNC_INTERVAL = float(os.getenv("RAG_MEMORY_INDEX_SYNC_INTERVAL", "30"))
+RAG_MEMORY_INDEX_HNSW_M = int(os.getenv("RAG_MEMORY_INDEX_HNSW_M", "16"))
+RAG_MEMORY_INDEX_HNSW_EF_CONSTRUCTION = int(os.getenv("RAG_MEMORY_INDEX_HNSW_EF_CONSTRUCTION", "200"))
+RAG_MEMORY_INDEX_HNSW_EF_SEARCH = int(os.getenv("RAG_MEMORY_INDEX_HNSW_EF_SEARCH", "100"))
+
+_SNAPSHOT_FILES = ("ids.npy", "doc_ids.npy", "vectors.npy")
+
+
+def _normalize_rows(mat):
+    norms = np.linalg.norm(mat, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (mat / norms).astype(np.float32, copy=False)
+
+
+class PublicVectorIndex:
+    """公共库向量索引。数组与 HNSW 索引整体替换(写时复制),检索线程拿到的引用始终是一致的快照。"""
+
+    def __init__(self, directory: Path, backend: str = "flat"):
+        self.directory = directory
+        self.backend = backend
+        self.ids = np.empty(0, dtype=np.int64)
+        self.doc_ids = np.empty(0, dtype=np.int64)
+        self.vectors = np.empty((0, 0), dtype=np.float32)
+        self.doc_versions: dict[int, str] = {}
+        self.ready = False
+        self.last_sync = 0.0
+        self._hnsw = None
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        # 后台同步线程至多一个;运行中又收到变更通知时置 _resync,跑完再同步一轮
+        self._trigger_lock = threading.Lock()
+        self._syncing = False
+        self._resync = False
+
+    # ─── 持久化 ───
+    def load_snapshot(self) -> bool:
+        meta_path = self.directory / "meta.json"
+        if not meta_path.exists():
+            return False
+        try:
+            meta = json.loads(meta_path.read_text(encoding="utf-8"))
+            if meta.get("model") != EMBEDDING_MODEL:
+                logger.info("memory index: snapshot built with another embedding model, ignored")
+                return False
+            ids = np.load(self.directory / "ids.npy", mmap_mode="r")
+            doc_ids = np.load(self.directory / "doc_ids.npy", mmap_mode="r")
+            vectors = np.load(self.directory / "vectors.npy", mmap_mode="r")
+        except Exception as e:
+            logger.warning(f"memory index: load snapshot failed: {type(e).__name__}: {e}")
+            return False
+        with self._lock:
+            self.ids, self.doc_ids, self.vectors = ids, doc_ids, vectors
+            self.doc_versions = {int(k): v for k, v in (meta.get("doc_versions") or {}).items()}
+            self._hnsw = self._load_hnsw(len(ids))
+        logger.info(f"memory index: mmap snapshot with {len(ids)} vectors")
+        return True
+
+    def save_snapshot(self) -> None:
+        with self._lock:
+            ids, doc_ids, vectors = self.ids, self.doc_ids, self.vectors
+            doc_versions = dict(self.doc_versions)
+            hnsw = self._hnsw
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # 先写临时文件再原子替换;meta.json 最后写,加载时以它为准
+        for name, arr in zip(_SNAPSHOT_FILES, (ids, doc_ids, vectors)):
+            tmp = self.directory / f".{name}.tmp"
+            with tmp.open("wb") as f:
+                np.save(f, np.ascontiguousarray(arr))
+            os.replace(tmp, self.directory / name)
+        if hnsw is not None:
+            tmp = self.directory / ".hnsw.bin.tmp"
+            hnsw.save_index(str(tmp))
+            os.replace(tmp, self.directory / "hnsw.bin")
+        meta = {
+            "model": EMBEDDING_MODEL,
+            "count": int(len(ids)),
+            "dim": int(vectors.shape[1]) if vectors.ndim == 2 else 0,
+            "doc_versions": {str(k): v for k, v in doc_versions.items()},
+            "saved_at": time.time(),
+        }
+        tmp = self.directory / ".meta.json.tmp"
+        tmp.write_text(json.dumps(meta), encoding="utf-8")
+        os.replace(tmp, self.directory / "meta.json")
+
+    # ─── HNSW(可选) ───
+    def _new_hnsw(self, dim: int, capacity: int):
+        if self.backend != "hnswlib":
+            return None
+        try:
+            import hnswlib
+        except ImportError:
+            logger.warning("memory index: hnswlib not installed, using flat search")
+            self.backend = "flat"
+            return None
+        index = hnswlib.Index(space="ip", dim=dim)
+        index.init_index(
+            max_elements=max(capacity, 1024),
+            M=RAG_MEMORY_INDEX_HNSW_M,
+            ef_construction=RAG_MEMORY_INDEX_HNSW_EF_CONSTRUCTION,
+            allow_replace_deleted=True,
+        )
+        index.set_ef(RAG_MEMORY_INDEX_HNSW_EF_SEARCH)
+        return index
+
+    def _copy_hnsw(self, index):
+        """复制一份 HNSW 索引供增量修改;复制失败返回 None,由调用方整体重建。"""
+        try:
+            clone = copy.deepcopy(index)
+            clone.set_ef(RAG_MEMORY_INDEX_HNSW_EF_SEARCH)
+            return clone
+        except Exception as e:
+            logger.warning(f"memory index: copy hnsw failed, rebuilding: {type(e).__name__}: {e}")
+            return None
+
+    def _load_hnsw(self, count: int):
+        path = self.directory / "hnsw.bin"
+        if self.backend != "hnswlib" or not path.exists() or count == 0:
+            return None
+        try:
+            import hnswlib
+
+            index = hnswlib.Index(space="ip", dim=int(self.vectors.shape[1]))
+            index.load_index(str(path), max_elements=count, allow_replace_deleted=True)
+            index.set_ef(RAG_MEMORY_INDEX_HNSW_EF_SEARCH)
+            return index
+        except Exception as e:
+            logger.warning(f"memory index: load hnsw failed, using flat: {type(e).__name__}: {e}")
+            return None
+
+    # ─── 增量同步 ───
+    def sync(self, db: Session) -> bool:
+        """与数据库中的公共文档版本对齐,返回是否有变化。"""
+        with self._sync_lock:
+            current = KnowledgeBaseCRUD.list_public_document_versions(db)
+            changed = [d for d, v in current.items() if self.doc_versions.get(d) != v]
+            removed = [d for d in self.doc_versions if d not in current]
+            self.last_sync = time.monotonic()
+            if not changed and not removed:
+                self.ready = True
+                return False
+
+            stale = np.asarray(changed + removed, dtype=np.int64)
+            keep = ~np.isin(self.doc_ids, stale) if len(self.doc_ids) else np.empty(0, dtype=bool)
+            new_ids, new_doc_ids, new_vecs = [], [], []
+            for row in KnowledgeBaseCRUD.iter_chunk_embeddings(db, changed):
+                new_ids.append(row["id"])
+                new_doc_ids.append(row["document_id"])
+                new_vecs.append(row["embedding"])
+
+            dim = len(new_vecs[0]) if new_vecs else (self.vectors.shape[1] if self.vectors.ndim == 2 else 0)
+            added = _normalize_rows(np.asarray(new_vecs, dtype=np.float32)) if new_vecs else np.empty((0, dim), np.float32)
+            old_vectors = self.vectors[keep] if len(keep) else np.empty((0, dim), np.float32)
+            ids = np.concatenate([self.ids[keep] if len(keep) else self.ids, np.asarray(new_ids, dtype=np.int64)])
+            doc_ids = np.concatenate(
+                [self.doc_ids[keep] if len(keep) else self.doc_ids, np.asarray(new_doc_ids, dtype=np.int64)]
+            )
+            vectors = np.vstack([old_vectors, added]) if dim else np.empty((0, 0), np.float32)
+
+            # 检索线程不加锁调用 knn_query,不能原地修改正在使用的索引:
+            # 在副本上删除/追加(或整体重建),与数组一起在 _lock 下替换
+            hnsw = self._hnsw
+            if self.backend == "hnswlib" and dim:
+                if hnsw is not None:
+                    hnsw = self._copy_hnsw(hnsw)
+                if hnsw is None:
+                    hnsw = self._new_hnsw(dim, len(ids))
+                    if hnsw is not None and len(ids):
+                        hnsw.add_items(vectors, ids)
+                else:
+                    for chunk_id in self.ids[~keep] if len(keep) else []:
+                        hnsw.mark_deleted(int(chunk_id))
+                    if len(new_ids):
+                        if hnsw.get_current_count() + len(new_ids) > hnsw.get_max_elements():
+                            hnsw.resize_index(hnsw.get_current_count() + len(new_ids) + 1024)
+                        hnsw.add_items(added, np.asarray(new_ids, dtype=np.int64), replace_deleted=True)
+
+            with self._lock:
+                self.ids, self.doc_ids, self.vectors, self._hnsw = ids, doc_ids, vectors, hnsw
+                self.doc_versions = current
+                self.ready = True
+            logger.info(
+                f"memory index: synced {len(changed)} changed / {len(removed)} removed docs, "
+                f"{len(ids)} vectors"
+            )
+            return True
+
+    # ─── 检索 ───
+    def search(self, query_vec: list[float], top_k: int, score_threshold: float) -> list[tuple[int, float]]:
+        """返回 [(chunk_id, 余弦相似度)],按相似度降序。"""
+        with self._lock:
+            ids, vectors, hnsw = self.ids, self.vectors, self._hnsw
+        if not len(ids) or top_k <= 0:
+            return []
+        q = np.asarray(query_vec, dtype=np.float32)
+        norm = float(np.linalg.norm(q))
+        if norm == 0 or q.shape[0] != vectors.shape[1]:
+            return []
+        q /= norm
+        if hnsw is not None:
+            # get_current_count() 含已标记删除的元素,k 以存活向量数为上限
+            k = min(top_k, len(ids))
+            labels, distances = hnsw.knn_query(q, k=k)
+            hits = [(int(l), 1.0 - float(d)) for l, d in zip(labels[0], distances[0])]
+        else:
+            scores = vectors @ q
+            k = min(top_k, len(scores))
+            top = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+            top = top[np.argsort(-scores[top])]
+            hits = [(int(ids[i]), float(scores[i])) for i in top]
+        return [(cid, s) for cid, s in hits if s >= score_threshold]
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "ready": self.ready,
+                "backend": "hnswlib" if self._hnsw is not None else "flat",
+                "vectors": int(len(self.ids)),
+                "documents": len(self.doc_versions),
+                "memory_mb": round(self.vectors.nbytes / 1024 / 1024, 1) if self.vectors.size else 0.0,
+            }
+
+
+_INDEX: PublicVectorIndex | None = None
+_INDEX_LOCK = threading.Lock()
+
+
+def _sync_in_background(index: PublicVectorIndex, save: bool = True) -> None:
+    def run() -> None:
+        while True:
+            db = SessionLocal()
+            try:
+                if index.sync(db) and save:
+                    index.save_snapshot()
+            except Exception as e:
+                db.rollback()
+                logger.warning(f"memory index: sync failed: {type(e).__name__}: {e}")
+            finally:
+                db.close()
+            with index._trigger_lock:
+                if not index._resync:
+                    index._syncing = False
+                    return
+                index._resync = False
+
+    with index._trigger_lock:
+        if index._syncing:
+            index._resync = True
+            return
+        index._syncing = True
+    threading.Thread(target=run, name="kb-memory-index", daemon=True).start()
+
+
+def warm_public_index() -> None:
+    """启动时调用:加载快照(若有)并在后台与数据库对齐。未开启或缺 numpy 时什么都不做。"""
+    global _INDEX
+    if not RAG_MEMORY_INDEX_ENABLED:
+        return
+    if np is None:
+        logger.warning("memory index: numpy not installed, RAG_MEMORY_INDEX_ENABLED ignored")
+        return
+    with _INDEX_LOCK:
+        if _INDEX is not None:
+            return
+        _INDEX = PublicVectorIndex(RAG_MEMORY_INDEX_DIR, RAG_MEMORY_INDEX_BACKEND)
+        _INDEX.load_snapshot()
+    _sync_in_background(_INDEX)
+
+
+def get_public_index() -> PublicVectorIndex | None:
+    """已就绪的公共库索引;未开启/未就绪时返回 None(调用方走 SQL)。顺带触发定期版本检查。"""
+    if _INDEX is None:
+        warm_public_index()
+    index = _INDEX
+    if index is None or not index.ready:
+        return None
+    if time.monotonic() - index.last_sync > RAG_MEMORY_INDEX_SYNC_INTERVAL:
+        _sync_in_background(index)
+    return index
+
+
+def notify_documents_changed(doc_ids: list[int]) -> None:
+    """文档入库完成/删除后调用,尽快把变化同步进内存索引。"""
+    if _INDEX is not None and doc_ids:
+        _sync_in_background(_INDEX)
+
+
+def memory_index_stats() -> dict[str, Any] | None:
+    return _INDEX.stats() if _INDEX is not None else None
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+backend_root = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(backend_root))
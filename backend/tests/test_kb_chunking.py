@@ -0,0 +1,82 @@
+"""iter_chunks(逐页流式切块)与整篇切块的等价性。"""
+import json
+import random
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+from services.kb_ingest import _looks_like_index_page, iter_chunks
+
+
+def reference_chunk_text(text: str, chunk_size: int = 700, overlap: int = 100) -> list[tuple[int, int, str]]:
+    """流式切块之前的整篇切分(extract_text + chunk_text),返回 (start, end, content)。"""
+    cleaned = (text or "").strip().replace("\r\n", "\n").strip()
+    chunks = []
+    start = 0
+    n = len(cleaned)
+    while start < n:
+        end = min(start + chunk_size, n)
+        content = cleaned[start:end].strip()
+        if content and not _looks_like_index_page(content)[0]:
+            chunks.append((start, end, content))
+        if end >= n:
+            break
+        start = max(0, end - overlap)
+    return chunks
+
+
+def streamed(pages, **kwargs) -> list[tuple[int, int, str]]:
+    out = []
+    for i, chunk in enumerate(iter_chunks(pages, **kwargs)):
+        assert chunk["chunk_index"] == i
+        meta = json.loads(chunk["metadata_json"])
+        out.append((meta["start"], meta["end"], chunk["content"]))
+    return out
+
+
+def assert_same(pages, **kwargs):
+    whole = "".join(text for _, text in pages)
+    assert streamed(pages, **kwargs) == reference_chunk_text(whole, **kwargs)
+
+
+def test_trailing_blank_page_does_not_add_overlap_chunk():
+    pages = [(1, "x" * 650 + " word" * 10), (2, "\n   \n")]
+    assert streamed(pages) == [(0, 700, "x" * 650 + " word" * 10)]
+    assert_same(pages)
+
+
+def test_crlf_split_across_pages():
+    pages = [(1, "a" * 699 + "\r"), (2, "\n" + "b" * 300), (3, "\r"), (4, "\nc" * 200)]
+    assert_same(pages)
+
+
+def test_leading_whitespace_pages():
+    assert_same([(1, "  \n"), (2, "\r"), (3, "\n  Hallo Welt " * 120)])
+
+
+def test_empty_document():
+    assert streamed([(1, ""), (2, " \r\n ")]) == []
+
+
+def test_page_numbers():
+    pages = [(1, "a" * 500), (2, "b" * 500), (3, "c" * 500)]
+    metas = [json.loads(c["metadata_json"]) for c in iter_chunks(pages)]
+    assert (metas[0]["page_start"], metas[0]["page_end"]) == (1, 2)
+    assert (metas[1]["page_start"], metas[1]["page_end"]) == (2, 3)
+    assert (metas[2]["page_start"], metas[2]["page_end"]) == (3, 3)
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_random_pages_match_whole_text(seed):
+    rng = random.Random(seed)
+    alphabet = ["a", "b", "Wort ", " ", "\n", "\r\n", "\r", "\t"]
+    pages = []
+    for page_no in range(1, rng.randint(1, 8) + 1):
+        if rng.random() < 0.2:
+            text = rng.choice(["", " ", "\n \n", "\r", "\r\n"])
+        else:
+            text = "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 400)))
+        pages.append((page_no, text))
+    chunk_size = rng.choice([50, 120, 700])
+    assert_same(pages, chunk_size=chunk_size, overlap=chunk_size // 7)
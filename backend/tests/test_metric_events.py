@@ -0,0 +1,256 @@
+"""record_metric_event(增量)与 refresh_student_metrics_batch(全量重建)的一致性。
+
+需要一个已执行 alembic upgrade head 的 PostgreSQL:TEST_DATABASE_URL=postgresql+psycopg://...
+每个用例建一个临时学生,结束时连同其行为数据一起删除。
+"""
+import os
+import uuid
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL", "").strip()
+if not TEST_DATABASE_URL:
+    pytest.skip("TEST_DATABASE_URL not set", allow_module_level=True)
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+from crud.repositories import (
+    ChatMessageCRUD,
+    ChatSessionCRUD,
+    GrammarSubmissionCRUD,
+    HomeworkCRUD,
+    SpeakingEvaluationCRUD,
+    StudentMetricStatsCRUD,
+    StudentVocabCollectionCRUD,
+    WritingSessionCRUD,
+)
+from models.entities import (
+    GrammarCategory,
+    GrammarExercise,
+    ListeningMaterial,
+    Student,
+    User,
+    Vocabulary,
+)
+from schemas.entities import (
+    ChatMessageCreate,
+    ChatSessionCreate,
+    GrammarSubmissionCreate,
+    HomeworkCreate,
+    SpeakingEvaluationCreate,
+    StudentVocabCollectionCreate,
+    WritingSessionCreate,
+)
+from services.metrics import (
+    METRICS_WINDOW_DAYS,
+    _window_start,
+    record_metric_event,
+    refresh_student_metrics_batch,
+    track_learning_activity,
+)
+
+
+@pytest.fixture(scope="module")
+def session_factory():
+    engine = create_engine(TEST_DATABASE_URL, future=True)
+    yield sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
+    engine.dispose()
+
+
+@pytest.fixture
+def ctx(session_factory):
+    """临时学生 + 语法题/听力材料/词汇各若干,并用全量重建建立统计行。"""
+    db = session_factory()
+    tag = uuid.uuid4().hex[:10]
+    user = User(username=f"metric-{tag}", password_hash="x", role="student", display_name="metric test")
+    db.add(user)
+    db.flush()
+    student = Student(uid=f"metric-{tag}", user_id=user.id, name="metric test")
+    category = GrammarCategory(name=f"metric-{tag}")
+    material = ListeningMaterial(title=f"metric-{tag}", audio_url="about:blank")
+    vocabs = [Vocabulary(german=f"metric-{tag}-{i}", chinese="测试") for i in range(3)]
+    db.add_all([student, category, material, *vocabs])
+    db.flush()
+    exercises = [
+        GrammarExercise(category_id=category.id, question=f"q{i}", correct_answer="a") for i in range(3)
+    ]
+    db.add_all(exercises)
+    db.commit()
+    refresh_student_metrics_batch(db, [student.id])
+    yield {
+        "db": db,
+        "student_id": student.id,
+        "exercise_ids": [e.id for e in exercises],
+        "material_id": material.id,
+        "vocab_ids": [v.id for v in vocabs],
+    }
+    db.rollback()
+    db.execute(text("DELETE FROM users WHERE id = :id"), {"id": user.id})
+    db.execute(text("DELETE FROM grammar_categories WHERE id = :id"), {"id": category.id})
+    db.execute(text("DELETE FROM listening_materials WHERE id = :id"), {"id": material.id})
+    db.execute(text("DELETE FROM vocabularies WHERE id = ANY(:ids)"), {"ids": [v.id for v in vocabs]})
+    db.commit()
+    db.close()
+
+
+def snapshot(db, student_id: int) -> dict:
+    """累计量、窗口计数、students 上的指标与 student_abilities。"""
+    db.expire_all()
+    stats = db.execute(
+        text("SELECT * FROM student_metric_stats WHERE student_id = :sid"), {"sid": student_id}
+    ).mappings().first()
+    assert stats is not None
+    window = StudentMetricStatsCRUD.window_counts(
+        db, [student_id], _window_start(METRICS_WINDOW_DAYS)
+    ).get(student_id, {})
+    student = db.execute(
+        text("SELECT active_score, overall_score, weak_point FROM students WHERE id = :sid"),
+        {"sid": student_id},
+    ).mappings().first()
+    ability = db.execute(
+        text(
+            "SELECT listening, speaking, reading, writing, ai_diagnosis "
+            "FROM student_abilities WHERE student_id = :sid"
+        ),
+        {"sid": student_id},
+    ).mappings().first()
+    return {
+        "stats": {c: round(float(stats[c] or 0), 6) for c in StudentMetricStatsCRUD.COUNTERS},
+        "window": {c: int(window.get(c, 0)) for c in StudentMetricStatsCRUD.DAILY_COUNTERS},
+        "student": {
+            "active_score": int(student["active_score"]),
+            "overall_score": round(float(student["overall_score"]), 2),
+            "weak_point": student["weak_point"],
+        },
+        "ability": dict(ability) if ability else None,
+    }
+
+
+def assert_event_matches_rebuild(c: dict, kind: str, **payload) -> dict:
+    """原始数据已提交后调用:增量事件的结果必须与随后全量重建的结果一致。"""
+    db, sid = c["db"], c["student_id"]
+    assert record_metric_event(db, sid, kind, **payload) is not None
+    incremental = snapshot(db, sid)
+    refresh_student_metrics_batch(db, [sid])
+    assert incremental == snapshot(db, sid)
+    return incremental
+
+
+# ─── 与各写路径相同的原始数据写入 + 事件参数 ───
+
+def submit_grammar(c: dict, answers: dict[int, bool]) -> None:
+    """同 routers/student_learning.py 的语法提交:首次作答新增记录,重答覆盖原记录。"""
+    db, sid = c["db"], c["student_id"]
+    new_submissions = correct_delta = 0
+    for exercise_id, is_correct in answers.items():
+        last = GrammarSubmissionCRUD.get_last_submission(db, sid, exercise_id)
+        if last:
+            correct_delta += int(is_correct) - int(bool(last.is_correct))
+            last.user_answer = "a" if is_correct else "b"
+            last.is_correct = is_correct
+            db.merge(last)
+        else:
+            new_submissions += 1
+            correct_delta += int(is_correct)
+            GrammarSubmissionCRUD.create(db, GrammarSubmissionCreate(
+                student_id=sid, exercise_id=exercise_id,
+                user_answer="a" if is_correct else "b", is_correct=is_correct,
+            ))
+    db.commit()
+    track_learning_activity(db, sid, "语法练习", max(3, len(answers) * 2))
+    db.commit()
+    assert_event_matches_rebuild(
+        c, "grammar_submission", submitted=new_submissions, correct=correct_delta
+    )
+
+
+def test_grammar_first_answer(ctx):
+    e1, e2, _ = ctx["exercise_ids"]
+    submit_grammar(ctx, {e1: True, e2: False})
+
+
+def test_grammar_re_answer(ctx):
+    e1, e2, e3 = ctx["exercise_ids"]
+    submit_grammar(ctx, {e1: True, e2: False})
+    # 重答:一题由对变错、一题由错变对、一题首次作答
+    submit_grammar(ctx, {e1: False, e2: True, e3: True})
+    submit_grammar(ctx, {e1: False, e2: False})
+
+
+def test_speaking_evaluation(ctx):
+    db, sid = ctx["db"], ctx["student_id"]
+    SpeakingEvaluationCRUD.create(db, SpeakingEvaluationCreate(
+        student_id=sid, material_id=ctx["material_id"],
+        total_score=82.5, pronunciation_score=80, fluency_score=85, intonation_score=79.5,
+    ))
+    assert_event_matches_rebuild(
+        ctx, "speaking_evaluation",
+        total_score=82.5, pronunciation_score=80, fluency_score=85, intonation_score=79.5,
+    )
+    # 未评分的测评只计练习次数
+    SpeakingEvaluationCRUD.create(db, SpeakingEvaluationCreate(student_id=sid, material_id=ctx["material_id"]))
+    assert_event_matches_rebuild(ctx, "speaking_evaluation")
+
+
+def test_writing_session(ctx):
+    db, sid = ctx["db"], ctx["student_id"]
+    user_text = "Ich lerne seit zwei Jahren Deutsch. Heute schreibe ich über meine Familie."
+    WritingSessionCRUD.create(db, WritingSessionCreate(student_id=sid, session_type="check", user_text=user_text))
+    assert_event_matches_rebuild(ctx, "writing_session", text_length=len(user_text))
+
+
+def test_vocab_collect_and_uncollect(ctx):
+    db, sid = ctx["db"], ctx["student_id"]
+    v1, v2, _ = ctx["vocab_ids"]
+    for vid in (v1, v2):
+        StudentVocabCollectionCRUD.collect(db, StudentVocabCollectionCreate(student_id=sid, vocab_id=vid))
+        assert_event_matches_rebuild(ctx, "vocab_collection", delta=1)
+    assert StudentVocabCollectionCRUD.uncollect(db, sid, v1)
+    after = assert_event_matches_rebuild(ctx, "vocab_collection", delta=-1)
+    assert after["stats"]["vocab_count"] == 1
+
+
+def test_chat_message(ctx):
+    db, sid = ctx["db"], ctx["student_id"]
+    session = ChatSessionCRUD.create(db, ChatSessionCreate(student_id=sid, title="metric test"))
+    ChatMessageCRUD.create(db, ChatMessageCreate(session_id=session.id, role="user", content="Hallo!"))
+    ChatMessageCRUD.create(db, ChatMessageCreate(session_id=session.id, role="assistant", content="Hallo, wie geht's?"))
+    ChatMessageCRUD.create(db, ChatMessageCreate(session_id=session.id, role="user", content="Gut, danke."))
+    assert_event_matches_rebuild(ctx, "chat_message", user_messages=2)
+
+
+def test_learning(ctx):
+    db, sid = ctx["db"], ctx["student_id"]
+    track_learning_activity(db, sid, "听力训练", 12, "听力材料")
+    db.commit()
+    assert_event_matches_rebuild(ctx, "learning")
+
+
+def test_homework_completed_and_rescored(ctx):
+    db, sid = ctx["db"], ctx["student_id"]
+    # 试卷提交:已完成且带分数
+    exam_hw = HomeworkCRUD.create(db, HomeworkCreate(
+        student_id=sid, title="exam", status="已完成", submitted_at=datetime.now(), score=60.0,
+    ))
+    assert_event_matches_rebuild(ctx, "homework_completed", score=60.0)
+    # 上传作业:已完成但待教师评分
+    upload_hw = HomeworkCRUD.create(db, HomeworkCreate(
+        student_id=sid, title="upload", status="已完成", submitted_at=datetime.now(),
+    ))
+    assert_event_matches_rebuild(ctx, "homework_completed", score=None)
+
+    # 首次评分与重新评分(同 routers/student.py save_homework_review)
+    for hw_id, new_score in ((upload_hw.id, 75.0), (exam_hw.id, 90.0), (upload_hw.id, 68.5)):
+        old_score = HomeworkCRUD.get_by_id(db, hw_id).score
+        HomeworkCRUD.update_score_feedback(db, hw_id, new_score, None)
+        after = assert_event_matches_rebuild(
+            ctx, "homework_scored",
+            old_score=None if old_score is None else float(old_score),
+            new_score=new_score,
+        )
+    assert after["stats"]["homework_scored"] == 2
+    assert after["stats"]["homework_score_sum"] == pytest.approx(90.0 + 68.5)